@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарки горячих путей UI-бота.
+Запуск: python3 bench_components.py [имя_бенчмарка ...]
+
+Работает на временной SQLite-базе (UI_BOT_DB_PATH), рабочую БД не трогает.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+_TMP_DIR = tempfile.mkdtemp(prefix="ui_bot_bench_")
+os.environ.setdefault("UI_BOT_DB_PATH", os.path.join(_TMP_DIR, "bench.sqlite3"))
+
+
+def _report(name, ops, seconds):
+    rate = ops / seconds if seconds > 0 else float("inf")
+    per_op_us = seconds / ops * 1e6 if ops else 0.0
+    print(f"  {name:<40} {rate:>12,.0f} ops/s  {per_op_us:>9.1f} µs/op")
+
+
+def _timeit(fn, ops):
+    start = time.perf_counter()
+    fn(ops)
+    return time.perf_counter() - start
+
+
+def bench_db_pool():
+    """Пул соединений vs новое соединение на каждый вызов (как было до пула)."""
+    import sqlite3
+    import user_db_handler as db
+
+    db.init_db()
+    user_id = 42
+    asyncio.run(db.ensure_user(user_id))
+    ops = 5000
+
+    def connect_per_call(n):
+        for _ in range(n):
+            conn = sqlite3.connect(db.DB_PATH, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA foreign_keys = ON;")
+            conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            conn.close()
+
+    def pooled(n):
+        pool = db._pool()
+        for _ in range(n):
+            with pool.reader() as conn:
+                conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+
+    print("SQLite: чтение профиля (синхронно)")
+    _report("connect per call", ops, _timeit(connect_per_call, ops))
+    _report("pool.reader()", ops, _timeit(pooled, ops))
+
+    async def handled_updates(n):
+        for _ in range(n):
+            await db.get_user_profile(user_id)
+            await db.get_user_state(user_id, "nav_stack", default=[])
+            await db.set_user_state(user_id, "current_screen", "menu")
+
+    updates = 500
+    start = time.perf_counter()
+    asyncio.run(handled_updates(updates))
+    print("SQLite: апдейт (profile + state read + state write)")
+    _report("get_user_profile/get/set_user_state", updates, time.perf_counter() - start)
+
+
+def bench_group_commit():
+    """Конкурентные записи: group commit писателя."""
+    import user_db_handler as db
+
+    db.init_db()
+    base_user_id = 1000
+    writes = 2000
+
+    async def burst(n):
+        await asyncio.gather(*[db.set_user_state(base_user_id + i % 100, "k", i) for i in range(n)])
+
+    before = db.get_writer_stats()
+    start = time.perf_counter()
+    asyncio.run(burst(writes))
+    seconds = time.perf_counter() - start
+    after = db.get_writer_stats()
+    batches = after["batches"] - before["batches"]
+    print(f"SQLite: {writes} конкурентных set_user_state → {batches} COMMIT (max пачка {after['max_batch']})")
+    _report("set_user_state (gather)", writes, seconds)
+
+
+def bench_callback_router():
+    """Диспетчеризация callback_data: trie-роутер vs цепочка startswith()."""
+    from ui_router import CallbackRouter
+
+    async def handler(**kwargs):
+        return None
+
+    lookups = 50000
+    print(f"{'маршрутов':>10} {'trie resolve':>16} {'if-chain':>16}")
+    for n_routes in (10, 100, 1000):
+        router = CallbackRouter()
+        prefixes = []
+        for i in range(n_routes):
+            router.add_route(f"r{i}:set:{{value}}", handler)
+            prefixes.append(f"r{i}:set:")
+        # Худший для цепочки случай — последний маршрут
+        data = f"r{n_routes - 1}:set:abc"
+
+        def trie(n):
+            resolve = router.resolve
+            for _ in range(n):
+                resolve(data)
+
+        def chain(n):
+            for _ in range(n):
+                for prefix in prefixes:
+                    if data.startswith(prefix):
+                        data.split(":", 2)[2]
+                        break
+
+        t_trie = _timeit(trie, lookups) / lookups * 1e6
+        t_chain = _timeit(chain, lookups) / lookups * 1e6
+        print(f"{n_routes:>10} {t_trie:>13.2f} µs {t_chain:>13.2f} µs")
+
+
+def bench_render_screen():
+    """render_screen: кэш экранов vs сборка клавиатуры и tr() на каждый рендер."""
+    import main
+    from user_db_handler import UserSession
+
+    profile = {"user_id": 1, "language": "ru", "currency": "USD", "plan": "vip"}
+    session = UserSession(1, profile, {"nav_stack": ["home"], "current_screen": "menu"}, has_credentials=True)
+    screens = ["home", "menu", "help", "bank", "my_longs", "autotrade", "plans", "settings"]
+    renders = 20000
+
+    def uncached(n):
+        for i in range(n):
+            screen = screens[i % len(screens)]
+            text, _ = main._build_screen(lang="ru", plan="vip", screen=screen, show_back=True, show_home=screen != "home")
+            if screen in main._DYNAMIC_SCREENS:
+                text.format(user_id=1, language="ru", currency="USD", po_status="ok")
+
+    def cached(n):
+        for i in range(n):
+            main.render_screen(session=session, screen=screens[i % len(screens)])
+
+    print("Рендер экранов (8 экранов по кругу)")
+    _report("без кэша (_build_screen)", renders, _timeit(uncached, renders))
+    _report("render_screen (кэш)", renders, _timeit(cached, renders))
+
+
+def bench_translations():
+    """tr(): скомпилированный каталог vs поиск по TRANSLATIONS + str.format на каждый вызов."""
+    import main
+
+    translations = main.TRANSLATIONS
+
+    def legacy_tr(lang, key, **kwargs):
+        table = translations.get(lang) or translations["ru"]
+        template = table.get(key) or translations["ru"].get(key) or key
+        try:
+            return template.format(**kwargs)
+        except Exception:
+            return template
+
+    keys = [("en", "btn_menu", {}), ("ru", "help_body", {}), ("en", "nav_back", {}), ("ru", "bank_body", {"plan": "vip"})]
+    calls = 200000
+
+    def legacy(n):
+        for i in range(n):
+            lang, key, kwargs = keys[i & 3]
+            legacy_tr(lang, key, **kwargs)
+
+    def catalog(n):
+        tr = main.CATALOG.tr
+        for i in range(n):
+            lang, key, kwargs = keys[i & 3]
+            tr(lang, key, **kwargs)
+
+    print("tr() (3 статических строки + 1 шаблон)")
+    _report("TRANSLATIONS + format", calls, _timeit(legacy, calls))
+    _report("TranslationCatalog.tr", calls, _timeit(catalog, calls))
+
+
+def bench_crypto():
+    """Шифрование: ключ + Fernet на каждый вызов vs реестр шифров и encrypt_many."""
+    from cryptography.fernet import Fernet
+
+    os.environ.setdefault("ENCRYPTION_KEY", Fernet.generate_key().decode())
+    import crypto_utils
+
+    crypto_utils.reload_cipher()
+    values = ["login_1234567", "password_secret"]
+    ops = 20000
+
+    def legacy(n):
+        for i in range(n):
+            key = crypto_utils.get_encryption_key()
+            Fernet(key.encode()).encrypt(values[i & 1].encode()).decode()
+
+    def cached(n):
+        for i in range(n):
+            crypto_utils.encrypt_data(values[i & 1])
+
+    def batched(n):
+        for _ in range(n // 2):
+            crypto_utils.encrypt_many(values)
+
+    def setup_only(n):
+        for _ in range(n):
+            Fernet(crypto_utils.get_encryption_key().encode())
+
+    token = crypto_utils.encrypt_data(values[0])
+
+    def legacy_decrypt(n):
+        for _ in range(n):
+            Fernet(crypto_utils.get_encryption_key().encode()).decrypt(token.encode())
+
+    def cached_decrypt(n):
+        for _ in range(n):
+            crypto_utils.decrypt_data(token)
+
+    async def pairs_inline(n):
+        for _ in range(n // 2):
+            crypto_utils.encrypt_many(values)
+
+    async def pairs_async(n):
+        for _ in range(n // 2):
+            await crypto_utils.encrypt_many_async(values)
+
+    async def loop_stall(fn, n):
+        # Самый длинный промежуток, когда event loop не мог выполнить другую задачу
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0)
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        await fn(n)
+        ticks.append(time.perf_counter())
+        task.cancel()
+        return max(b - a for a, b in zip(ticks, ticks[1:])) * 1e6
+
+    print("Fernet: шифрование/расшифрование коротких строк")
+    _report("накладные: env + Fernet() (без шифрования)", ops, _timeit(setup_only, ops))
+    _report("encrypt: env + Fernet() на вызов", ops, _timeit(legacy, ops))
+    _report("encrypt_data (реестр)", ops, _timeit(cached, ops))
+    _report("encrypt_many (пары login/password)", ops, _timeit(batched, ops))
+    _report("decrypt: env + Fernet() на вызов", ops, _timeit(legacy_decrypt, ops))
+    _report("decrypt_data (реестр)", ops, _timeit(cached_decrypt, ops))
+
+    async_ops = 2000
+    print("Пары login/password: на event loop vs encrypt_many_async (пул потоков)")
+    _report("encrypt_many на loop", async_ops, _timeit(lambda n: asyncio.run(pairs_inline(n)), async_ops))
+    _report("encrypt_many_async", async_ops, _timeit(lambda n: asyncio.run(pairs_async(n)), async_ops))
+    print(f"  макс. блокировка loop (1000 пар подряд): на loop {asyncio.run(loop_stall(pairs_inline, async_ops)):,.0f} µs, "
+          f"в пуле {asyncio.run(loop_stall(pairs_async, async_ops)):,.0f} µs")
+
+
+def bench_session_state():
+    """Навигация: строки user_states (JSON на ключ) vs упакованная строка user_sessions."""
+    import json
+    import user_db_handler as db
+
+    db.init_db()
+    user_id = 77
+    asyncio.run(db.ensure_user(user_id))
+    screens = ["home", "menu", "settings", "plans", "help", "bank"]
+    navs = 300
+
+    def nav_state(i):
+        return screens[i % len(screens)], screens[: 1 + i % 5]
+
+    async def legacy(n):
+        # Как UserSession.flush до упаковки: ensure users + upsert строки на каждый ключ
+        for i in range(n):
+            current, stack = nav_state(i)
+            rows = [("current_screen", json.dumps(current)), ("nav_stack", json.dumps(stack))]
+
+            def _op(conn, rows=rows):
+                now = db._utcnow_iso()
+                db._ensure_user_row(conn, user_id, now)
+                conn.executemany(
+                    "INSERT INTO user_states (user_id, key, value_json, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(user_id, key) DO UPDATE SET value_json = excluded.value_json, updated_at = excluded.updated_at",
+                    [(user_id, k, v, now) for k, v in rows],
+                )
+
+            await db._write(_op)
+
+    async def packed(n):
+        # Как UserSession.flush теперь: ensure users (INSERT ... DO NOTHING) + одна упакованная строка
+        for i in range(n):
+            current, stack = nav_state(i)
+            nav = {"current_screen": current, "nav_stack": stack}
+
+            def _op(conn, nav=nav):
+                now = db._utcnow_iso()
+                db._ensure_user_row(conn, user_id, now)
+                db._save_nav(conn, user_id, nav, now)
+
+            await db._write(_op)
+
+    def measure(fn):
+        statements = []
+        with db._pool().writer() as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.set_trace_callback(statements.append)
+        wal = db.DB_PATH + "-wal"
+        start = time.perf_counter()
+        asyncio.run(fn(navs))
+        seconds = time.perf_counter() - start
+        with db._pool().writer() as conn:
+            conn.set_trace_callback(None)
+        data = [st for st in statements if st.split(None, 1)[0].upper() in ("INSERT", "UPDATE", "DELETE")]
+        return seconds, len(data) / navs, os.path.getsize(wal) / navs if os.path.exists(wal) else 0.0
+
+    current, stack = nav_state(4)
+    json_bytes = sum(len(k) + len(json.dumps(v)) + 20 for k, v in (("current_screen", current), ("nav_stack", stack)))
+    packed_bytes = len(db._pack_nav({"current_screen": current, "nav_stack": stack})) + 20
+    print(f"Навигация ({navs} переходов): значения+ключи+updated_at — JSON {json_bytes} Б, упаковано {packed_bytes} Б")
+    asyncio.run(db.delete_user_state(user_id, "nav_stack"))
+    asyncio.run(db.delete_user_state(user_id, "current_screen"))
+    for name, fn in (("user_states (JSON, строка на ключ)", legacy), ("user_sessions (упаковано)", packed)):
+        seconds, per_nav, wal_bytes = measure(fn)
+        _report(name, navs, seconds)
+        print(f"  {'':<40} {per_nav:>5.1f} DML/переход  {wal_bytes:>9,.0f} Б WAL/переход")
+
+
+BENCHMARKS = {
+    "db_pool": bench_db_pool,
+    "group_commit": bench_group_commit,
+    "callback_router": bench_callback_router,
+    "render_screen": bench_render_screen,
+    "translations": bench_translations,
+    "crypto": bench_crypto,
+    "session_state": bench_session_state,
+}
+
+
+def main(argv):
+    names = argv or list(BENCHMARKS)
+    for name in names:
+        fn = BENCHMARKS.get(name)
+        if fn is None:
+            print(f"Неизвестный бенчмарк: {name}. Доступные: {', '.join(BENCHMARKS)}")
+            return 2
+        print(f"\n=== {name}: {fn.__doc__} ===")
+        fn()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,171 @@
+"""
+concurrency.py
+
+Параллельная обработка апдейтов с сохранением порядка внутри одного пользователя.
+
+PTB по умолчанию обрабатывает апдейты строго по одному: медленный вызов в хендлере одного
+пользователя задерживает всех. PerUserUpdateProcessor выполняет апдейты разных пользователей
+параллельно (до UI_BOT_UPDATE_WORKERS одновременно), а апдейты одного user_id — по очереди,
+в порядке поступления: двойной клик не перемешивает чтение и запись nav_stack.
+
+Апдейты, для которых supersede(update) истинно (навигация), схлопываются: если пока такой
+апдейт ждал своей очереди, от того же пользователя пришёл более новый такой же, старый не
+выполняется (вместо него вызывается on_superseded) — рендерится только последняя навигация.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Сколько апдейтов выполняется одновременно (для разных пользователей)
+UPDATE_WORKERS = max(1, int(os.getenv("UI_BOT_UPDATE_WORKERS", "32") or 32))
+# Сколько апдейтов может ждать в процессоре (в т.ч. в очереди своего пользователя);
+# сверх этого PTB придерживает новые апдейты
+UPDATE_MAX_PENDING = max(UPDATE_WORKERS, int(os.getenv("UI_BOT_UPDATE_MAX_PENDING", "1024") or 1024))
+
+_LATENCY_WINDOW = 1024
+
+
+def update_key(update: object) -> Optional[Hashable]:
+    """Ключ сериализации: user_id (или chat_id); None — апдейт без пользователя, без очереди."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return ("chat", update.effective_chat.id)
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Апдейты одного ключа — последовательно (FIFO), разных ключей — параллельно.
+
+    Семафор PTB (max_concurrent_updates) ограничивает число апдейтов внутри процессора,
+    а рабочий слот берётся только после того, как подошла очередь пользователя, — ожидающие
+    апдейты одного пользователя не занимают слоты остальных.
+    """
+
+    def __init__(
+        self,
+        workers: int = UPDATE_WORKERS,
+        max_pending: int = UPDATE_MAX_PENDING,
+        *,
+        supersede: Optional[Callable[[object], bool]] = None,
+        on_superseded: Optional[Callable[[object], Awaitable[Any]]] = None,
+    ) -> None:
+        super().__init__(max(workers, max_pending))
+        self.workers = max(1, workers)
+        self.supersede = supersede
+        self.on_superseded = on_superseded
+        # key -> номер последнего пришедшего схлопываемого апдейта
+        self._seq = 0
+        self._latest: Dict[Hashable, int] = {}
+        self._worker_slots = asyncio.Semaphore(self.workers)
+        # key -> (lock, число апдейтов ключа в процессоре); запись удаляется, когда очередь пуста
+        self._locks: Dict[Hashable, Tuple[asyncio.Lock, int]] = {}
+        self._waits_ms: Deque[float] = deque(maxlen=_LATENCY_WINDOW)
+        self._stats: Dict[str, int] = {
+            "processed": 0,
+            "errors": 0,
+            "pending": 0,
+            "running": 0,
+            "max_pending": 0,
+            "max_key_depth": 0,
+            "superseded": 0,
+        }
+        self._update_queue: Optional["asyncio.Queue[object]"] = None
+
+    def attach_queue(self, update_queue: "asyncio.Queue[object]") -> None:
+        """Очередь Application.update_queue — её глубина попадает в stats() как "queued"."""
+        self._update_queue = update_queue
+
+    async def initialize(self) -> None:
+        """Ничего не выделяет: очереди пользователей создаются по требованию."""
+
+    async def shutdown(self) -> None:
+        """Ничего не освобождает: незавершённые апдейты дожидается Application."""
+
+    def _enter(self, key: Hashable) -> asyncio.Lock:
+        lock, depth = self._locks.get(key) or (asyncio.Lock(), 0)
+        self._locks[key] = (lock, depth + 1)
+        self._stats["max_key_depth"] = max(self._stats["max_key_depth"], depth + 1)
+        return lock
+
+    def _leave(self, key: Hashable) -> None:
+        lock, depth = self._locks[key]
+        if depth <= 1:
+            del self._locks[key]
+            self._latest.pop(key, None)
+        else:
+            self._locks[key] = (lock, depth - 1)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = update_key(update)
+        queued = time.perf_counter()
+        self._stats["pending"] += 1
+        self._stats["max_pending"] = max(self._stats["max_pending"], self._stats["pending"])
+        try:
+            if key is None:
+                await self._run(coroutine, queued)
+                return
+            seq: Optional[int] = None
+            if self.supersede is not None and self.supersede(update):
+                self._seq += 1
+                seq = self._latest[key] = self._seq
+            lock = self._enter(key)
+            superseded = False
+            try:
+                async with lock:
+                    superseded = seq is not None and self._latest.get(key) != seq
+                    if not superseded:
+                        await self._run(coroutine, queued)
+            finally:
+                self._leave(key)
+        finally:
+            self._stats["pending"] -= 1
+
+        if superseded:
+            self._stats["superseded"] += 1
+            close = getattr(coroutine, "close", None)
+            if close is not None:
+                close()
+            if self.on_superseded is not None:
+                await self.on_superseded(update)
+
+    async def _run(self, coroutine: Awaitable[Any], queued: float) -> None:
+        async with self._worker_slots:
+            self._waits_ms.append((time.perf_counter() - queued) * 1000)
+            self._stats["running"] += 1
+            try:
+                await coroutine
+            except Exception:
+                # Ошибки хендлеров логирует Application (error handlers); здесь — только счётчик
+                self._stats["errors"] += 1
+                raise
+            finally:
+                self._stats["running"] -= 1
+                self._stats["processed"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {**self._stats, "workers": self.workers, "keys": len(self._locks)}
+        # Ждут своей очереди пользователя или свободного рабочего слота
+        stats["waiting"] = stats["pending"] - stats["running"]
+        if self._update_queue is not None:
+            stats["queued"] = self._update_queue.qsize()
+        waits = sorted(self._waits_ms)
+        if waits:
+            stats["wait_ms"] = {
+                "avg": round(sum(waits) / len(waits), 3),
+                "p50": round(waits[len(waits) // 2], 3),
+                "p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3),
+                "max": round(waits[-1], 3),
+            }
+        return stats
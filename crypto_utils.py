@@ -1,11 +1,31 @@
 # crypto_utils.py
+import asyncio
+import hashlib
 import os
-from cryptography.fernet import Fernet
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
 import logging
-from typing import Optional
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional
 
 logger = logging.getLogger(__name__)
 
+# Пул для async-обёрток: Fernet не выполняется на event loop
+CRYPTO_WORKERS = max(1, int(os.getenv("UI_BOT_CRYPTO_WORKERS", "2") or 2))
+_LATENCY_WINDOW = 1024
+
+# Реестр шифров: ключи из окружения разбираются один раз, MultiFernet переиспользуется.
+# Шифруем основным ключом, расшифровываем любым из списка (основной + старые).
+# Смена ключей на лету — только явно, через reload_cipher().
+_CIPHER_LOCK = threading.Lock()
+_CIPHER: Optional[MultiFernet] = None
+_PRIMARY: Optional[Fernet] = None
+_PRIMARY_ID: Optional[str] = None
+# Результат is_encryption_configured(): считается один раз, сбрасывается reload_cipher()
+_CONFIGURED: Optional[bool] = None
+
 def get_encryption_key() -> str:
     """Получает ключ шифрования из переменных окружения."""
     # NOTE: Не вызываем load_dotenv() здесь, чтобы модуль не имел скрытых side-effects.
@@ -16,13 +36,84 @@ def get_encryption_key() -> str:
         raise ValueError("ENCRYPTION_KEY is required")
     return key
 
+def get_encryption_keys() -> List[str]:
+    """
+    Ключи в порядке приоритета: первый — основной (им шифруем), остальные — старые.
+
+    ENCRYPTION_KEYS="new,old1,old2" задаёт список целиком; иначе ENCRYPTION_KEY
+    + необязательный ENCRYPTION_KEYS_OLD="old1,old2".
+    """
+    keys = _env_keys()
+    if not keys:
+        get_encryption_key()  # логирует и бросает ValueError
+    return keys
+
+def _env_keys() -> List[str]:
+    # Как get_encryption_keys(), но без лога и исключения: пустой список — ключей нет
+    listed = [k.strip() for k in (os.getenv("ENCRYPTION_KEYS") or "").split(",") if k.strip()]
+    if listed:
+        return listed
+    key = (os.getenv("ENCRYPTION_KEY") or "").strip()
+    if not key:
+        return []
+    return [key] + [k.strip() for k in (os.getenv("ENCRYPTION_KEYS_OLD") or "").split(",") if k.strip()]
+
+def _load_cipher() -> MultiFernet:
+    global _CIPHER, _PRIMARY, _PRIMARY_ID
+    with _CIPHER_LOCK:
+        if _CIPHER is None:
+            keys = get_encryption_keys()
+            fernets = [Fernet(k.encode()) for k in keys]
+            _PRIMARY = fernets[0]
+            _PRIMARY_ID = hashlib.sha256(keys[0].encode()).hexdigest()[:12]
+            _CIPHER = MultiFernet(fernets)
+        return _CIPHER
+
+def get_cipher() -> MultiFernet:
+    """Шифр по ключам из окружения (создаётся при первом вызове; отсутствие ключа не кэшируется)."""
+    cipher = _CIPHER
+    if cipher is None:
+        cipher = _load_cipher()
+    return cipher
+
+def reload_cipher() -> None:
+    """Перечитывает ключи из окружения (например, после ротации ключа)."""
+    global _CIPHER, _CONFIGURED
+    with _CIPHER_LOCK:
+        _CIPHER = None
+        _CONFIGURED = None
+    get_cipher()
+
+def primary_key_id() -> str:
+    """Короткий отпечаток основного ключа (sha256) — для чекпоинтов перешифрования."""
+    get_cipher()
+    return _PRIMARY_ID  # type: ignore[return-value]
+
+def is_encryption_configured() -> bool:
+    """
+    Ключи заданы и валидны (ENCRYPTION_KEYS или ENCRYPTION_KEY [+ ENCRYPTION_KEYS_OLD]).
+
+    Для /health: без логов, результат кэшируется до reload_cipher().
+    """
+    global _CONFIGURED
+    if _CONFIGURED is None:
+        if _CIPHER is not None:
+            _CONFIGURED = True
+        else:
+            keys = _env_keys()
+            try:
+                _CONFIGURED = bool(keys) and all(Fernet(k.encode()) for k in keys)
+            except Exception:
+                _CONFIGURED = False
+    return _CONFIGURED
+
+def has_old_keys() -> bool:
+    return len(_env_keys()) > 1
+
 def encrypt_data(data: str) -> Optional[str]:
     """Шифрует строку используя ключ из переменных окружения."""
     try:
-        key = get_encryption_key()
-        f = Fernet(key.encode())
-        encrypted = f.encrypt(data.encode()).decode()
-        return encrypted
+        return get_cipher().encrypt(data.encode()).decode()
     except Exception as e:
         logger.error(f"❌ Ошибка шифрования: {e}")
         return None
@@ -30,14 +121,155 @@ def encrypt_data(data: str) -> Optional[str]:
 def decrypt_data(encrypted_data: str) -> Optional[str]:
     """Расшифровывает строку используя ключ из переменных окружения."""
     try:
-        key = get_encryption_key()
-        f = Fernet(key.encode())
-        decrypted = f.decrypt(encrypted_data.encode()).decode()
-        return decrypted
+        return get_cipher().decrypt(encrypted_data.encode()).decode()
     except Exception as e:
         logger.error(f"❌ Ошибка расшифрования: {e}")
         return None
 
+def encrypt_many(values: Iterable[str]) -> List[Optional[str]]:
+    """Шифрует пачку строк одним шифром. Ошибка в элементе — None на его месте."""
+    try:
+        cipher = get_cipher()
+    except Exception as e:
+        logger.error(f"❌ Ошибка шифрования: {e}")
+        return [None for _ in values]
+    result: List[Optional[str]] = []
+    for value in values:
+        try:
+            result.append(cipher.encrypt(value.encode()).decode())
+        except Exception as e:
+            logger.error(f"❌ Ошибка шифрования: {e}")
+            result.append(None)
+    return result
+
+def decrypt_many(values: Iterable[str]) -> List[Optional[str]]:
+    """Расшифровывает пачку строк одним шифром. Ошибка в элементе — None на его месте."""
+    try:
+        cipher = get_cipher()
+    except Exception as e:
+        logger.error(f"❌ Ошибка расшифрования: {e}")
+        return [None for _ in values]
+    result: List[Optional[str]] = []
+    for value in values:
+        try:
+            result.append(cipher.decrypt(value.encode()).decode())
+        except Exception as e:
+            logger.error(f"❌ Ошибка расшифрования: {e}")
+            result.append(None)
+    return result
+
+def rotate_many(tokens: Iterable[Optional[str]]) -> List[Optional[str]]:
+    """
+    Перешифровывает пачку ciphertext'ов основным ключом.
+
+    Элемент уже на основном ключе (или пустой) возвращается как есть; не расшифровываемый
+    ни одним ключом — None (строку трогать нельзя).
+    """
+    cipher = get_cipher()
+    primary = _PRIMARY
+    result: List[Optional[str]] = []
+    for token in tokens:
+        if not token:
+            result.append(token)
+            continue
+        raw = token.encode()
+        try:
+            primary.decrypt(raw)  # type: ignore[union-attr]
+            result.append(token)
+            continue
+        except InvalidToken:
+            pass
+        try:
+            result.append(cipher.rotate(raw).decode())
+        except InvalidToken:
+            result.append(None)
+    return result
+
+
+# --- async-обёртки: шифрование в пуле потоков ---
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_EXECUTOR_LOCK = threading.Lock()
+
+class _CryptoStats:
+    """Счётчики и окна задержек по операциям: wait — ожидание потока пула, work — сам Fernet."""
+
+    def __init__(self) -> None:
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._windows: Dict[str, Dict[str, Deque[float]]] = {}
+
+    def record(self, op: str, wait_ms: float, work_ms: float, ok: bool) -> None:
+        counters = self._counters.setdefault(op, {"calls": 0, "errors": 0})
+        counters["calls"] += 1
+        if not ok:
+            counters["errors"] += 1
+        windows = self._windows.setdefault(
+            op, {"wait_ms": deque(maxlen=_LATENCY_WINDOW), "work_ms": deque(maxlen=_LATENCY_WINDOW)}
+        )
+        windows["wait_ms"].append(wait_ms)
+        windows["work_ms"].append(work_ms)
+
+    def snapshot(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {}
+        for op, counters in self._counters.items():
+            entry: Dict[str, Any] = dict(counters)
+            for name, window in self._windows[op].items():
+                values = sorted(window)
+                if values:
+                    entry[name] = {
+                        "avg": round(sum(values) / len(values), 3),
+                        "p50": round(values[len(values) // 2], 3),
+                        "p95": round(values[min(len(values) - 1, int(len(values) * 0.95))], 3),
+                        "max": round(values[-1], 3),
+                    }
+            result[op] = entry
+        return result
+
+_STATS = _CryptoStats()
+
+def _pool() -> ThreadPoolExecutor:
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        with _EXECUTOR_LOCK:
+            if _EXECUTOR is None:
+                _EXECUTOR = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix="ui-crypto")
+    return _EXECUTOR
+
+async def _run(op: str, fn: Callable[[str], Optional[str]], value: str) -> Optional[str]:
+    submitted = time.perf_counter()
+    timing: Dict[str, float] = {}
+
+    def _job() -> Optional[str]:
+        timing["started"] = time.perf_counter()
+        try:
+            return fn(value)
+        finally:
+            timing["finished"] = time.perf_counter()
+
+    result = await asyncio.wrap_future(_pool().submit(_job))
+    started = timing.get("started", submitted)
+    _STATS.record(op, (started - submitted) * 1000, (timing.get("finished", started) - started) * 1000, result is not None)
+    return result
+
+async def encrypt_async(data: str) -> Optional[str]:
+    """encrypt_data в пуле UI_BOT_CRYPTO_WORKERS потоков."""
+    return await _run("encrypt", encrypt_data, data)
+
+async def decrypt_async(encrypted_data: str) -> Optional[str]:
+    """decrypt_data в пуле UI_BOT_CRYPTO_WORKERS потоков."""
+    return await _run("decrypt", decrypt_data, encrypted_data)
+
+async def encrypt_many_async(values: Iterable[str]) -> List[Optional[str]]:
+    """Шифрует независимые значения параллельно (например, login и password)."""
+    return list(await asyncio.gather(*(encrypt_async(v) for v in values)))
+
+async def decrypt_many_async(values: Iterable[str]) -> List[Optional[str]]:
+    """Расшифровывает независимые значения параллельно."""
+    return list(await asyncio.gather(*(decrypt_async(v) for v in values)))
+
+def get_crypto_stats() -> Dict[str, Any]:
+    """Метрики async-обёрток по операциям: calls/errors и wait_ms/work_ms (avg/p50/p95/max)."""
+    return {"workers": CRYPTO_WORKERS, **_STATS.snapshot()}
+
 
 # --- Совместимость с ТЗ: SSID encryption helpers ---
 def encrypt_ssid(ssid: str) -> Optional[str]:
@@ -0,0 +1,82 @@
+"""
+health.py
+
+Фоновый монитор зависимостей UI-бота.
+
+Каждая проверка (Supabase, запись в SQLite, Telegram get_me) выполняется раз в
+UI_BOT_HEALTH_INTERVAL секунд с таймаутом UI_BOT_HEALTH_TIMEOUT; результаты кэшируются,
+так что /health отдаёт готовый словарь без обращений к внешним сервисам.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import datetime as _dt
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+HEALTH_INTERVAL = float(os.getenv("UI_BOT_HEALTH_INTERVAL", "30"))
+HEALTH_TIMEOUT = float(os.getenv("UI_BOT_HEALTH_TIMEOUT", "5"))
+
+Probe = Callable[[], Awaitable[Any]]
+
+
+class HealthMonitor:
+    """Реестр проверок + кэш их последних результатов."""
+
+    def __init__(self, *, interval: float = HEALTH_INTERVAL, timeout: float = HEALTH_TIMEOUT) -> None:
+        self.interval = interval
+        self.timeout = timeout
+        self._probes: Dict[str, Optional[Probe]] = {}
+        # Словарь целиком заменяется после каждого прохода — чтение всегда согласованно и O(1)
+        self._results: Dict[str, Dict[str, Any]] = {}
+
+    def add_probe(self, name: str, probe: Optional[Probe]) -> None:
+        """probe=None — зависимость не настроена (проверка не выполняется)."""
+        self._probes[name] = probe
+        self._results = {**self._results, name: {"status": "not_configured" if probe is None else "unknown"}}
+
+    async def _check(self, name: str, probe: Optional[Probe]) -> Dict[str, Any]:
+        if probe is None:
+            return {"status": "not_configured"}
+        started = time.perf_counter()
+        result: Dict[str, Any]
+        try:
+            await asyncio.wait_for(probe(), timeout=self.timeout)
+            result = {"status": "ok"}
+        except asyncio.TimeoutError:
+            result = {"status": "error", "error": f"timeout after {self.timeout:g}s"}
+        except Exception as e:
+            result = {"status": "error", "error": repr(e)[:200]}
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        result["checked_at"] = _dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+        if result["status"] == "error":
+            logger.warning(f"⚠️ Health check {name} failed: {result['error']}")
+        return result
+
+    async def check_all(self) -> Dict[str, Dict[str, Any]]:
+        """Запускает все проверки параллельно и обновляет кэш."""
+        names = list(self._probes)
+        checked = await asyncio.gather(*[self._check(name, self._probes[name]) for name in names])
+        self._results = dict(zip(names, checked))
+        return self._results
+
+    def results(self) -> Dict[str, Dict[str, Any]]:
+        """Последние результаты (без проверок)."""
+        return self._results
+
+    def healthy(self) -> bool:
+        return all(r["status"] != "error" for r in self._results.values())
+
+    async def run(self) -> None:
+        logger.info("✅ Health monitor started")
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"❌ Health monitor error: {e}")
+            await asyncio.sleep(self.interval)
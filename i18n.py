@@ -0,0 +1,153 @@
+"""
+i18n.py
+
+Скомпилированный каталог переводов UI-бота.
+
+TRANSLATIONS (lang -> {key: template}) компилируется один раз при старте:
+- каждый ключ получает целочисленный id;
+- каждый язык — плоский кортеж шаблонов по id (пропуски заполнены языком по умолчанию);
+- шаблоны без плейсхолдеров помечены и возвращаются без str.format.
+
+Дополнительные языки подхватываются из каталога UI_BOT_LOCALES_DIR (файлы <lang>.json)
+лениво — при первом обращении к языку.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import string
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_FORMATTER = string.Formatter()
+
+
+def _needs_format(template: str) -> bool:
+    try:
+        return any(field is not None for _, field, _, _ in _FORMATTER.parse(template)) or "{{" in template or "}}" in template
+    except ValueError:
+        # Битый шаблон (одиночная скобка): format всё равно упадёт — отдаём как есть
+        return False
+
+
+class TranslationCatalog:
+    """Каталог переводов: key -> id, язык -> кортеж шаблонов и флагов форматирования."""
+
+    def __init__(
+        self,
+        translations: Dict[str, Dict[str, str]],
+        default_lang: str = "ru",
+        locales_dir: Optional[str] = None,
+    ) -> None:
+        if default_lang not in translations:
+            raise ValueError(f"Default language '{default_lang}' is missing in translations")
+        self.default_lang = default_lang
+
+        keys: List[str] = list(translations[default_lang])
+        for table in translations.values():
+            keys.extend(k for k in table if k not in keys)
+        self._key_ids: Dict[str, int] = {key: i for i, key in enumerate(keys)}
+        self._keys: Tuple[str, ...] = tuple(keys)
+
+        self._templates: Dict[str, Tuple[str, ...]] = {}
+        self._formatted: Dict[str, Tuple[bool, ...]] = {}
+        self._compile(default_lang, translations[default_lang])
+        for lang, table in translations.items():
+            if lang != default_lang:
+                self._compile(lang, table)
+
+        self._lazy_lock = threading.Lock()
+        self._lazy_paths: Dict[str, str] = {}
+        if locales_dir:
+            self._discover(locales_dir)
+
+    # --- compile/load ---
+    def _compile(self, lang: str, table: Dict[str, str]) -> None:
+        default = self._templates.get(self.default_lang)
+        templates = []
+        for i, key in enumerate(self._keys):
+            template = table.get(key) or (default[i] if default else "") or key
+            templates.append(template)
+        self._templates[lang] = tuple(templates)
+        self._formatted[lang] = tuple(_needs_format(t) for t in templates)
+
+    def _discover(self, locales_dir: str) -> None:
+        try:
+            names = os.listdir(locales_dir)
+        except OSError as e:
+            logger.warning(f"⚠️ Locales dir {locales_dir} is not readable: {e}")
+            return
+        for name in names:
+            lang, ext = os.path.splitext(name)
+            if ext == ".json" and lang and lang not in self._templates:
+                self._lazy_paths[lang] = os.path.join(locales_dir, name)
+
+    def _load_lazy(self, lang: str) -> bool:
+        with self._lazy_lock:
+            if lang in self._templates:
+                return True
+            path = self._lazy_paths.pop(lang, None)
+            if path is None:
+                return False
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    table = json.load(f)
+            except Exception as e:
+                logger.error(f"❌ Could not load locale {lang} from {path}: {e}")
+                return False
+            self.add_language(lang, table)
+            return True
+
+    def add_language(self, lang: str, table: Dict[str, str]) -> None:
+        """Добавляет/заменяет язык. Неизвестные каталогу ключи игнорируются."""
+        unknown = [k for k in table if k not in self._key_ids]
+        if unknown:
+            logger.warning(f"⚠️ Locale {lang}: ignoring {len(unknown)} unknown keys (e.g. {unknown[0]!r})")
+        self._compile(lang, {k: v for k, v in table.items() if isinstance(v, str)})
+
+    # --- lookup ---
+    def languages(self) -> List[str]:
+        """Доступные языки (включая ещё не загруженные), язык по умолчанию — первым."""
+        langs = [self.default_lang] + sorted(l for l in self._templates if l != self.default_lang)
+        return langs + sorted(l for l in self._lazy_paths if l not in self._templates)
+
+    def has_language(self, lang: str) -> bool:
+        return lang in self._templates or lang in self._lazy_paths
+
+    def key_id(self, key: str) -> int:
+        return self._key_ids[key]
+
+    def _table(self, lang: str) -> str:
+        if lang in self._templates or (lang in self._lazy_paths and self._load_lazy(lang)):
+            return lang
+        return self.default_lang
+
+    def tr(self, lang: str, key: str, **kwargs: Any) -> str:
+        key_id = self._key_ids.get(key)
+        if key_id is None:
+            return key
+        templates = self._templates.get(lang)
+        if templates is None:
+            lang = self._table(lang)
+            templates = self._templates[lang]
+        if not self._formatted[lang][key_id]:
+            return templates[key_id]
+        try:
+            return templates[key_id].format(**kwargs)
+        except Exception:
+            return templates[key_id]
+
+    def tr_id(self, lang: str, key_id: int, **kwargs: Any) -> str:
+        if lang not in self._templates:
+            lang = self._table(lang)
+        template = self._templates[lang][key_id]
+        if not self._formatted[lang][key_id]:
+            return template
+        try:
+            return template.format(**kwargs)
+        except Exception:
+            return template
@@ -12,13 +12,21 @@
 from __future__ import annotations
 
 import asyncio
+import base64
+import datetime
+import functools
+import hmac
+import json
 import logging
 import os
-from typing import Any, Dict, Optional
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, Optional
 
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from telegram import (
     BotCommand,
@@ -35,20 +43,35 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-
-from crypto_utils import encrypt_ssid
+from telegram.error import BadRequest
+
+from concurrency import PerUserUpdateProcessor
+from crypto_utils import encrypt_many_async, get_crypto_stats, has_old_keys, is_encryption_configured, primary_key_id, rotate_many
+from health import HealthMonitor
+from i18n import TranslationCatalog
+from maintenance import StateSweeper
+from outbound import PRIORITY_BROADCAST, OutboundScheduler
 from payments import check_crypto_payment_status, create_crypto_payment
+from signals import SignalClient, SignalOutbox, SignalResultDispatcher, SignalTicket
 from supabase import Client, create_client
+from ui_router import CallbackRouter
 from user_db_handler import (
+    CHANGES_START,
+    UserSession,
+    check_write_latency,
     ensure_user,
+    get_credential_changes,
     get_encrypted_data_from_local_db,
-    get_user_profile,
-    get_user_state,
+    get_encrypted_data_many,
+    get_job_checkpoint,
+    get_signal_outbox_stats,
     init_db,
+    iter_encrypted_data_many,
+    reencrypt_credentials,
     reset_user_data,
     save_encrypted_credentials,
-    set_user_state,
     update_user_profile,
+    user_session,
 )
 
 
@@ -167,6 +190,7 @@ TRANSLATIONS: Dict[str, Dict[str, str]] = {
         "signal_requires_plan_short": "🔒 Short-сигналы доступны на тарифе Short/VIP.",
         "signal_requires_po": "❌ Сначала настройте PO через /set_po.",
         "signal_sent": "⏳ Запрос на сигнал отправлен. Ожидайте ответ от ядра.",
+        "signal_pending": "⏳ Запрос уже отправлен — ожидайте ответ от ядра.",
         "signal_supabase_off": "⚠️ Supabase не настроен. Запрос сигналов временно недоступен.",
         "plan_free": "Free",
         "plan_pro": "Pro",
@@ -262,6 +286,7 @@ TRANSLATIONS: Dict[str, Dict[str, str]] = {
         "signal_requires_plan_short": "🔒 Short signals require Short/VIP.",
         "signal_requires_po": "❌ Configure PO first via /set_po.",
         "signal_sent": "⏳ Signal request sent. Please wait.",
+        "signal_pending": "⏳ Your request is already pending. Please wait.",
         "signal_supabase_off": "⚠️ Supabase not configured. Signals are unavailable.",
         "plan_free": "Free",
         "plan_pro": "Pro",
@@ -303,101 +328,289 @@ TRANSLATIONS: Dict[str, Dict[str, str]] = {
 }
 
 
+# Компилируется один раз; доп. языки — лениво из UI_BOT_LOCALES_DIR/<lang>.json
+CATALOG = TranslationCatalog(TRANSLATIONS, default_lang="ru", locales_dir=os.getenv("UI_BOT_LOCALES_DIR"))
+
+
 def tr(lang: str, key: str, **kwargs: Any) -> str:
-    table = TRANSLATIONS.get(lang) or TRANSLATIONS["ru"]
-    template = table.get(key) or TRANSLATIONS["ru"].get(key) or key
-    try:
-        return template.format(**kwargs)
-    except Exception:
-        return template
+    return CATALOG.tr(lang, key, **kwargs)
 
 
 # --- UI helpers ---
-async def _ensure_not_banned(user_id: int) -> bool:
-    profile = await get_user_profile(user_id)
-    if profile.get("is_banned") and not _is_root_admin(user_id):
+def _ensure_not_banned(session: UserSession) -> bool:
+    if session.profile.get("is_banned") and not _is_root_admin(session.user_id):
         return False
     return True
 
 
+# --- UI message mode / Bot API accounting ---
+# replace — удалить предыдущее UI-сообщение и отправить новое (2 вызова Bot API);
+# edit    — отредактировать предыдущее UI-сообщение на месте (1 вызов), delete+send — только при ошибке.
+UI_MESSAGE_MODE = (os.getenv("UI_MESSAGE_MODE") or "replace").strip().lower()
+if UI_MESSAGE_MODE not in ("replace", "edit"):
+    logger.warning(f"⚠️ Unknown UI_MESSAGE_MODE={UI_MESSAGE_MODE!r}, using 'replace'")
+    UI_MESSAGE_MODE = "replace"
+
+# Последний отрисованный UI по чату: (message_id, text, keyboard) — если поменялась только
+# клавиатура, достаточно edit_message_reply_markup
+_LAST_RENDERED: "OrderedDict[int, tuple[int, str, Optional[InlineKeyboardMarkup]]]" = OrderedDict()
+_LAST_RENDERED_MAX = 10000
+
+# Актуальное UI-сообщение по чату (в памяти, в обоих режимах): клики по более старым
+# сообщениям отбрасываются в callback_router без загрузки сессии из БД
+_LAST_UI_MESSAGE: "OrderedDict[int, int]" = OrderedDict()
+
+# Все исходящие send/edit/delete — через планировщик с лимитами Telegram (outbound.py)
+OUTBOUND = OutboundScheduler()
+
+_INTERACTION_CALLS: ContextVar[Optional[Counter]] = ContextVar("ui_interaction_calls", default=None)
+
+
+class _UiApiStats:
+    """Счётчики вызовов Bot API: всего, по методам и на одно взаимодействие (апдейт)."""
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.interactions = 0
+        self.interaction_calls = 0
+        self.max_per_interaction = 0
+        self.by_method: Counter = Counter()
+        self.edits = 0
+        self.edit_fallbacks = 0
+        self.stale_callbacks = 0
+
+    def record(self, method: str) -> None:
+        self.by_method[method] += 1
+        calls = _INTERACTION_CALLS.get()
+        if calls is not None:
+            calls[method] += 1
+
+    def finish(self, calls: Counter) -> None:
+        total = sum(calls.values())
+        self.interactions += 1
+        self.interaction_calls += total
+        self.max_per_interaction = max(self.max_per_interaction, total)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "mode": UI_MESSAGE_MODE,
+            "interactions": self.interactions,
+            "api_calls": sum(self.by_method.values()),
+            "calls_per_interaction": round(self.interaction_calls / self.interactions, 3) if self.interactions else 0.0,
+            "max_per_interaction": self.max_per_interaction,
+            "by_method": dict(self.by_method),
+            "edits": self.edits,
+            "edit_fallbacks": self.edit_fallbacks,
+            "stale_callbacks": self.stale_callbacks,
+        }
+
+
+_UI_API_STATS = _UiApiStats()
+
+
+def get_ui_api_stats() -> Dict[str, Any]:
+    return _UI_API_STATS.snapshot()
+
+
+def _track_interaction(handler):
+    """Оборачивает Telegram-хендлер: считает вызовы Bot API, сделанные за один апдейт."""
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        calls: Counter = Counter()
+        token = _INTERACTION_CALLS.set(calls)
+        try:
+            await handler(update, context)
+        finally:
+            _INTERACTION_CALLS.reset(token)
+            _UI_API_STATS.finish(calls)
+            logger.debug(f"UI interaction {handler.__name__}: {sum(calls.values())} Bot API calls {dict(calls)}")
+
+    return wrapper
+
+
+def _remember_ui_message(chat_id: int, message_id: int) -> None:
+    _LAST_UI_MESSAGE[chat_id] = message_id
+    _LAST_UI_MESSAGE.move_to_end(chat_id)
+    while len(_LAST_UI_MESSAGE) > _LAST_RENDERED_MAX:
+        _LAST_UI_MESSAGE.popitem(last=False)
+
+
+def _is_stale_ui_click(chat_id: int, message_id: int, last_ui_message_id: Optional[int] = None) -> bool:
+    """Клик по сообщению старше текущего UI-сообщения (все клавиатуры бота — только в UI-сообщениях)."""
+    if last_ui_message_id is None:
+        last_ui_message_id = _LAST_UI_MESSAGE.get(chat_id)
+    return last_ui_message_id is not None and message_id < int(last_ui_message_id)
+
+
+def _remember_rendered(chat_id: int, message_id: int, text: str, keyboard: Optional[InlineKeyboardMarkup]) -> None:
+    _LAST_RENDERED[chat_id] = (message_id, text, keyboard)
+    _LAST_RENDERED.move_to_end(chat_id)
+    while len(_LAST_RENDERED) > _LAST_RENDERED_MAX:
+        _LAST_RENDERED.popitem(last=False)
+
+
 async def _delete_message_safe(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int) -> None:
     try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+        # Склеенные планировщиком удаления в Bot API не уходят — не считаем их
+        await OUTBOUND.delete_message(
+            context.bot, chat_id, message_id, on_submit=lambda: _UI_API_STATS.record("delete_message")
+        )
     except Exception:
         pass
 
 
+async def _edit_ui_message(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    message_id: int,
+    text: str,
+    keyboard: Optional[InlineKeyboardMarkup],
+) -> bool:
+    """Правит UI-сообщение на месте. False — сообщение нельзя править (удалено, слишком старое и т.п.)."""
+    # Полностью совпавший экран всё равно правим: ответ Telegram подтверждает, что сообщение ещё существует
+    last = _LAST_RENDERED.get(chat_id)
+    markup_only = last is not None and last[0] == message_id and last[1] == text and last[2] != keyboard
+    try:
+        if markup_only:
+            _UI_API_STATS.record("edit_message_reply_markup")
+            await OUTBOUND.call(context.bot, "edit_message_reply_markup", chat_id=chat_id, message_id=message_id, reply_markup=keyboard)
+        else:
+            _UI_API_STATS.record("edit_message_text")
+            await OUTBOUND.call(
+                context.bot,
+                "edit_message_text",
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                parse_mode="HTML",
+                reply_markup=keyboard,
+                disable_web_page_preview=True,
+            )
+    except BadRequest as e:
+        # Содержимое совпало с текущим — правка не нужна, сообщение живое
+        if "not modified" not in str(e).lower():
+            logger.debug(f"Edit of UI message {message_id} in chat {chat_id} failed: {e}")
+            return False
+    except Exception as e:
+        logger.debug(f"Edit of UI message {message_id} in chat {chat_id} failed: {e}")
+        return False
+
+    _UI_API_STATS.edits += 1
+    _remember_rendered(chat_id, message_id, text, keyboard)
+    return True
+
+
+def _is_current_ui_message(session: UserSession, chat_id: int, message_id: int) -> bool:
+    return (
+        session.profile.get("last_ui_chat_id") == chat_id
+        and session.profile.get("last_ui_message_id") == message_id
+    )
+
+
 async def send_ui(
     *,
     context: ContextTypes.DEFAULT_TYPE,
-    user_id: int,
+    session: UserSession,
     chat_id: int,
     text: str,
     keyboard: Optional[InlineKeyboardMarkup] = None,
 ) -> None:
-    """Удаляет предыдущее UI-сообщение и отправляет новое."""
-    profile = await get_user_profile(user_id)
-    last_chat_id = profile.get("last_ui_chat_id")
-    last_message_id = profile.get("last_ui_message_id")
+    """Показывает UI-сообщение: правит предыдущее (UI_MESSAGE_MODE=edit) или удаляет его и шлёт новое."""
+    last_chat_id = session.profile.get("last_ui_chat_id")
+    last_message_id = session.profile.get("last_ui_message_id")
 
     if last_chat_id and last_message_id:
+        if UI_MESSAGE_MODE == "edit" and int(last_chat_id) == chat_id:
+            if await _edit_ui_message(context, chat_id, int(last_message_id), text, keyboard):
+                return
+            _UI_API_STATS.edit_fallbacks += 1
         await _delete_message_safe(context, int(last_chat_id), int(last_message_id))
 
-    msg = await context.bot.send_message(
+    _UI_API_STATS.record("send_message")
+    msg = await OUTBOUND.call(
+        context.bot,
+        "send_message",
         chat_id=chat_id,
         text=text,
         parse_mode="HTML",
         reply_markup=keyboard,
         disable_web_page_preview=True,
     )
-    await update_user_profile(user_id, last_ui_chat_id=chat_id, last_ui_message_id=msg.message_id)
+    session.update_profile(last_ui_chat_id=chat_id, last_ui_message_id=msg.message_id)
+    _remember_ui_message(chat_id, msg.message_id)
+    if UI_MESSAGE_MODE == "edit":
+        _remember_rendered(chat_id, msg.message_id, text, keyboard)
+
+
+async def _send_signal_result(bot: Any, user_id: int, text: str) -> Any:
+    # Результат — отдельное сообщение, не UI: следующий экран его не удаляет
+    return await OUTBOUND.call(
+        bot,
+        "send_message",
+        chat_id=user_id,
+        text=text,
+        parse_mode="HTML",
+        disable_web_page_preview=True,
+        priority=PRIORITY_BROADCAST,
+    )
+
 
+def _reencrypt_job_name() -> str:
+    # Своя задача на каждый основной ключ: после следующей ротации проход начнётся заново
+    return f"reencrypt:{primary_key_id()}"
 
-async def _nav_stack(user_id: int) -> list[str]:
-    stack = await get_user_state(user_id, "nav_stack", default=[])
-    return stack if isinstance(stack, list) else []
+
+async def _reencrypt_credentials_job() -> None:
+    """Фоном перешифровывает user_credentials основным ключом (продолжает с чекпоинта)."""
+    job = _reencrypt_job_name()
+    logger.info("🔑 Re-encrypting credentials with the primary key (job %s)", job)
+    try:
+        result = await reencrypt_credentials(rotate_many, job)
+    except Exception as e:
+        logger.error(f"❌ Credentials re-encryption failed (will resume on restart): {e}")
+        return
+    logger.info("✅ Credentials re-encryption finished: %s", result)
+
+
+def _nav_stack(session: UserSession) -> list[str]:
+    stack = session.get_state("nav_stack", default=[])
+    return list(stack) if isinstance(stack, list) else []
 
 
-async def _current_screen(user_id: int) -> str:
-    cur = await get_user_state(user_id, "current_screen", default="home")
+def _current_screen(session: UserSession) -> str:
+    cur = session.get_state("current_screen", default="home")
     return cur if isinstance(cur, str) else "home"
 
 
 async def show_screen(
     *,
     context: ContextTypes.DEFAULT_TYPE,
-    user_id: int,
+    session: UserSession,
     chat_id: int,
     screen: str,
     push_current: bool = True,
     clear_stack: bool = False,
 ) -> None:
-    await ensure_user(user_id)
-
-    if not await _ensure_not_banned(user_id):
-        profile = await get_user_profile(user_id)
-        await send_ui(
-            context=context,
-            user_id=user_id,
-            chat_id=chat_id,
-            text=tr(profile.get("language", "ru"), "banned"),
-            keyboard=None,
-        )
+    if not _ensure_not_banned(session):
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(session.lang, "banned"), keyboard=None)
         return
 
     if clear_stack:
-        await set_user_state(user_id, "nav_stack", [])
+        session.set_state("nav_stack", [])
 
-    cur = await _current_screen(user_id)
+    cur = _current_screen(session)
     if push_current and screen != cur:
-        stack = await _nav_stack(user_id)
+        stack = _nav_stack(session)
         stack.append(cur)
-        await set_user_state(user_id, "nav_stack", stack[-20:])
+        session.set_state("nav_stack", stack[-20:])
 
-    await set_user_state(user_id, "current_screen", screen)
+    session.set_state("current_screen", screen)
 
-    text, kb = await render_screen(user_id=user_id, screen=screen)
-    await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=text, keyboard=kb)
+    text, kb = render_screen(session=session, screen=screen)
+    await send_ui(context=context, session=session, chat_id=chat_id, text=text, keyboard=kb)
 
 
 def _nav_kb(lang: str, show_back: bool, show_home: bool) -> list[list[InlineKeyboardButton]]:
@@ -409,27 +622,65 @@ def _nav_kb(lang: str, show_back: bool, show_home: bool) -> list[list[InlineKeyb
     return [row] if row else []
 
 
-async def render_screen(*, user_id: int, screen: str) -> tuple[str, InlineKeyboardMarkup]:
-    profile = await get_user_profile(user_id)
+# Кэш отрисованных экранов: (screen, lang, show_back, show_home, plan) -> (текст, клавиатура, динамический?)
+# Клавиатуры PTB неизменяемы, поэтому один объект безопасно отдавать всем пользователям.
+# У динамических экранов в тексте вместо полей профиля — маркеры _slot(); перевод уже отформатирован,
+# поэтому поля подставляются str.replace, а не повторным .format() (фигурные скобки в тексте не трогаем).
+# При переполнении вытесняются самые давно использованные ключи (LRU), а не весь кэш сразу.
+_RENDER_CACHE: "OrderedDict[tuple[str, str, bool, bool, str], tuple[str, InlineKeyboardMarkup, bool]]" = OrderedDict()
+_RENDER_CACHE_MAX = 2048
+_DYNAMIC_SCREENS = frozenset({"home", "settings"})
+
+
+def _slot(field: str) -> str:
+    return f"\x00{field}\x00"
+
+
+def render_screen(*, session: UserSession, screen: str) -> tuple[str, InlineKeyboardMarkup]:
+    profile = session.profile
     lang = profile.get("language", "ru")
     plan = profile.get("plan", "free")
 
-    stack = await _nav_stack(user_id)
-    show_back = len(stack) > 0 and screen != "home"
+    show_back = screen != "home" and len(_nav_stack(session)) > 0
     show_home = screen != "home"
 
-    if screen == "home":
-        creds = await get_encrypted_data_from_local_db(user_id)
-        po_status = tr(lang, "po_set") if creds else tr(lang, "po_not_set")
+    key = (screen, lang, show_back, show_home, plan)
+    cached = _RENDER_CACHE.get(key)
+    if cached is None:
+        text, kb = _build_screen(lang=lang, plan=plan, screen=screen, show_back=show_back, show_home=show_home)
+        cached = (text, kb, screen in _DYNAMIC_SCREENS)
+        while len(_RENDER_CACHE) >= _RENDER_CACHE_MAX:
+            _RENDER_CACHE.popitem(last=False)
+        _RENDER_CACHE[key] = cached
+    else:
+        _RENDER_CACHE.move_to_end(key)
+
+    text, kb, dynamic = cached
+    if dynamic:
+        fields = {
+            "user_id": session.user_id,
+            "language": lang,
+            "currency": profile.get("currency", "USD"),
+            "po_status": tr(lang, "po_set") if session.has_credentials else tr(lang, "po_not_set"),
+        }
+        for field, value in fields.items():
+            text = text.replace(_slot(field), str(value))
+    return text, kb
 
+
+def _build_screen(
+    *, lang: str, plan: str, screen: str, show_back: bool, show_home: bool
+) -> tuple[str, InlineKeyboardMarkup]:
+    """Статическая часть экрана; поля профиля остаются маркерами _slot() (см. render_screen)."""
+    if screen == "home":
         text = f"<b>{tr(lang, 'home_title')}</b>\n\n" + tr(
             lang,
             "home_profile",
-            user_id=user_id,
-            language=profile.get("language", "ru"),
-            currency=profile.get("currency", "USD"),
+            user_id=_slot("user_id"),
+            language=_slot("language"),
+            currency=_slot("currency"),
             plan=plan,
-            po_status=po_status,
+            po_status=_slot("po_status"),
         )
 
         kb = InlineKeyboardMarkup(
@@ -505,13 +756,10 @@ async def render_screen(*, user_id: int, screen: str) -> tuple[str, InlineKeyboa
 
     if screen == "settings":
         text = f"<b>{tr(lang, 'settings_title')}</b>\n\n" + tr(
-            lang, "settings_body", language=profile.get("language", "ru"), currency=profile.get("currency", "USD")
+            lang, "settings_body", language=_slot("language"), currency=_slot("currency")
         )
         kb_rows = [
-            [
-                InlineKeyboardButton("RU", callback_data="set:lang:ru"),
-                InlineKeyboardButton("EN", callback_data="set:lang:en"),
-            ],
+            [InlineKeyboardButton(code.upper(), callback_data=f"set:lang:{code}") for code in CATALOG.languages()],
             [
                 InlineKeyboardButton("USD", callback_data="set:currency:USD"),
                 InlineKeyboardButton("EUR", callback_data="set:currency:EUR"),
@@ -528,14 +776,59 @@ async def render_screen(*, user_id: int, screen: str) -> tuple[str, InlineKeyboa
 
 
 # --- Supabase integration (external) ---
-async def create_signal_request(user_id: int, request_type: str = "latest_signal") -> bool:
-    if not supabase:
-        return False
+# Синхронный supabase-py — в пуле SignalClient, event loop не блокируется
+SIGNALS = SignalClient(supabase)
+# Запросы сначала коммитятся в локальный signal_outbox, в Supabase уходят пачками (run() в main)
+SIGNAL_OUTBOX = SignalOutbox(SIGNALS)
+# Ответы ядра (POST /signals/results) → signal_deliveries → рассылка (run() в main)
+SIGNAL_RESULTS = SignalResultDispatcher(dedup=SIGNAL_OUTBOX.dedup)
+
+# Общий секрет ядра для POST /signals/results (пусто — приём результатов выключен)
+RESULTS_TOKEN = (os.getenv("UI_BOT_RESULTS_TOKEN") or "").strip()
+RESULTS_MAX_BATCH = 1000
+
+# Приём апдейтов: polling (по умолчанию) или webhook — POST WEBHOOK_PATH на том же uvicorn, что и api_app
+UPDATE_MODE = (os.getenv("UI_BOT_UPDATE_MODE") or "polling").strip().lower()
+WEBHOOK_URL = (os.getenv("UI_BOT_WEBHOOK_URL") or "").strip().rstrip("/")
+WEBHOOK_PATH = "/" + (os.getenv("UI_BOT_WEBHOOK_PATH") or "telegram/webhook").strip().strip("/")
+WEBHOOK_SECRET = (os.getenv("UI_BOT_WEBHOOK_SECRET") or "").strip()
+# Application, в очередь которого кладутся апдейты; выставляется в run_telegram_bot после start()
+_WEBHOOK_APPLICATION: Optional[Application] = None
+_WEBHOOK_STATS: Counter = Counter()
+
+
+def _is_nav_callback(update: object) -> bool:
+    # Переход на экран (не back — каждый back снимает свой уровень стека)
+    query = update.callback_query if isinstance(update, Update) else None
+    data = query.data if query is not None else None
+    return bool(data) and data.startswith("nav:") and data != "nav:back"
+
+
+async def _answer_superseded(update: object) -> None:
+    # Навигацию перекрыла более новая — только гасим «часики» на кнопке (через OUTBOUND, как остальные вызовы)
+    query = update.callback_query
+    chat_id = query.message.chat_id if query.message else query.from_user.id
+    _UI_API_STATS.record("answer_callback_query")
+    try:
+        await OUTBOUND.answer_callback_query(query.get_bot(), chat_id, query.id)
+    except Exception:
+        pass
+
+
+# Фоновая уборка: истёкшие user_states и (опционально) архивация неактивных пользователей
+SWEEPER = StateSweeper()
+
+# Апдейты разных пользователей — параллельно, одного пользователя — по очереди;
+# из нескольких ожидающих переходов одного пользователя рендерится только последний
+UPDATE_PROCESSOR = PerUserUpdateProcessor(supersede=_is_nav_callback, on_superseded=_answer_superseded)
+
+
+async def create_signal_request(user_id: int, request_type: str = "latest_signal") -> Optional[SignalTicket]:
+    """None — Supabase не настроен; ticket.duplicate — присоединились к запросу в окне cooldown."""
     # Внешние данные (не профиль пользователя)
-    supabase.table("signal_requests").insert(
-        {"user_id": user_id, "request_type": request_type, "status": "pending"}
-    ).execute()
-    return True
+    if not SIGNAL_OUTBOX.enabled:
+        return None
+    return await SIGNAL_OUTBOX.submit(user_id, request_type)
 
 
 # --- FastAPI (core <-> UI bot) ---
@@ -551,37 +844,107 @@ class CoreRequest(BaseModel):
     request_source: str
 
 
+class SignalResult(BaseModel):
+    result_id: str
+    user_id: int
+    text: str
+    request_type: Optional[str] = None
+    idempotency_key: Optional[str] = None
+
+
+class SignalResultsBatch(BaseModel):
+    results: list[SignalResult]
+
+
 @api_app.get("/")
 async def root() -> Dict[str, Any]:
     return {
         "status": "ok",
         "service": "UI Bot API",
         "version": "1.1.0",
-        "endpoints": {"health": "/health", "credentials": "/get_po_credentials"},
+        "endpoints": {
+            "health": "/health",
+            "health_deep": "/health/deep",
+            "credentials": "/get_po_credentials",
+            "credentials_batch": "/get_po_credentials/batch",
+            "credentials_changes": "/credentials/changes",
+            "signal_results": "/signals/results",
+            "telegram_webhook": WEBHOOK_PATH if UPDATE_MODE == "webhook" else None,
+        },
     }
 
 
-@api_app.get("/health")
-async def health_check() -> Dict[str, Any]:
-    supabase_status = "not_configured"
-    if supabase:
-        try:
-            supabase.table("signal_requests").select("id").limit(1).execute()
-            supabase_status = "connected"
-        except Exception as e:
-            logger.error(f"Supabase health check failed: {e}")
-            supabase_status = "disconnected"
+# Проверки зависимостей — фоном (HEALTH.run() в main), /health читает только кэш
+HEALTH = HealthMonitor()
+HEALTH.add_probe(
+    "supabase",
+    (lambda: SIGNALS.run(lambda: supabase.table("signal_requests").select("id").limit(1).execute())) if supabase else None,
+)
+HEALTH.add_probe("sqlite_write", check_write_latency)
+# "telegram" (get_me) регистрируется в run_telegram_bot() после application.initialize()
+HEALTH.add_probe("telegram", None)
+
+_SUPABASE_STATUS = {"ok": "connected", "error": "disconnected", "not_configured": "not_configured"}
+
 
+def _health_payload(checks: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
     return {
-        "status": "healthy",
+        "status": "healthy" if all(c["status"] != "error" for c in checks.values()) else "degraded",
         "telegram_bot": "configured" if BOT_TOKEN else "not_configured",
         "telegram_token_env": BOT_TOKEN_ENV or "not_set",
-        "supabase": supabase_status,
-        "encryption": "enabled" if os.getenv("ENCRYPTION_KEY") else "not_configured",
+        "supabase": _SUPABASE_STATUS.get(checks.get("supabase", {}).get("status", ""), "unknown"),
+        "encryption": "enabled" if is_encryption_configured() else "not_configured",
         "sqlite_db": "enabled",
+        "checks": checks,
     }
 
 
+@api_app.get("/health")
+async def health_check() -> Dict[str, Any]:
+    # O(1): только кэш фонового монитора, без сетевых вызовов
+    return _health_payload(HEALTH.results())
+
+
+@api_app.get("/health/deep")
+async def health_check_deep() -> Dict[str, Any]:
+    """Проверки по запросу (обновляют кэш) + метрики компонентов."""
+    payload = _health_payload(await HEALTH.check_all())
+    # Чтения SQLite — в потоке: при занятом писателе не держим event loop
+    outbox_rows = await asyncio.to_thread(get_signal_outbox_stats)
+    reencryption = await asyncio.to_thread(get_job_checkpoint, _reencrypt_job_name()) if has_old_keys() else None
+    payload.update(
+        {
+            "ui_api": get_ui_api_stats(),
+            "outbound": OUTBOUND.stats(),
+            "signals": SIGNALS.stats(),
+            "signal_outbox": {**SIGNAL_OUTBOX.stats(), "rows": outbox_rows},
+            "signal_results": SIGNAL_RESULTS.stats(),
+            "crypto": get_crypto_stats(),
+            "updates": UPDATE_PROCESSOR.stats(),
+            "maintenance": SWEEPER.stats(),
+            "webhook": dict(_WEBHOOK_STATS) if UPDATE_MODE == "webhook" else None,
+            "reencryption": reencryption,
+        }
+    )
+    return payload
+
+
+CREDENTIAL_SOURCES = frozenset({"trading_core", "render_core", "admin"})
+# Пачки больше порога (или Accept: application/x-ndjson) отдаются потоком NDJSON
+CREDENTIALS_BATCH_MAX = int(os.getenv("UI_BOT_CREDENTIALS_BATCH_MAX") or "10000")
+CREDENTIALS_NDJSON_THRESHOLD = 500
+
+
+class CoreBatchRequest(BaseModel):
+    user_ids: list[int]
+    request_source: str
+
+
+def _check_request_source(request_source: str) -> None:
+    if request_source not in CREDENTIAL_SOURCES:
+        raise HTTPException(status_code=403, detail="Unknown request source")
+
+
 @api_app.post("/get_po_credentials")
 async def get_po_credentials_endpoint(request_data: CoreRequest) -> Dict[str, Any]:
     user_id = request_data.user_id
@@ -589,8 +952,7 @@ async def get_po_credentials_endpoint(request_data: CoreRequest) -> Dict[str, An
 
     logger.info(f"📥 Credential request for user {user_id} from {request_source}")
 
-    if request_source not in ["trading_core", "render_core", "admin"]:
-        raise HTTPException(status_code=403, detail="Unknown request source")
+    _check_request_source(request_source)
 
     encrypted_creds = await get_encrypted_data_from_local_db(user_id)
     if not encrypted_creds:
@@ -604,141 +966,272 @@ async def get_po_credentials_endpoint(request_data: CoreRequest) -> Dict[str, An
     }
 
 
+@api_app.post("/get_po_credentials/batch")
+async def get_po_credentials_batch_endpoint(
+    request_data: CoreBatchRequest,
+    accept: Optional[str] = Header(default=None),
+) -> Any:
+    """Ciphertext'ы для списка user_id одним WHERE user_id IN (...) (порциями по лимиту SQLite)."""
+    _check_request_source(request_data.request_source)
+    user_ids = request_data.user_ids
+    if len(user_ids) > CREDENTIALS_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {CREDENTIALS_BATCH_MAX} user_ids per request")
+
+    logger.info(f"📥 Batch credential request for {len(user_ids)} users from {request_data.request_source}")
+
+    if len(user_ids) <= CREDENTIALS_NDJSON_THRESHOLD and "application/x-ndjson" not in (accept or ""):
+        found = await get_encrypted_data_many(user_ids)
+        return {
+            "status": "success",
+            "credentials": [{"user_id": uid, **creds} for uid, creds in found.items()],
+            "missing": [uid for uid in dict.fromkeys(user_ids) if uid not in found],
+        }
+
+    async def _ndjson() -> AsyncIterator[bytes]:
+        # Строка на пользователя, последней — итог с ненайденными user_id
+        seen = set()
+        async for rows in iter_encrypted_data_many(user_ids):
+            lines = []
+            for row in rows:
+                seen.add(row["user_id"])
+                lines.append(json.dumps(row, separators=(",", ":")))
+            if lines:
+                yield ("\n".join(lines) + "\n").encode()
+        missing = [uid for uid in dict.fromkeys(user_ids) if uid not in seen]
+        yield (json.dumps({"status": "done", "found": len(seen), "missing": missing}, separators=(",", ":")) + "\n").encode()
+
+    return StreamingResponse(_ndjson(), media_type="application/x-ndjson")
+
+
+# Лента изменений кредов: только строки старше горизонта (успели закоммититься), страницы по 500
+CHANGES_HORIZON_SECONDS = 2
+CHANGES_PAGE_SIZE = 500
+CHANGES_MAX_LIMIT = 10000
+
+
+def _encode_cursor(cursor: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(cursor), separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(token: str) -> tuple:
+    try:
+        ts, user_id, kind = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return str(ts), int(user_id), str(kind)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _changes_ts(value: datetime.datetime) -> str:
+    # Формат updated_at в SQLite: 2024-01-01T00:00:00Z
+    return value.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+@api_app.get("/credentials/changes")
+async def credentials_changes_endpoint(
+    request_source: str,
+    since: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 1000,
+) -> StreamingResponse:
+    """
+    NDJSON-лента изменений user_credentials для зеркала ядра.
+
+    Старт — since (ISO-время, включительно) или cursor из прошлого ответа; строки:
+    {"kind": "upsert", ...ciphertext} / {"kind": "delete", ...}; последняя —
+    {"next_cursor": ..., "has_more": ...}.
+    """
+    _check_request_source(request_source)
+    limit = max(1, min(limit, CHANGES_MAX_LIMIT))
+    if cursor:
+        after = _decode_cursor(cursor)
+    elif since:
+        try:
+            since_dt = datetime.datetime.fromisoformat(since.replace("Z", "+00:00"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid since (expected ISO 8601)")
+        if since_dt.tzinfo is None:
+            since_dt = since_dt.replace(tzinfo=datetime.timezone.utc)
+        after = (_changes_ts(since_dt), CHANGES_START[1], CHANGES_START[2])
+    else:
+        after = CHANGES_START
+    until = _changes_ts(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=CHANGES_HORIZON_SECONDS))
+
+    async def _ndjson() -> AsyncIterator[bytes]:
+        nonlocal after
+        sent = 0
+        has_more = True
+        while sent < limit:
+            page_size = min(CHANGES_PAGE_SIZE, limit - sent)
+            changes = await get_credential_changes(after, until, page_size)
+            if changes:
+                last = changes[-1]
+                after = (last["ts"], last["user_id"], last["kind"])
+                sent += len(changes)
+                yield ("\n".join(json.dumps(c, separators=(",", ":")) for c in changes) + "\n").encode()
+            if len(changes) < page_size:
+                has_more = False
+                break
+        tail = {"next_cursor": _encode_cursor(after), "has_more": has_more, "until": until}
+        yield (json.dumps(tail, separators=(",", ":")) + "\n").encode()
+
+    return StreamingResponse(_ndjson(), media_type="application/x-ndjson")
+
+
+@api_app.post("/signals/results", status_code=202)
+async def signal_results_endpoint(
+    batch: SignalResultsBatch,
+    x_results_token: Optional[str] = Header(default=None),
+) -> Dict[str, Any]:
+    """Пачка готовых сигналов от ядра: сохраняется и доставляется пользователям фоном."""
+    if not RESULTS_TOKEN:
+        raise HTTPException(status_code=503, detail="Signal results ingest is not configured")
+    if not x_results_token or not hmac.compare_digest(x_results_token, RESULTS_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid results token")
+    if len(batch.results) > RESULTS_MAX_BATCH:
+        raise HTTPException(status_code=413, detail=f"At most {RESULTS_MAX_BATCH} results per request")
+
+    accepted = await SIGNAL_RESULTS.ingest([r.model_dump() if hasattr(r, "model_dump") else r.dict() for r in batch.results])
+    logger.info(f"📥 Signal results: {accepted} accepted, {len(batch.results) - accepted} duplicates")
+    return {"status": "accepted", "accepted": accepted, "duplicates": len(batch.results) - accepted}
+
+
+@api_app.post(WEBHOOK_PATH)
+async def telegram_webhook_endpoint(
+    request: Request,
+    x_telegram_bot_api_secret_token: Optional[str] = Header(default=None),
+) -> Dict[str, Any]:
+    """Апдейт от Telegram (webhook mode): проверка secret_token и постановка в очередь Application."""
+    application = _WEBHOOK_APPLICATION
+    if application is None:
+        _WEBHOOK_STATS["not_ready"] += 1
+        raise HTTPException(status_code=503, detail="Webhook mode is not active")
+    if not x_telegram_bot_api_secret_token or not hmac.compare_digest(x_telegram_bot_api_secret_token, WEBHOOK_SECRET):
+        _WEBHOOK_STATS["rejected"] += 1
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except Exception as e:
+        _WEBHOOK_STATS["invalid"] += 1
+        logger.warning(f"⚠️ Invalid webhook payload: {e}")
+        raise HTTPException(status_code=400, detail="Invalid update payload")
+    if update is None:
+        _WEBHOOK_STATS["invalid"] += 1
+        raise HTTPException(status_code=400, detail="Invalid update payload")
+    # Обработка — в Application (как при polling); Telegram получает 200 сразу
+    await application.update_queue.put(update)
+    _WEBHOOK_STATS["received"] += 1
+    return {"ok": True}
+
+
 # --- Telegram commands ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    await ensure_user(user_id)
-    if _is_root_admin(user_id):
-        await update_user_profile(user_id, is_admin=1)
-
     chat_id = update.effective_chat.id
 
     # Удаляем команду /start для "чистого" UI
     if update.message:
         await _delete_message_safe(context, chat_id, update.message.message_id)
 
-    await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="home", push_current=False, clear_stack=True)
+    async with user_session(user_id) as session:
+        if _is_root_admin(user_id):
+            session.update_profile(is_admin=1)
+        await show_screen(context=context, session=session, chat_id=chat_id, screen="home", push_current=False, clear_stack=True)
 
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def _screen_command(update: Update, context: ContextTypes.DEFAULT_TYPE, screen: str, push_current: bool = True) -> None:
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     if update.message:
         await _delete_message_safe(context, chat_id, update.message.message_id)
-    await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="help")
+    async with user_session(user_id) as session:
+        await show_screen(context=context, session=session, chat_id=chat_id, screen=screen, push_current=push_current)
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _screen_command(update, context, "help")
 
 
 async def bank_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    if update.message:
-        await _delete_message_safe(context, chat_id, update.message.message_id)
-    await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="bank")
+    await _screen_command(update, context, "bank")
 
 
 async def my_longs_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    if update.message:
-        await _delete_message_safe(context, chat_id, update.message.message_id)
-    await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="my_longs")
+    await _screen_command(update, context, "my_longs")
 
 
 async def my_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    if update.message:
-        await _delete_message_safe(context, chat_id, update.message.message_id)
     # ТЗ: главная статистика — на домашнем экране
-    await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="home", push_current=False)
+    await _screen_command(update, context, "home", push_current=False)
 
 
-async def long_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def _signal_command(update: Update, context: ContextTypes.DEFAULT_TYPE, request_type: str) -> None:
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
     if update.message:
         await _delete_message_safe(context, chat_id, update.message.message_id)
-    await _handle_signal(user_id=user_id, chat_id=chat_id, context=context, request_type="long")
+    async with user_session(user_id) as session:
+        await _handle_signal(session=session, chat_id=chat_id, context=context, request_type=request_type)
+
+
+async def long_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _signal_command(update, context, "long")
 
 
 async def short_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    if update.message:
-        await _delete_message_safe(context, chat_id, update.message.message_id)
-    await _handle_signal(user_id=user_id, chat_id=chat_id, context=context, request_type="short")
+    await _signal_command(update, context, "short")
 
 
 async def autotrade_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    if update.message:
-        await _delete_message_safe(context, chat_id, update.message.message_id)
-    await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="autotrade")
+    await _screen_command(update, context, "autotrade")
 
 
 async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    if update.message:
-        await _delete_message_safe(context, chat_id, update.message.message_id)
-    await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="menu")
+    await _screen_command(update, context, "menu")
 
 
 async def plans_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    if update.message:
-        await _delete_message_safe(context, chat_id, update.message.message_id)
-    await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="plans")
+    await _screen_command(update, context, "plans")
 
 
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    if update.message:
-        await _delete_message_safe(context, chat_id, update.message.message_id)
-    await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="settings")
+    await _screen_command(update, context, "settings")
 
 
 async def set_po_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    profile = await get_user_profile(user_id)
-    lang = profile.get("language", "ru")
 
     if update.message:
         await _delete_message_safe(context, chat_id, update.message.message_id)
 
-    if not context.args or len(context.args) != 2:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "set_po_usage"))
-        return
+    async with user_session(user_id) as session:
+        lang = session.lang
 
-    login, password = context.args[0], context.args[1]
-    if len(login) < 3 or len(login) > 100 or len(password) < 6 or len(password) > 100:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "set_po_invalid"))
-        return
+        if not context.args or len(context.args) != 2:
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "set_po_usage"))
+            return
 
-    login_enc = encrypt_ssid(login)
-    password_enc = encrypt_ssid(password)
-    if not login_enc or not password_enc:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "encryption_error"))
-        return
+        login, password = context.args[0], context.args[1]
+        if len(login) < 3 or len(login) > 100 or len(password) < 6 or len(password) > 100:
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "set_po_invalid"))
+            return
 
-    try:
-        await save_encrypted_credentials(user_id, login_enc, password_enc)
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "set_po_saved"))
-    except Exception as e:
-        logger.error(f"DB error saving credentials for user {user_id}: {e}")
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "db_error"))
+        login_enc, password_enc = await encrypt_many_async([login, password])
+        if not login_enc or not password_enc:
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "encryption_error"))
+            return
+
+        try:
+            await save_encrypted_credentials(user_id, login_enc, password_enc)
+            session.has_credentials = True
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "set_po_saved"))
+        except Exception as e:
+            logger.error(f"DB error saving credentials for user {user_id}: {e}")
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "db_error"))
 
 
 async def request_signal_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    if update.message:
-        await _delete_message_safe(context, chat_id, update.message.message_id)
-    await _handle_signal(user_id=user_id, chat_id=chat_id, context=context, request_type="latest_signal")
+    await _signal_command(update, context, "latest_signal")
 
 
 # --- Callback handler ---
@@ -750,240 +1243,286 @@ async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = query.from_user.id
     chat_id = query.message.chat_id if query.message else user_id
 
+    _UI_API_STATS.record("answer_callback_query")
     try:
-        await query.answer()
+        await OUTBOUND.answer_callback_query(context.bot, chat_id, query.id)
     except Exception:
         pass
 
     data = query.data or ""
 
-    # Удаляем сообщение, по которому кликнули (доп. чистота UI)
-    if query.message:
-        await _delete_message_safe(context, chat_id, query.message.message_id)
-
-    if data == "nav:home":
-        await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="home", push_current=False, clear_stack=True)
+    # Клик по устаревшему UI (уже перерисованному) — отбрасываем без обращения к БД
+    if query.message and _is_stale_ui_click(chat_id, query.message.message_id):
+        _UI_API_STATS.stale_callbacks += 1
         return
 
-    if data == "nav:back":
-        stack = await _nav_stack(user_id)
-        if stack:
-            prev = stack.pop()
-            await set_user_state(user_id, "nav_stack", stack)
-            await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen=prev, push_current=False)
-        else:
-            await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="home", push_current=False, clear_stack=True)
-        return
+    async with user_session(user_id) as session:
+        # После рестарта памяти нет — тот же отсев по уже загруженному профилю
+        last_ui_message_id = session.profile.get("last_ui_message_id")
+        if last_ui_message_id and int(session.profile.get("last_ui_chat_id") or 0) == chat_id:
+            _remember_ui_message(chat_id, int(last_ui_message_id))
+            if query.message and _is_stale_ui_click(chat_id, query.message.message_id, last_ui_message_id):
+                _UI_API_STATS.stale_callbacks += 1
+                return
+        # Удаляем сообщение, по которому кликнули (доп. чистота UI).
+        # В режиме edit текущее UI-сообщение не трогаем — его перерисует send_ui.
+        if query.message and not (
+            UI_MESSAGE_MODE == "edit" and _is_current_ui_message(session, chat_id, query.message.message_id)
+        ):
+            await _delete_message_safe(context, chat_id, query.message.message_id)
+        await _dispatch_callback(context=context, session=session, chat_id=chat_id, data=data)
 
-    if data.startswith("nav:"):
-        screen = data.split(":", 1)[1]
-        if screen in {"menu", "plans", "settings", "home", "help", "bank", "my_longs", "my_stats", "autotrade"}:
-            await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen=screen)
-        return
 
-    if data == "action:signal":
-        await _handle_signal(user_id=user_id, chat_id=chat_id, context=context, request_type="latest_signal")
-        return
+callbacks = CallbackRouter()
 
-    if data.startswith("set:lang:"):
-        lang = data.split(":", 2)[2]
-        if lang in TRANSLATIONS:
-            await update_user_profile(user_id, language=lang)
-        await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="settings", push_current=False)
-        return
+# Экраны, на которые можно перейти по "nav:<screen>"
+NAV_SCREENS = frozenset({"menu", "plans", "settings", "home", "help", "bank", "my_longs", "my_stats", "autotrade"})
+CURRENCIES = frozenset({"USD", "EUR", "RUB"})
 
-    if data.startswith("set:currency:"):
-        currency = data.split(":", 2)[2]
-        if currency in {"USD", "EUR", "RUB"}:
-            await update_user_profile(user_id, currency=currency)
-        await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="settings", push_current=False)
-        return
 
-    if data.startswith("admin:"):
-        profile = await get_user_profile(user_id)
-        lang = profile.get("language", "ru")
+async def _dispatch_callback(
+    *, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int, data: str
+) -> None:
+    await callbacks.dispatch(data, context=context, session=session, chat_id=chat_id)
 
-        if not _is_root_admin(user_id):
-            await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_denied"))
-            return
 
-        if data.startswith("admin:give:"):
-            plan = data.split(":", 2)[2].strip().lower()
-            if plan in {"long", "short", "vip"}:
-                await update_user_profile(user_id, plan=plan, is_admin=1, is_banned=0)
-                await set_user_state(user_id, "admin_flow", None)
-                await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_done"))
-                await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="home", push_current=False, clear_stack=True)
-            return
+@callbacks.route("nav:home")
+async def cb_nav_home(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int) -> None:
+    await show_screen(context=context, session=session, chat_id=chat_id, screen="home", push_current=False, clear_stack=True)
 
-        if data.startswith("admin:flow:"):
-            action = data.split(":", 2)[2].strip()
-            await set_user_state(user_id, "admin_flow", {"action": action})
-            prompt_key = {
-                "ban": "admin_prompt_ban",
-                "unban": "admin_prompt_unban",
-                "reset": "admin_prompt_reset",
-                "set_plan": "admin_prompt_set_plan",
-            }.get(action, "admin_bad_input")
-            await send_ui(
-                context=context,
-                user_id=user_id,
-                chat_id=chat_id,
-                text=tr(lang, prompt_key),
-                keyboard=InlineKeyboardMarkup(_nav_kb(lang, show_back=False, show_home=True)),
-            )
-            return
 
-    if data.startswith("plan:select:"):
-        plan = data.split(":", 2)[2]
-        profile = await get_user_profile(user_id)
-        lang = profile.get("language", "ru")
+@callbacks.route("nav:back")
+async def cb_nav_back(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int) -> None:
+    stack = _nav_stack(session)
+    if stack:
+        prev = stack.pop()
+        session.set_state("nav_stack", stack)
+        await show_screen(context=context, session=session, chat_id=chat_id, screen=prev, push_current=False)
+    else:
+        await show_screen(context=context, session=session, chat_id=chat_id, screen="home", push_current=False, clear_stack=True)
 
-        if plan == "free":
-            await update_user_profile(user_id, plan="free")
-            await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="plans", push_current=False)
-            return
 
-        plan = str(plan).lower()
-        if plan not in {"long", "short", "vip"}:
-            await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="plans", push_current=False)
-            return
+@callbacks.route("nav:{screen}")
+async def cb_nav(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int, screen: str) -> None:
+    if screen in NAV_SCREENS:
+        await show_screen(context=context, session=session, chat_id=chat_id, screen=screen)
 
-        amount = 10.0 if plan in {"long", "short"} else 25.0
-        payment = create_crypto_payment(user_id=user_id, plan=plan, amount=amount, currency="USDT")
-        await set_user_state(
-            user_id,
-            "pending_payment",
-            {"payment_id": payment.payment_id, "plan": plan, "amount": amount, "currency": payment.currency},
-        )
 
-        kb = InlineKeyboardMarkup(
-            [
-                [InlineKeyboardButton("✅ I paid / Проверить", callback_data=f"plan:check:{payment.payment_id}")],
-                *(_nav_kb(lang, show_back=True, show_home=True)),
-            ]
-        )
-        await send_ui(
-            context=context,
-            user_id=user_id,
-            chat_id=chat_id,
-            text=tr(
-                lang,
-                "pay_created",
-                plan=plan.upper(),
-                amount=amount,
-                currency=payment.currency,
-                payment_id=payment.payment_id,
-                pay_url=payment.pay_url,
-            ),
-            keyboard=kb,
-        )
+@callbacks.route("action:signal")
+async def cb_signal(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int) -> None:
+    await _handle_signal(session=session, chat_id=chat_id, context=context, request_type="latest_signal")
+
+
+@callbacks.route("set:lang:{lang}")
+async def cb_set_lang(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int, lang: str) -> None:
+    if CATALOG.has_language(lang):
+        session.update_profile(language=lang)
+    await show_screen(context=context, session=session, chat_id=chat_id, screen="settings", push_current=False)
+
+
+@callbacks.route("set:currency:{currency}")
+async def cb_set_currency(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int, currency: str) -> None:
+    if currency in CURRENCIES:
+        session.update_profile(currency=currency)
+    await show_screen(context=context, session=session, chat_id=chat_id, screen="settings", push_current=False)
+
+
+async def _deny_non_admin(context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int) -> bool:
+    if _is_root_admin(session.user_id):
+        return False
+    await send_ui(context=context, session=session, chat_id=chat_id, text=tr(session.lang, "admin_denied"))
+    return True
+
+
+@callbacks.route("admin:give:{plan}")
+async def cb_admin_give(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int, plan: str) -> None:
+    if await _deny_non_admin(context, session, chat_id):
         return
+    plan = plan.strip().lower()
+    if plan in {"long", "short", "vip"}:
+        session.update_profile(plan=plan, is_admin=1, is_banned=0)
+        session.set_state("admin_flow", None)
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(session.lang, "admin_done"))
+        await show_screen(context=context, session=session, chat_id=chat_id, screen="home", push_current=False, clear_stack=True)
 
-    if data.startswith("plan:check:"):
-        payment_id = data.split(":", 2)[2]
-        pending = await get_user_state(user_id, "pending_payment", default=None)
-        profile = await get_user_profile(user_id)
-        lang = profile.get("language", "ru")
-
-        status = check_crypto_payment_status(payment_id)
-        if status == "paid" and isinstance(pending, dict) and pending.get("payment_id") == payment_id:
-            plan = pending.get("plan", "long")
-            await update_user_profile(user_id, plan=plan)
-            await set_user_state(user_id, "pending_payment", None)
-            await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "pay_check_paid", plan=plan.upper()))
-        else:
-            await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "pay_check_pending"))
+
+@callbacks.route("admin:flow:{action}")
+async def cb_admin_flow(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int, action: str) -> None:
+    if await _deny_non_admin(context, session, chat_id):
         return
+    lang = session.lang
+    action = action.strip()
+    session.set_state("admin_flow", {"action": action})
+    prompt_key = {
+        "ban": "admin_prompt_ban",
+        "unban": "admin_prompt_unban",
+        "reset": "admin_prompt_reset",
+        "set_plan": "admin_prompt_set_plan",
+    }.get(action, "admin_bad_input")
+    await send_ui(
+        context=context,
+        session=session,
+        chat_id=chat_id,
+        text=tr(lang, prompt_key),
+        keyboard=InlineKeyboardMarkup(_nav_kb(lang, show_back=False, show_home=True)),
+    )
+
+
+@callbacks.route("admin:{rest:path}")
+async def cb_admin_other(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int, rest: str) -> None:
+    await _deny_non_admin(context, session, chat_id)
+
+
+@callbacks.route("plan:select:{plan}")
+async def cb_plan_select(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int, plan: str) -> None:
+    lang = session.lang
+
+    if plan == "free":
+        session.update_profile(plan="free")
+        await show_screen(context=context, session=session, chat_id=chat_id, screen="plans", push_current=False)
+        return
+
+    plan = str(plan).lower()
+    if plan not in {"long", "short", "vip"}:
+        await show_screen(context=context, session=session, chat_id=chat_id, screen="plans", push_current=False)
+        return
+
+    amount = 10.0 if plan in {"long", "short"} else 25.0
+    payment = create_crypto_payment(user_id=session.user_id, plan=plan, amount=amount, currency="USDT")
+    session.set_state(
+        "pending_payment",
+        {"payment_id": payment.payment_id, "plan": plan, "amount": amount, "currency": payment.currency},
+    )
+
+    kb = InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton("✅ I paid / Проверить", callback_data=f"plan:check:{payment.payment_id}")],
+            *(_nav_kb(lang, show_back=True, show_home=True)),
+        ]
+    )
+    await send_ui(
+        context=context,
+        session=session,
+        chat_id=chat_id,
+        text=tr(
+            lang,
+            "pay_created",
+            plan=plan.upper(),
+            amount=amount,
+            currency=payment.currency,
+            payment_id=payment.payment_id,
+            pay_url=payment.pay_url,
+        ),
+        keyboard=kb,
+    )
+
+
+@callbacks.route("plan:check:{payment_id}")
+async def cb_plan_check(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int, payment_id: str) -> None:
+    lang = session.lang
+    pending = session.get_state("pending_payment", default=None)
+
+    status = check_crypto_payment_status(payment_id)
+    if status == "paid" and isinstance(pending, dict) and pending.get("payment_id") == payment_id:
+        plan = pending.get("plan", "long")
+        session.update_profile(plan=plan)
+        session.set_state("pending_payment", None)
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "pay_check_paid", plan=plan.upper()))
+    else:
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "pay_check_pending"))
 
 
 async def _handle_signal(
-    *, user_id: int, chat_id: int, context: ContextTypes.DEFAULT_TYPE, request_type: str = "latest_signal"
+    *, session: UserSession, chat_id: int, context: ContextTypes.DEFAULT_TYPE, request_type: str = "latest_signal"
 ) -> None:
-    profile = await get_user_profile(user_id)
-    lang = profile.get("language", "ru")
-    plan = str(profile.get("plan", "free")).lower()
+    user_id = session.user_id
+    lang = session.lang
+    plan = str(session.profile.get("plan", "free")).lower()
 
     # Доступ по тарифам (как в исходнике: short/long/vip)
     if request_type == "long" and plan not in {"long", "vip"}:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "signal_requires_plan_long"))
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "signal_requires_plan_long"))
         return
     if request_type == "short" and plan not in {"short", "vip"}:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "signal_requires_plan_short"))
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "signal_requires_plan_short"))
         return
     if request_type == "latest_signal" and plan not in {"long", "short", "vip"}:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "signal_requires_plan"))
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "signal_requires_plan"))
         return
 
-    creds = await get_encrypted_data_from_local_db(user_id)
-    if not creds:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "signal_requires_po"))
+    if not session.has_credentials:
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "signal_requires_po"))
         return
 
     if not supabase:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "signal_supabase_off"))
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "signal_supabase_off"))
         return
 
     try:
-        await asyncio.to_thread(lambda: None)  # микроyield для гладкости UI
-        ok = await create_signal_request(user_id, request_type=request_type)
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "signal_sent" if ok else "signal_supabase_off"))
+        ticket = await create_signal_request(user_id, request_type=request_type)
+        if ticket is None:
+            key = "signal_supabase_off"
+        else:
+            key = "signal_pending" if ticket.duplicate else "signal_sent"
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, key))
     except Exception as e:
         logger.error(f"Signal request error for user {user_id}: {e}")
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "signal_supabase_off"))
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "signal_supabase_off"))
 
 
 # --- Admin commands (root-only) ---
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    profile = await get_user_profile(user_id)
-    lang = profile.get("language", "ru")
 
-    if not _is_root_admin(user_id):
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_denied"))
-        return
+    async with user_session(user_id) as session:
+        lang = session.lang
 
-    if update.message:
-        await _delete_message_safe(context, chat_id, update.message.message_id)
+        if not _is_root_admin(user_id):
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "admin_denied"))
+            return
 
-    kb = InlineKeyboardMarkup(
-        [
-            [InlineKeyboardButton(tr(lang, "admin_btn_ban"), callback_data="admin:flow:ban")],
-            [InlineKeyboardButton(tr(lang, "admin_btn_unban"), callback_data="admin:flow:unban")],
-            [InlineKeyboardButton(tr(lang, "admin_btn_set_plan"), callback_data="admin:flow:set_plan")],
-            [InlineKeyboardButton(tr(lang, "admin_btn_reset"), callback_data="admin:flow:reset")],
-            [InlineKeyboardButton(tr(lang, "admin_btn_give_me"), callback_data="nav:plans")],
+        if update.message:
+            await _delete_message_safe(context, chat_id, update.message.message_id)
+
+        kb = InlineKeyboardMarkup(
             [
-                InlineKeyboardButton(tr(lang, "plan_long"), callback_data="admin:give:long"),
-                InlineKeyboardButton(tr(lang, "plan_short"), callback_data="admin:give:short"),
-                InlineKeyboardButton(tr(lang, "plan_vip"), callback_data="admin:give:vip"),
-            ],
-        ]
-        + _nav_kb(lang, show_back=False, show_home=True)
-    )
-    await set_user_state(user_id, "admin_flow", None)
-    await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_panel_title"), keyboard=kb)
+                [InlineKeyboardButton(tr(lang, "admin_btn_ban"), callback_data="admin:flow:ban")],
+                [InlineKeyboardButton(tr(lang, "admin_btn_unban"), callback_data="admin:flow:unban")],
+                [InlineKeyboardButton(tr(lang, "admin_btn_set_plan"), callback_data="admin:flow:set_plan")],
+                [InlineKeyboardButton(tr(lang, "admin_btn_reset"), callback_data="admin:flow:reset")],
+                [InlineKeyboardButton(tr(lang, "admin_btn_give_me"), callback_data="nav:plans")],
+                [
+                    InlineKeyboardButton(tr(lang, "plan_long"), callback_data="admin:give:long"),
+                    InlineKeyboardButton(tr(lang, "plan_short"), callback_data="admin:give:short"),
+                    InlineKeyboardButton(tr(lang, "plan_vip"), callback_data="admin:give:vip"),
+                ],
+            ]
+            + _nav_kb(lang, show_back=False, show_home=True)
+        )
+        session.set_state("admin_flow", None)
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "admin_panel_title"), keyboard=kb)
 
 
 async def god_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    profile = await get_user_profile(user_id)
-    lang = profile.get("language", "ru")
 
-    if not _is_root_admin(user_id):
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_denied"))
-        return
+    async with user_session(user_id) as session:
+        lang = session.lang
 
-    if update.message:
-        await _delete_message_safe(context, chat_id, update.message.message_id)
+        if not _is_root_admin(user_id):
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "admin_denied"))
+            return
 
-    # "Экстренное исправление": навсегда VIP + все права
-    await update_user_profile(user_id, plan="vip", is_admin=1, is_banned=0)
-    await set_user_state(user_id, "admin_flow", None)
-    await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "god_done"))
-    await show_screen(context=context, user_id=user_id, chat_id=chat_id, screen="home", push_current=False, clear_stack=True)
+        if update.message:
+            await _delete_message_safe(context, chat_id, update.message.message_id)
+
+        # "Экстренное исправление": навсегда VIP + все права
+        session.update_profile(plan="vip", is_admin=1, is_banned=0)
+        session.set_state("admin_flow", None)
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "god_done"))
+        await show_screen(context=context, session=session, chat_id=chat_id, screen="home", push_current=False, clear_stack=True)
 
 
 async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1001,10 +1540,14 @@ async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     if not _is_root_admin(user_id):
         return
 
-    profile = await get_user_profile(user_id)
-    lang = profile.get("language", "ru")
+    async with user_session(user_id) as session:
+        await _handle_admin_flow(context=context, session=session, chat_id=chat_id, text=text)
 
-    flow = await get_user_state(user_id, "admin_flow", default=None)
+
+async def _handle_admin_flow(*, context: ContextTypes.DEFAULT_TYPE, session: UserSession, chat_id: int, text: str) -> None:
+    lang = session.lang
+
+    flow = session.get_state("admin_flow", default=None)
     if not isinstance(flow, dict) or "action" not in flow:
         return
 
@@ -1019,7 +1562,7 @@ async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     if action in {"ban", "unban", "reset"}:
         target_id = _parse_int(text)
         if not target_id:
-            await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_bad_input"))
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "admin_bad_input"))
             return
 
         if action == "reset":
@@ -1028,24 +1571,24 @@ async def text_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             await ensure_user(target_id)
             await update_user_profile(target_id, is_banned=1 if action == "ban" else 0)
 
-        await set_user_state(user_id, "admin_flow", None)
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_done"))
+        session.set_state("admin_flow", None)
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "admin_done"))
         return
 
     if action == "set_plan":
         parts = text.split()
         if len(parts) != 2:
-            await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_bad_input"))
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "admin_bad_input"))
             return
         target_id = _parse_int(parts[0])
         plan = parts[1].lower()
         if not target_id or plan not in {"free", "long", "short", "vip"}:
-            await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_bad_input"))
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "admin_bad_input"))
             return
         await ensure_user(target_id)
         await update_user_profile(target_id, plan=plan)
-        await set_user_state(user_id, "admin_flow", None)
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_done"))
+        session.set_state("admin_flow", None)
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "admin_done"))
         return
 
 
@@ -1058,119 +1601,76 @@ def _parse_target_id(context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
         return None
 
 
-async def ban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def _admin_target_command(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str) -> None:
+    """Общий каркас /ban_user, /unban_user, /add_admin, /remove_admin, /reset_user."""
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    profile = await get_user_profile(user_id)
-    lang = profile.get("language", "ru")
 
-    if not _is_root_admin(user_id):
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_denied"))
-        return
+    async with user_session(user_id) as session:
+        lang = session.lang
 
-    target_id = _parse_target_id(context)
-    if not target_id:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_bad_args"))
-        return
+        if not _is_root_admin(user_id):
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "admin_denied"))
+            return
 
-    await ensure_user(target_id)
-    await update_user_profile(target_id, is_banned=1)
-    await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_done"))
+        target_id = _parse_target_id(context)
+        if not target_id:
+            await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "admin_bad_args"))
+            return
 
+        if action == "reset":
+            await reset_user_data(target_id)
+        else:
+            fields = {
+                "ban": {"is_banned": 1},
+                "unban": {"is_banned": 0},
+                "add_admin": {"is_admin": 1},
+                "remove_admin": {"is_admin": 0},
+            }[action]
+            await ensure_user(target_id)
+            await update_user_profile(target_id, **fields)
+        await send_ui(context=context, session=session, chat_id=chat_id, text=tr(lang, "admin_done"))
 
-async def unban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    profile = await get_user_profile(user_id)
-    lang = profile.get("language", "ru")
 
-    if not _is_root_admin(user_id):
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_denied"))
-        return
+async def ban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _admin_target_command(update, context, "ban")
 
-    target_id = _parse_target_id(context)
-    if not target_id:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_bad_args"))
-        return
 
-    await ensure_user(target_id)
-    await update_user_profile(target_id, is_banned=0)
-    await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_done"))
+async def unban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _admin_target_command(update, context, "unban")
 
 
 async def add_admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    profile = await get_user_profile(user_id)
-    lang = profile.get("language", "ru")
-
-    if not _is_root_admin(user_id):
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_denied"))
-        return
-
-    target_id = _parse_target_id(context)
-    if not target_id:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_bad_args"))
-        return
-
-    await ensure_user(target_id)
-    await update_user_profile(target_id, is_admin=1)
-    await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_done"))
+    await _admin_target_command(update, context, "add_admin")
 
 
 async def remove_admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    profile = await get_user_profile(user_id)
-    lang = profile.get("language", "ru")
-
-    if not _is_root_admin(user_id):
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_denied"))
-        return
-
-    target_id = _parse_target_id(context)
-    if not target_id:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_bad_args"))
-        return
-
-    await ensure_user(target_id)
-    await update_user_profile(target_id, is_admin=0)
-    await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_done"))
+    await _admin_target_command(update, context, "remove_admin")
 
 
 async def reset_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    profile = await get_user_profile(user_id)
-    lang = profile.get("language", "ru")
-
-    if not _is_root_admin(user_id):
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_denied"))
-        return
-
-    target_id = _parse_target_id(context)
-    if not target_id:
-        await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_bad_args"))
-        return
-
-    await reset_user_data(target_id)
-    await send_ui(context=context, user_id=user_id, chat_id=chat_id, text=tr(lang, "admin_done"))
+    await _admin_target_command(update, context, "reset")
 
 
 # --- Runner ---
 async def run_telegram_bot(application: Application) -> None:
+    global _WEBHOOK_APPLICATION
     logger.info("🚀 Starting Telegram bot...")
+    webhook_mode = UPDATE_MODE == "webhook"
 
     # Если на стороне Telegram остался webhook (частая причина "бот запущен, но polling не получает апдейты"),
     # то принудительно снимаем его перед polling.
-    try:
-        await application.bot.delete_webhook(drop_pending_updates=True)
-        logger.info("✅ Webhook disabled (polling mode)")
-    except Exception as e:
-        # Не фейлим старт целиком: иногда delete_webhook может падать из-за сетевых/временных проблем.
-        logger.warning(f"⚠️ Could not delete webhook (continuing): {e}")
+    if not webhook_mode:
+        try:
+            await application.bot.delete_webhook(drop_pending_updates=True)
+            logger.info("✅ Webhook disabled (polling mode)")
+        except Exception as e:
+            # Не фейлим старт целиком: иногда delete_webhook может падать из-за сетевых/временных проблем.
+            logger.warning(f"⚠️ Could not delete webhook (continuing): {e}")
 
     await application.initialize()
+    HEALTH.add_probe("telegram", application.bot.get_me)
+    UPDATE_PROCESSOR.attach_queue(application.update_queue)
 
     # Диагностика: помогает понять, что токен/бот корректны
     try:
@@ -1207,8 +1707,18 @@ async def run_telegram_bot(application: Application) -> None:
 
     await application.start()
 
+    if webhook_mode:
+        # Апдейты приходят в telegram_webhook_endpoint и кладутся в application.update_queue
+        _WEBHOOK_APPLICATION = application
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+        )
+        logger.info("✅ Webhook set: %s%s", WEBHOOK_URL, WEBHOOK_PATH)
     # Polling: pin'им PTB, но оставляем fallback на случай окружения.
-    if getattr(application, "updater", None) is not None and hasattr(application.updater, "start_polling"):
+    elif getattr(application, "updater", None) is not None and hasattr(application.updater, "start_polling"):
         await application.updater.start_polling(
             poll_interval=1.0,
             timeout=10,
@@ -1252,7 +1762,8 @@ async def run_telegram_bot(application: Application) -> None:
             await asyncio.sleep(60)
     finally:
         logger.info("🛑 Stopping Telegram bot...")
-        if getattr(application, "updater", None) is not None and hasattr(application.updater, "stop"):
+        _WEBHOOK_APPLICATION = None
+        if getattr(application, "updater", None) is not None and getattr(application.updater, "running", False):
             await application.updater.stop()
         await application.stop()
         await application.shutdown()
@@ -1280,35 +1791,45 @@ async def main() -> None:
         )
         raise SystemExit(2)
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    if UPDATE_MODE not in ("polling", "webhook"):
+        logger.error("UI_BOT_UPDATE_MODE must be 'polling' or 'webhook', got %r", UPDATE_MODE)
+        raise SystemExit(2)
+    if UPDATE_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+        logger.error(
+            "Webhook mode requires UI_BOT_WEBHOOK_URL (public https base URL of this server) "
+            "and UI_BOT_WEBHOOK_SECRET (1-256 chars: A-Z, a-z, 0-9, _ and -)."
+        )
+        raise SystemExit(2)
+
+    application = Application.builder().token(BOT_TOKEN).concurrent_updates(UPDATE_PROCESSOR).build()
 
     # Commands
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("bank", bank_command))
-    application.add_handler(CommandHandler("my_longs", my_longs_command))
-    application.add_handler(CommandHandler("my_stats", my_stats_command))
-    application.add_handler(CommandHandler("menu", menu_command))
-    application.add_handler(CommandHandler("plans", plans_command))
-    application.add_handler(CommandHandler("settings", settings_command))
-    application.add_handler(CommandHandler("autotrade", autotrade_command))
-    application.add_handler(CommandHandler("set_po", set_po_command))
-    application.add_handler(CommandHandler("signal", request_signal_command))
-    application.add_handler(CommandHandler("long", long_command))
-    application.add_handler(CommandHandler("short", short_command))
+    application.add_handler(CommandHandler("start", _track_interaction(start_command)))
+    application.add_handler(CommandHandler("help", _track_interaction(help_command)))
+    application.add_handler(CommandHandler("bank", _track_interaction(bank_command)))
+    application.add_handler(CommandHandler("my_longs", _track_interaction(my_longs_command)))
+    application.add_handler(CommandHandler("my_stats", _track_interaction(my_stats_command)))
+    application.add_handler(CommandHandler("menu", _track_interaction(menu_command)))
+    application.add_handler(CommandHandler("plans", _track_interaction(plans_command)))
+    application.add_handler(CommandHandler("settings", _track_interaction(settings_command)))
+    application.add_handler(CommandHandler("autotrade", _track_interaction(autotrade_command)))
+    application.add_handler(CommandHandler("set_po", _track_interaction(set_po_command)))
+    application.add_handler(CommandHandler("signal", _track_interaction(request_signal_command)))
+    application.add_handler(CommandHandler("long", _track_interaction(long_command)))
+    application.add_handler(CommandHandler("short", _track_interaction(short_command)))
 
     # Admin
-    application.add_handler(CommandHandler("admin", admin_command))
-    application.add_handler(CommandHandler("god", god_command))
-    application.add_handler(CommandHandler("ban_user", ban_user_command))
-    application.add_handler(CommandHandler("unban_user", unban_user_command))
-    application.add_handler(CommandHandler("add_admin", add_admin_command))
-    application.add_handler(CommandHandler("remove_admin", remove_admin_command))
-    application.add_handler(CommandHandler("reset_user", reset_user_command))
+    application.add_handler(CommandHandler("admin", _track_interaction(admin_command)))
+    application.add_handler(CommandHandler("god", _track_interaction(god_command)))
+    application.add_handler(CommandHandler("ban_user", _track_interaction(ban_user_command)))
+    application.add_handler(CommandHandler("unban_user", _track_interaction(unban_user_command)))
+    application.add_handler(CommandHandler("add_admin", _track_interaction(add_admin_command)))
+    application.add_handler(CommandHandler("remove_admin", _track_interaction(remove_admin_command)))
+    application.add_handler(CommandHandler("reset_user", _track_interaction(reset_user_command)))
 
     # UI callbacks
-    application.add_handler(CallbackQueryHandler(callback_router))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_router))
+    application.add_handler(CallbackQueryHandler(_track_interaction(callback_router)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, _track_interaction(text_router)))
 
     telegram_task = asyncio.create_task(run_telegram_bot(application))
 
@@ -1317,7 +1838,15 @@ async def main() -> None:
     server = uvicorn.Server(config)
     api_task = asyncio.create_task(server.serve())
 
-    await asyncio.gather(telegram_task, api_task)
+    tasks = [telegram_task, api_task, asyncio.create_task(HEALTH.run()), asyncio.create_task(SWEEPER.run())]
+    if SIGNAL_OUTBOX.enabled:
+        tasks.append(asyncio.create_task(SIGNAL_OUTBOX.run()))
+    if RESULTS_TOKEN:
+        tasks.append(asyncio.create_task(SIGNAL_RESULTS.run(functools.partial(_send_signal_result, application.bot))))
+    if has_old_keys():
+        tasks.append(asyncio.create_task(_reencrypt_credentials_job()))
+
+    await asyncio.gather(*tasks)
 
 
 if __name__ == "__main__":
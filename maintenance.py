@@ -0,0 +1,119 @@
+"""
+maintenance.py
+
+Фоновая уборка локальной SQLite-базы UI-бота.
+
+Раз в UI_BOT_SWEEP_INTERVAL секунд:
+- удаляет истёкшие строки user_states (TTL по ключу, UI_BOT_STATE_TTLS) пачками по UI_BOT_SWEEP_BATCH;
+- если задан UI_BOT_ARCHIVE_INACTIVE_DAYS — переносит профили пользователей, неактивных дольше
+  этого срока (без кредов, не админов), в users_archive и удаляет их строки состояний.
+
+Между пачками — пауза UI_BOT_SWEEP_PAUSE_MS, чтобы не занимать писателя надолго.
+Отчёт последнего прохода и суммарные счётчики — в stats() (/health/deep).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import datetime as _dt
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from user_db_handler import archive_inactive_users, get_state_table_stats, sweep_expired_states
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL = float(os.getenv("UI_BOT_SWEEP_INTERVAL", "600"))
+SWEEP_BATCH = max(1, int(os.getenv("UI_BOT_SWEEP_BATCH", "500")))
+SWEEP_PAUSE = float(os.getenv("UI_BOT_SWEEP_PAUSE_MS", "20")) / 1000.0
+# 0 — архивация выключена
+ARCHIVE_INACTIVE_DAYS = float(os.getenv("UI_BOT_ARCHIVE_INACTIVE_DAYS", "0") or 0)
+
+
+class StateSweeper:
+    """Пакетное удаление истёкших состояний и (опционально) архивация неактивных пользователей."""
+
+    def __init__(
+        self,
+        *,
+        interval: float = SWEEP_INTERVAL,
+        batch_size: int = SWEEP_BATCH,
+        pause: float = SWEEP_PAUSE,
+        archive_after_days: float = ARCHIVE_INACTIVE_DAYS,
+    ) -> None:
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.pause = pause
+        self.archive_after_days = archive_after_days
+        self._stats: Dict[str, int] = {
+            "sweeps": 0,
+            "errors": 0,
+            "expired_states": 0,
+            "archived_users": 0,
+            "reclaimed_rows": 0,
+        }
+        self._last_report: Optional[Dict[str, Any]] = None
+
+    async def _drain(self, step: Callable[[], Awaitable[int]]) -> int:
+        # Пачки до первой неполной; между пачками писатель свободен для UI
+        total = 0
+        while True:
+            n = await step()
+            total += n
+            if n < self.batch_size:
+                return total
+            await asyncio.sleep(self.pause)
+
+    async def sweep_once(self) -> Dict[str, Any]:
+        """Один проход. Возвращает отчёт: сколько строк удалено по таблицам и размеры таблиц после."""
+        started = time.perf_counter()
+        reclaimed = {"user_states": 0, "user_sessions": 0, "users": 0}
+
+        expired = await self._drain(lambda: sweep_expired_states(self.batch_size))
+        reclaimed["user_states"] += expired
+
+        archived = 0
+        if self.archive_after_days > 0:
+            cutoff = _dt.datetime.utcnow() - _dt.timedelta(days=self.archive_after_days)
+            inactive_before = cutoff.replace(microsecond=0).isoformat() + "Z"
+
+            async def _archive_batch() -> int:
+                rows = await archive_inactive_users(inactive_before, self.batch_size)
+                for table, n in rows.items():
+                    reclaimed[table] += n
+                return rows["users"]
+
+            archived = await self._drain(_archive_batch)
+
+        report: Dict[str, Any] = {
+            "expired_states": expired,
+            "archived_users": archived,
+            "reclaimed_rows": reclaimed,
+            "tables": await asyncio.to_thread(get_state_table_stats),
+            "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+            "finished_at": _dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
+        }
+        self._stats["sweeps"] += 1
+        self._stats["expired_states"] += expired
+        self._stats["archived_users"] += archived
+        self._stats["reclaimed_rows"] += sum(reclaimed.values())
+        self._last_report = report
+        if expired or archived:
+            logger.info(f"🧹 State sweep: {expired} expired states, {archived} users archived, rows reclaimed {reclaimed}")
+        return report
+
+    async def run(self) -> None:
+        """Фоновый цикл (main): проход раз в interval секунд."""
+        logger.info("✅ State sweeper started")
+        while True:
+            try:
+                await self.sweep_once()
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.error(f"❌ State sweep failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "archive_after_days": self.archive_after_days, "last_report": self._last_report}
@@ -0,0 +1,388 @@
+"""
+outbound.py
+
+Планировщик исходящих вызовов Bot API.
+
+Все send/edit/delete и ответы на callback-запросы идут через одну очередь:
+- глобальный token bucket (~30 сообщений/с на бота);
+- token bucket на чат для новых сообщений (send_*; правки и удаления — только глобальный лимит);
+- не больше одного вызова в полёте на чат (порядок внутри чата сохраняется);
+- полосы приоритета: ответы UI обслуживаются раньше рассылок;
+- выбор следующего вызова не проходит всю очередь: в каждой полосе — очереди по чатам,
+  очередь готовых чатов и куча чатов, ждущих свою корзину (по времени готовности);
+- RetryAfter (429): пауза всей очереди на retry_after и повтор вызова;
+- удаления одного и того же сообщения склеиваются в один вызов.
+
+Лимиты настраиваются через окружение:
+UI_BOT_OUT_GLOBAL_RATE, UI_BOT_OUT_GLOBAL_BURST, UI_BOT_OUT_CHAT_RATE, UI_BOT_OUT_CHAT_BURST,
+UI_BOT_OUT_MAX_RETRIES.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_UI = 0
+PRIORITY_BROADCAST = 1
+
+GLOBAL_RATE = float(os.getenv("UI_BOT_OUT_GLOBAL_RATE", "30"))
+GLOBAL_BURST = float(os.getenv("UI_BOT_OUT_GLOBAL_BURST", "30"))
+CHAT_RATE = float(os.getenv("UI_BOT_OUT_CHAT_RATE", "1"))
+CHAT_BURST = float(os.getenv("UI_BOT_OUT_CHAT_BURST", "4"))
+MAX_RETRIES = int(os.getenv("UI_BOT_OUT_MAX_RETRIES", "3"))
+
+# Методы, которые создают сообщения в чате: на них действует лимит чата (~1 сообщение/с)
+_CHAT_LIMITED_PREFIXES = ("send_", "copy_message", "forward_message")
+
+# Сколько недавно удалённых сообщений помнить (повторный delete того же id — без вызова API)
+_RECENT_DELETES_MAX = 4096
+# Сколько корзин чатов держать до очистки полных (простаивающих)
+_CHAT_BUCKETS_MAX = 10000
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity."""
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float, now: float) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.stamp = now
+
+    def _refill(self, now: float) -> None:
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до свободного токена (0 — можно сейчас)."""
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1.0
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ("bot", "method", "chat_id", "kwargs", "priority", "future", "attempts", "enqueued_at", "delete_key")
+
+    def __init__(self, bot: Any, method: str, chat_id: int, kwargs: Dict[str, Any], priority: int, future: asyncio.Future, now: float) -> None:
+        self.bot = bot
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+        self.enqueued_at = now
+        self.delete_key: Optional[Tuple[int, int]] = None
+
+
+class OutboundScheduler:
+    """Очередь исходящих вызовов Bot API с лимитами и приоритетами.
+
+    Диспетчер запускается лениво в текущем event loop при первом вызове.
+    """
+
+    def __init__(
+        self,
+        *,
+        global_rate: float = GLOBAL_RATE,
+        global_burst: float = GLOBAL_BURST,
+        chat_rate: float = CHAT_RATE,
+        chat_burst: float = CHAT_BURST,
+        max_retries: int = MAX_RETRIES,
+        lanes: int = 2,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._lane_count = lanes
+        self._clock = clock
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        now = self._clock()
+        # Полоса -> чат -> задания чата (FIFO); пустые очереди удаляются
+        self._lanes: List[Dict[int, Deque[_Job]]] = [{} for _ in range(self._lane_count)]
+        # Чаты с заданиями, которые можно отправить сейчас (не в полёте, корзина не пуста)
+        self._ready: List[Deque[int]] = [deque() for _ in range(self._lane_count)]
+        # Чаты, ждущие токен своей корзины: (готов в, seq, полоса, chat_id)
+        self._delayed: List[Tuple[float, int, int, int]] = []
+        self._delayed_seq = itertools.count()
+        # (полоса, chat_id), уже стоящие в _ready или _delayed
+        self._scheduled: Set[Tuple[int, int]] = set()
+        self._global = TokenBucket(self.global_rate, self.global_burst, now)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._busy: Set[int] = set()
+        self._running: Set[asyncio.Task] = set()
+        self._paused_until = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pending_deletes: Dict[Tuple[int, int], asyncio.Future] = {}
+        self._recent_deletes: "OrderedDict[Tuple[int, int], None]" = OrderedDict()
+        self._stats: Dict[str, Any] = {
+            "calls": 0,
+            "errors": 0,
+            "retries": 0,
+            "retry_after_s": 0.0,
+            "coalesced_deletes": 0,
+            "wait_total_s": 0.0,
+            "wait_max_s": 0.0,
+        }
+
+    # --- lifecycle ---
+    def _ensure_started(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            if self._loop is not loop:
+                # Новый event loop (перезапуск, тесты): задания старого loop'а уже никто не ждёт
+                self._reset_state()
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run(), name="ui-bot-outbound")
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    # --- submit ---
+    async def call(self, bot: Any, method: str, *, chat_id: int, priority: int = PRIORITY_UI, **kwargs: Any) -> Any:
+        """Ставит bot.<method>(chat_id=..., **kwargs) в очередь и ждёт результата."""
+        future = self._submit(bot, method, chat_id, kwargs, priority)
+        return await future
+
+    async def delete_message(
+        self,
+        bot: Any,
+        chat_id: int,
+        message_id: int,
+        *,
+        priority: int = PRIORITY_UI,
+        on_submit: Optional[Callable[[], None]] = None,
+    ) -> Any:
+        """delete_message со склейкой: один вызов на (chat_id, message_id).
+
+        on_submit вызывается, только если удаление действительно ушло в очередь (не склеено).
+        """
+        key = (chat_id, message_id)
+        if key in self._recent_deletes:
+            self._stats["coalesced_deletes"] += 1
+            return True
+        pending = self._pending_deletes.get(key)
+        if pending is not None and not pending.done():
+            self._stats["coalesced_deletes"] += 1
+            return await asyncio.shield(pending)
+
+        future = self._submit(bot, "delete_message", chat_id, {"message_id": message_id}, priority, delete_key=key)
+        self._pending_deletes[key] = future
+        if on_submit is not None:
+            on_submit()
+        return await asyncio.shield(future)
+
+    async def answer_callback_query(
+        self, bot: Any, chat_id: int, callback_query_id: str, *, priority: int = PRIORITY_UI, **kwargs: Any
+    ) -> Any:
+        """answer_callback_query через очередь; chat_id — только для очереди чата, в сам вызов не передаётся."""
+        kwargs["callback_query_id"] = callback_query_id
+        future = self._submit(bot, "answer_callback_query", chat_id, kwargs, priority, pass_chat_id=False)
+        return await future
+
+    def _lane(self, priority: int) -> int:
+        return min(max(priority, 0), self._lane_count - 1)
+
+    def _submit(
+        self,
+        bot: Any,
+        method: str,
+        chat_id: int,
+        kwargs: Dict[str, Any],
+        priority: int,
+        delete_key: Optional[Tuple[int, int]] = None,
+        pass_chat_id: bool = True,
+    ) -> asyncio.Future:
+        self._ensure_started()
+        future = self._loop.create_future()  # type: ignore[union-attr]
+        if pass_chat_id:
+            kwargs["chat_id"] = chat_id
+        job = _Job(bot, method, chat_id, kwargs, priority, future, self._clock())
+        job.delete_key = delete_key
+        lane = self._lane(priority)
+        self._lanes[lane].setdefault(chat_id, deque()).append(job)
+        self._schedule(lane, chat_id)
+        self._wakeup.set()  # type: ignore[union-attr]
+        return future
+
+    def _schedule(self, lane: int, chat_id: int) -> None:
+        """Ставит чат в очередь готовых полосы (если у него есть задания и он не в полёте)."""
+        if chat_id in self._busy or (lane, chat_id) in self._scheduled or chat_id not in self._lanes[lane]:
+            return
+        self._scheduled.add((lane, chat_id))
+        self._ready[lane].append(chat_id)
+
+    # --- dispatch ---
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _CHAT_BUCKETS_MAX:
+                self._chats = {cid: b for cid, b in self._chats.items() if cid in self._busy or not b.is_full(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def _next_job(self) -> Tuple[Optional[_Job], Optional[float]]:
+        """Следующее готовое задание или (None, сколько ждать; None — очередь пуста)."""
+        now = self._clock()
+        if now < self._paused_until:
+            return None, self._paused_until - now
+        global_wait = self._global.wait_time(now)
+        if global_wait > 0:
+            return None, global_wait
+
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, lane, chat_id = heapq.heappop(self._delayed)
+            self._ready[lane].append(chat_id)
+
+        for lane, ready in enumerate(self._ready):
+            queues = self._lanes[lane]
+            while ready:
+                chat_id = ready.popleft()
+                self._scheduled.discard((lane, chat_id))
+                queue = queues.get(chat_id)
+                while queue and queue[0].future.cancelled():
+                    self._forget_delete(queue.popleft())
+                if not queue:
+                    queues.pop(chat_id, None)
+                    continue
+                if chat_id in self._busy:
+                    # Вернётся в очередь готовых, когда завершится вызов в полёте (_execute)
+                    continue
+                job = queue[0]
+                if job.method.startswith(_CHAT_LIMITED_PREFIXES):
+                    bucket = self._chat_bucket(chat_id, now)
+                    wait = bucket.wait_time(now)
+                    if wait > 0:
+                        self._scheduled.add((lane, chat_id))
+                        heapq.heappush(self._delayed, (now + wait, next(self._delayed_seq), lane, chat_id))
+                        continue
+                    bucket.take(now)
+                queue.popleft()
+                if not queue:
+                    del queues[chat_id]
+                self._global.take(now)
+                return job, None
+        if self._delayed:
+            return None, max(0.0, self._delayed[0][0] - now)
+        return None, None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                job, wait = self._next_job()
+            except Exception as e:
+                logger.error(f"❌ Outbound dispatcher error: {e}")
+                job, wait = None, 0.1
+
+            if job is None:
+                self._wakeup.clear()  # type: ignore[union-attr]
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)  # type: ignore[union-attr]
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._busy.add(job.chat_id)
+            task = asyncio.create_task(self._execute(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, job: _Job) -> None:
+        started = self._clock()
+        waited = started - job.enqueued_at
+        self._stats["wait_total_s"] += waited
+        self._stats["wait_max_s"] = max(self._stats["wait_max_s"], waited)
+        self._stats["calls"] += 1
+        job.attempts += 1
+        try:
+            result = await getattr(job.bot, job.method)(**job.kwargs)
+        except RetryAfter as e:
+            retry_after = float(e.retry_after)
+            self._stats["retry_after_s"] += retry_after
+            if job.attempts <= self.max_retries and not job.future.done():
+                # Флуд-контроль Telegram: притормаживаем всю очередь, задание — в начало своей полосы
+                self._stats["retries"] += 1
+                self._paused_until = max(self._paused_until, self._clock() + retry_after)
+                self._lanes[self._lane(job.priority)].setdefault(job.chat_id, deque()).appendleft(job)
+                logger.warning(f"⚠️ Bot API flood control on {job.method} (chat {job.chat_id}): retry in {retry_after:.1f}s")
+            else:
+                self._fail(job, e)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            if job.delete_key is not None:
+                self._remember_delete(job.delete_key)
+            if not job.future.done():
+                job.future.set_result(result)
+            self._forget_delete(job)
+        finally:
+            self._busy.discard(job.chat_id)
+            for lane in range(self._lane_count):
+                self._schedule(lane, job.chat_id)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def _fail(self, job: _Job, error: BaseException) -> None:
+        self._stats["errors"] += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+            # Ошибку получит вызывающий; если его уже нет — не шумим "exception was never retrieved"
+            job.future.add_done_callback(lambda f: f.exception())
+        self._forget_delete(job)
+
+    def _remember_delete(self, key: Tuple[int, int]) -> None:
+        self._recent_deletes[key] = None
+        while len(self._recent_deletes) > _RECENT_DELETES_MAX:
+            self._recent_deletes.popitem(last=False)
+
+    def _forget_delete(self, job: _Job) -> None:
+        if job.delete_key is not None and self._pending_deletes.get(job.delete_key) is job.future:
+            del self._pending_deletes[job.delete_key]
+
+    # --- stats ---
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        calls = stats["calls"]
+        stats["wait_avg_ms"] = round(stats.pop("wait_total_s") / calls * 1000, 3) if calls else 0.0
+        stats["wait_max_ms"] = round(stats.pop("wait_max_s") * 1000, 3)
+        stats["queued"] = [sum(len(queue) for queue in lane.values()) for lane in self._lanes]
+        stats["in_flight"] = len(self._busy)
+        stats["paused_s"] = round(max(0.0, self._paused_until - self._clock()), 3)
+        return stats
@@ -0,0 +1,477 @@
+"""
+signals.py
+
+Клиент внешней таблицы signal_requests (Supabase).
+
+Синхронный supabase-py выполняется в собственном пуле потоков, а не в event loop:
+- не больше UI_BOT_SIGNAL_CONCURRENCY одновременных запросов;
+- таймаут UI_BOT_SIGNAL_TIMEOUT секунд на запрос (ожидание слота + HTTP);
+- собственные метрики: число вызовов, ошибки, таймауты, брошенные вызовы, задержка (avg/p50/p95/max).
+
+Таймаут прекращает только ожидание: уже начатый HTTP-запрос в потоке не прервать, и вставка
+может закоммититься после того, как вызывающий получил TimeoutError. Повтор при этом безопасен:
+upsert идёт по idempotency_key с ignore_duplicates, так что повторная отправка той же строки
+дубля не создаёт. Брошенный вызов держит свой слот, пока поток не закончит, поэтому зависшие
+вставки не копятся в очереди пула сверх UI_BOT_SIGNAL_CONCURRENCY.
+
+Запросы пользователей идут через SignalOutbox: строка коммитится в локальный signal_outbox
+(user_db_handler), а фоновый flusher пачками делает upsert в Supabase по idempotency_key
+(повтор после сбоя не создаёт дублей), с экспоненциальной задержкой между попытками.
+Таблице signal_requests нужна колонка idempotency_key с UNIQUE-ограничением.
+
+Повторные запросы того же (user_id, request_type) в окне UI_BOT_SIGNAL_COOLDOWN секунд
+не создают строк: они присоединяются к уже отправленному запросу (SignalDeduplicator).
+
+Ответы ядра приходят пачками (POST /signals/results) и доставляются SignalResultDispatcher:
+результаты сохраняются в signal_deliveries, фоновый цикл рассылает их через переданную
+функцию отправки (в main — очередь outbound с приоритетом рассылок) и пишет итог доставки.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple, TypeVar
+
+from postgrest.types import ReturnMethod
+from telegram.error import BadRequest, Forbidden
+
+from user_db_handler import (
+    enqueue_signal_request,
+    fetch_pending_deliveries,
+    fetch_pending_signals,
+    mark_deliveries,
+    mark_signals_failed,
+    mark_signals_sent,
+    prune_signal_outbox,
+    record_signal_results,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+SIGNAL_CONCURRENCY = max(1, int(os.getenv("UI_BOT_SIGNAL_CONCURRENCY", "4")))
+SIGNAL_TIMEOUT = float(os.getenv("UI_BOT_SIGNAL_TIMEOUT", "5"))
+
+OUTBOX_BATCH_SIZE = max(1, int(os.getenv("UI_BOT_SIGNAL_BATCH_SIZE", "100")))
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("UI_BOT_SIGNAL_FLUSH_INTERVAL", "5"))
+# Сколько подождать после первого запроса, чтобы собрать всплеск в одну пачку
+OUTBOX_LINGER = float(os.getenv("UI_BOT_SIGNAL_FLUSH_LINGER_MS", "50")) / 1000.0
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("UI_BOT_SIGNAL_MAX_ATTEMPTS", "12"))
+OUTBOX_BACKOFF_BASE = 1.0
+OUTBOX_BACKOFF_MAX = 300.0
+# Отправленные строки outbox храним сутки
+OUTBOX_RETENTION = 24 * 3600.0
+
+SIGNAL_COOLDOWN = float(os.getenv("UI_BOT_SIGNAL_COOLDOWN", "60"))
+
+RESULTS_BATCH_SIZE = max(1, int(os.getenv("UI_BOT_RESULTS_BATCH_SIZE", "200")))
+RESULTS_MAX_ATTEMPTS = int(os.getenv("UI_BOT_RESULTS_MAX_ATTEMPTS", "5"))
+RESULTS_RETRY_DELAY = 30.0
+RESULTS_POLL_INTERVAL = 10.0
+_DEDUP_MAX_ENTRIES = 100_000
+
+_LATENCY_WINDOW = 1024
+
+
+class SignalClient:
+    """Асинхронная обёртка над синхронным Supabase-клиентом."""
+
+    def __init__(
+        self,
+        client: Any,
+        *,
+        max_concurrency: int = SIGNAL_CONCURRENCY,
+        timeout: float = SIGNAL_TIMEOUT,
+    ) -> None:
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._semaphores: Dict[int, asyncio.Semaphore] = {}
+        self._latencies_ms: Deque[float] = deque(maxlen=_LATENCY_WINDOW)
+        # abandoned — вызовы, которые перестали ждать, пока поток ещё выполнял запрос;
+        # abandoned_running — сколько таких потоков работает сейчас (и держит слоты)
+        self._stats: Dict[str, int] = {
+            "calls": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "in_flight": 0,
+            "abandoned": 0,
+            "abandoned_running": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.client is not None
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="ui-signal")
+        return self._executor
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # Семафор привязан к event loop — держим по одному на loop
+        loop_id = id(asyncio.get_running_loop())
+        sem = self._semaphores.get(loop_id)
+        if sem is None:
+            self._semaphores = {loop_id: asyncio.Semaphore(self.max_concurrency)}
+            sem = self._semaphores[loop_id]
+        return sem
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """Выполняет fn(*args) в пуле клиента с лимитом параллельности, таймаутом и метриками.
+
+        После TimeoutError fn может ещё выполниться до конца (см. docstring модуля) — передавайте
+        сюда только идемпотентные операции.
+        """
+        started = time.perf_counter()
+        self._stats["calls"] += 1
+        self._stats["in_flight"] += 1
+        try:
+            return await asyncio.wait_for(self._run_bounded(fn, *args), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        finally:
+            self._stats["in_flight"] -= 1
+            self._latencies_ms.append((time.perf_counter() - started) * 1000)
+
+    async def _run_bounded(self, fn: Callable[..., T], *args: Any) -> T:
+        sem = self._semaphore()
+        await sem.acquire()
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._pool().submit(fn, *args)
+        except BaseException:
+            sem.release()
+            raise
+        # Слот освобождается, когда поток закончил, а не когда вызывающий перестал ждать
+        future.add_done_callback(lambda _: self._call_threadsafe(loop, sem.release))
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Ещё не начатый вызов отменяется; начатый дорабатывает в потоке
+            if not future.cancel() and not future.done():
+                self._stats["abandoned"] += 1
+                self._stats["abandoned_running"] += 1
+                future.add_done_callback(lambda _: self._call_threadsafe(loop, self._abandoned_done))
+            raise
+
+    @staticmethod
+    def _call_threadsafe(loop: asyncio.AbstractEventLoop, fn: Callable[[], Any]) -> None:
+        try:
+            loop.call_soon_threadsafe(fn)
+        except RuntimeError:
+            # event loop уже закрыт — его семафор больше никому не нужен
+            pass
+
+    def _abandoned_done(self) -> None:
+        self._stats["abandoned_running"] -= 1
+
+    async def upsert_requests(self, rows: List[Dict[str, Any]]) -> None:
+        """Пакетная вставка в signal_requests; строки с уже известным idempotency_key пропускаются."""
+        await self.run(self._upsert_rows, rows)
+
+    def _upsert_rows(self, rows: list) -> Any:
+        return (
+            self.client.table("signal_requests")
+            .upsert(rows, on_conflict="idempotency_key", ignore_duplicates=True, returning=ReturnMethod.minimal)
+            .execute()
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies_ms)
+        stats: Dict[str, Any] = dict(self._stats)
+        if latencies:
+            stats["latency_ms"] = {
+                "avg": round(sum(latencies) / len(latencies), 3),
+                "p50": round(latencies[len(latencies) // 2], 3),
+                "p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+                "max": round(latencies[-1], 3),
+            }
+        return stats
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class SignalTicket(NamedTuple):
+    idempotency_key: str
+    duplicate: bool
+
+
+class SignalDeduplicator:
+    """Реестр запросов в полёте по (user_id, request_type) с окном cooldown.
+
+    Первый запрос резервирует слот (future с idempotency_key); повторы в окне ждут
+    этот future и получают тот же ключ, новых строк не создаётся.
+    """
+
+    def __init__(
+        self,
+        cooldown: float = SIGNAL_COOLDOWN,
+        *,
+        max_entries: int = _DEDUP_MAX_ENTRIES,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.cooldown = cooldown
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[asyncio.Future, float]]" = OrderedDict()
+        self._stats: Dict[str, Any] = {"accepted": 0, "suppressed": 0, "suppressed_by_type": {}}
+
+    def claim(self, user_id: int, request_type: str) -> Tuple[asyncio.Future, bool]:
+        """(future ключа, duplicate). duplicate=False — вызывающий обязан resolve()/fail() future."""
+        now = self._clock()
+        slot = (user_id, request_type)
+        entry = self._entries.get(slot)
+        if entry is not None and entry[1] > now:
+            self._stats["suppressed"] += 1
+            by_type = self._stats["suppressed_by_type"]
+            by_type[request_type] = by_type.get(request_type, 0) + 1
+            return entry[0], True
+
+        future = asyncio.get_running_loop().create_future()
+        if self.cooldown > 0:
+            self._entries[slot] = (future, now + self.cooldown)
+            self._entries.move_to_end(slot)
+            self._prune(now)
+        self._stats["accepted"] += 1
+        return future, False
+
+    def release(self, user_id: int, request_type: str) -> None:
+        """Снимает запрос с учёта досрочно (например, результат уже доставлен)."""
+        self._entries.pop((user_id, request_type), None)
+
+    def _prune(self, now: float) -> None:
+        if len(self._entries) <= self.max_entries:
+            return
+        for slot in [slot for slot, (_, expires_at) in self._entries.items() if expires_at <= now]:
+            del self._entries[slot]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["suppressed_by_type"] = dict(stats["suppressed_by_type"])
+        stats["tracked"] = len(self._entries)
+        return stats
+
+
+class SignalOutbox:
+    """Локальный outbox запросов сигналов + фоновая пакетная отправка в Supabase."""
+
+    def __init__(
+        self,
+        client: SignalClient,
+        *,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        flush_interval: float = OUTBOX_FLUSH_INTERVAL,
+        linger: float = OUTBOX_LINGER,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        backoff_base: float = OUTBOX_BACKOFF_BASE,
+        backoff_max: float = OUTBOX_BACKOFF_MAX,
+        dedup: Optional[SignalDeduplicator] = None,
+    ) -> None:
+        self.client = client
+        self.dedup = dedup if dedup is not None else SignalDeduplicator()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.linger = linger
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._wakeup: Optional[asyncio.Event] = None
+        self._last_prune = 0.0
+        self._stats: Dict[str, int] = {"enqueued": 0, "flushes": 0, "sent": 0, "failed_batches": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.client.enabled
+
+    async def submit(self, user_id: int, request_type: str) -> SignalTicket:
+        """Коммитит запрос локально и будит flusher; повтор в окне cooldown присоединяется к прошлому."""
+        future, duplicate = self.dedup.claim(user_id, request_type)
+        if duplicate:
+            return SignalTicket(await asyncio.shield(future), True)
+
+        try:
+            key = await enqueue_signal_request(user_id, request_type)
+        except asyncio.CancelledError:
+            # Не future.cancel(): CancelledError у дубликатов обошёл бы их except Exception
+            self.dedup.release(user_id, request_type)
+            future.set_exception(RuntimeError("signal request cancelled before commit"))
+            future.exception()
+            raise
+        except Exception as e:
+            # Слот освобождаем; ждущие дубликаты получат ту же ошибку
+            self.dedup.release(user_id, request_type)
+            future.set_exception(e)
+            future.exception()
+            raise
+        future.set_result(key)
+        self._stats["enqueued"] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return SignalTicket(key, False)
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempts))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def flush_once(self) -> int:
+        """Отправляет одну пачку готовых строк. Возвращает число отправленных."""
+        rows = await fetch_pending_signals(self.batch_size)
+        if not rows:
+            return 0
+        ids = [row["id"] for row in rows]
+        payload = [
+            {
+                "user_id": row["user_id"],
+                "request_type": row["request_type"],
+                "status": "pending",
+                "idempotency_key": row["idempotency_key"],
+            }
+            for row in rows
+        ]
+        self._stats["flushes"] += 1
+        try:
+            await self.client.upsert_requests(payload)
+        except Exception as e:
+            self._stats["failed_batches"] += 1
+            retry_in = self._backoff(max(row["attempts"] for row in rows))
+            logger.warning(f"⚠️ Signal outbox flush of {len(rows)} rows failed, retry in {retry_in:.1f}s: {e!r}")
+            await mark_signals_failed(ids, repr(e), retry_in, self.max_attempts)
+            return 0
+        await mark_signals_sent(ids)
+        self._stats["sent"] += len(ids)
+        return len(ids)
+
+    async def flush(self) -> int:
+        """Отправляет все готовые строки пачками, пока они есть (или пока пачка не упала)."""
+        total = 0
+        while True:
+            sent = await self.flush_once()
+            total += sent
+            if sent < self.batch_size:
+                return total
+
+    async def run(self) -> None:
+        """Фоновый цикл: по сигналу submit() (с задержкой linger) или раз в flush_interval."""
+        self._wakeup = asyncio.Event()
+        logger.info("✅ Signal outbox flusher started")
+        while True:
+            # Первый проход — сразу: дожимаем то, что осталось в outbox с прошлого запуска
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_prune > 3600:
+                    self._last_prune = time.monotonic()
+                    await prune_signal_outbox(OUTBOX_RETENTION)
+            except Exception as e:
+                logger.error(f"❌ Signal outbox flusher error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                await asyncio.sleep(self.linger)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self._stats)
+        stats["dedup"] = self.dedup.stats()
+        return stats
+
+
+SendResult = Callable[[int, str], Awaitable[Any]]
+
+
+class SignalResultDispatcher:
+    """Доставка результатов сигналов пользователям пачками с учётом состояния доставки."""
+
+    def __init__(
+        self,
+        *,
+        dedup: Optional[SignalDeduplicator] = None,
+        batch_size: int = RESULTS_BATCH_SIZE,
+        max_attempts: int = RESULTS_MAX_ATTEMPTS,
+        retry_delay: float = RESULTS_RETRY_DELAY,
+        poll_interval: float = RESULTS_POLL_INTERVAL,
+    ) -> None:
+        self.dedup = dedup
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stats: Dict[str, int] = {"received": 0, "duplicates": 0, "delivered": 0, "retried": 0, "failed": 0}
+
+    async def ingest(self, results: List[Dict[str, Any]]) -> int:
+        """Сохраняет пачку результатов и будит доставку. Возвращает число новых (не повторных)."""
+        accepted = await record_signal_results(results)
+        self._stats["received"] += accepted
+        self._stats["duplicates"] += len(results) - accepted
+        if accepted and self._wakeup is not None:
+            self._wakeup.set()
+        return accepted
+
+    async def deliver_once(self, send: SendResult) -> int:
+        """Рассылает одну пачку ожидающих результатов. Возвращает размер пачки."""
+        rows = await fetch_pending_deliveries(self.batch_size)
+        if not rows:
+            return 0
+
+        outcomes = await asyncio.gather(*[send(row["user_id"], row["text"]) for row in rows], return_exceptions=True)
+
+        delivered: List[int] = []
+        retry: List[Tuple[int, str]] = []
+        failed: List[Tuple[int, str]] = []
+        for row, outcome in zip(rows, outcomes):
+            if not isinstance(outcome, BaseException):
+                delivered.append(row["id"])
+                if self.dedup is not None and row["request_type"]:
+                    # Ответ доставлен — пользователь может сразу запросить новый сигнал
+                    self.dedup.release(row["user_id"], row["request_type"])
+            elif isinstance(outcome, (Forbidden, BadRequest)):
+                # Бот заблокирован / чат недоступен — повтор не поможет
+                failed.append((row["id"], repr(outcome)))
+            else:
+                retry.append((row["id"], repr(outcome)))
+
+        await mark_deliveries(delivered, retry, failed, self.retry_delay, self.max_attempts)
+        self._stats["delivered"] += len(delivered)
+        self._stats["retried"] += len(retry)
+        self._stats["failed"] += len(failed)
+        if retry or failed:
+            logger.warning(f"⚠️ Signal results: {len(retry)} to retry, {len(failed)} undeliverable")
+        return len(rows)
+
+    async def run(self, send: SendResult) -> None:
+        """Фоновый цикл доставки: по сигналу ingest() или раз в poll_interval (повторы)."""
+        self._wakeup = asyncio.Event()
+        logger.info("✅ Signal results dispatcher started")
+        while True:
+            self._wakeup.clear()
+            try:
+                while await self.deliver_once(send) >= self.batch_size:
+                    pass
+            except Exception as e:
+                logger.error(f"❌ Signal results dispatcher error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self._stats)
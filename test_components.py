@@ -4,8 +4,10 @@
 Запуск: python3 test_components.py
 """
 
+import functools
 import sys
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Цветной вывод для терминала
@@ -31,6 +33,25 @@ def print_error(text):
 def print_warning(text):
     print(f"{Colors.YELLOW}⚠️  {text}{Colors.RESET}")
 
+def on_temp_db(test):
+    """Запускает тест на временной SQLite-базе: рабочую ui_bot.sqlite3 (UI_BOT_DB_PATH) не трогает."""
+
+    @functools.wraps(test)
+    def wrapper():
+        import user_db_handler as db
+
+        original_path = db.DB_PATH
+        with tempfile.TemporaryDirectory(prefix="ui_bot_test_") as tmp:
+            db.configure_pool(os.path.join(tmp, "test.sqlite3"))
+            try:
+                return test()
+            finally:
+                # Отложенные touch'и относятся к временной базе — дописываем их туда
+                db.flush_touches()
+                db.configure_pool(original_path)
+
+    return wrapper
+
 def test_imports():
     """Тест 1: Проверка импортов."""
     print_header("ТЕСТ 1: Проверка импортов")
@@ -262,6 +283,1956 @@ def test_api_structure():
         print_error(f"Ошибка проверки API: {e}")
         return False
 
+@on_temp_db
+def test_db_pool():
+    """Тест 7: Пул соединений SQLite (меньше открытий на апдейт)."""
+    print_header("ТЕСТ 7: Пул соединений SQLite")
+
+    try:
+        import asyncio
+        import user_db_handler as db
+
+        test_user_id = 999999998
+
+        async def handle_update():
+            # Типичный набор обращений к БД при обработке одного клика (show_screen/render/send_ui)
+            await db.ensure_user(test_user_id)
+            await db.get_user_profile(test_user_id)
+            await db.get_user_state(test_user_id, "current_screen", default="home")
+            await db.get_user_state(test_user_id, "nav_stack", default=[])
+            await db.set_user_state(test_user_id, "nav_stack", ["home"])
+            await db.set_user_state(test_user_id, "current_screen", "menu")
+            await db.get_encrypted_data_from_local_db(test_user_id)
+            await db.update_user_profile(test_user_id, last_ui_chat_id=1, last_ui_message_id=2)
+
+        updates = 5
+
+        async def run_updates():
+            # Прогрев: соединения открываются по одному на рабочий поток
+            await handle_update()
+            before = db.get_pool_stats()
+            for _ in range(updates):
+                await handle_update()
+            return before, db.get_pool_stats()
+
+        db.init_db()
+        before, after = asyncio.run(run_updates())
+
+        opens = after["opens"] - before["opens"]
+        calls = (after["reads"] + after["writes"]) - (before["reads"] + before["writes"])
+        print_success(f"{updates} апдейтов: {calls} обращений к БД, новых соединений: {opens}")
+
+        # Без пула (connect на каждый вызов) открывалось соединение на каждое обращение (и на каждый ensure_user)
+        if opens >= calls:
+            print_error("Пул не переиспользует соединения")
+            return False
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования пула: {e}")
+        return False
+
+@on_temp_db
+def test_db_touch():
+    """Тест 8: Чтения не пишут в БД, touch'и копятся и пишутся пачкой."""
+    print_header("ТЕСТ 8: Touch-модель (чтения без записи)")
+
+    try:
+        import asyncio
+        import user_db_handler as db
+
+        test_user_id = 999999997
+
+        async def scenario():
+            await db.reset_user_data(test_user_id)
+            writes_before = db.get_pool_stats()["writes"]
+            profile = await db.get_user_profile(test_user_id)
+            await db.get_user_state(test_user_id, "nav_stack", default=[])
+            await db.get_encrypted_ssid(test_user_id)
+            read_writes = db.get_pool_stats()["writes"] - writes_before
+
+            await db.ensure_user(test_user_id)
+            writes_before = db.get_pool_stats()["writes"]
+            for _ in range(10):
+                await db.ensure_user(test_user_id)
+            touch_writes = db.get_pool_stats()["writes"] - writes_before
+            flushed = db.flush_touches()
+            return profile, read_writes, touch_writes, flushed
+
+        db.init_db()
+        profile, read_writes, touch_writes, flushed = asyncio.run(scenario())
+
+        if read_writes:
+            print_error(f"Чтения выполнили {read_writes} записей")
+            return False
+        print_success(f"Чтения без записи (профиль по умолчанию: plan={profile.get('plan')})")
+
+        if touch_writes:
+            print_error(f"Повторные ensure_user выполнили {touch_writes} записей")
+            return False
+        print_success(f"10 touch'ей → 0 записей до flush, flush_touches() обновил {flushed} польз.")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования touch-модели: {e}")
+        return False
+
+@on_temp_db
+def test_db_group_commit():
+    """Тест 9: Group commit — пачка конкурентных записей коммитится вместе."""
+    print_header("ТЕСТ 9: Group commit писателя")
+
+    try:
+        import asyncio
+        import user_db_handler as db
+
+        base_user_id = 999999900
+        writes = 50
+
+        async def burst():
+            before = db.get_writer_stats()
+            await asyncio.gather(
+                *[db.set_user_state(base_user_id + (i % 5), f"k{i}", {"i": i}) for i in range(writes)]
+            )
+            after = db.get_writer_stats()
+            values = await asyncio.gather(
+                *[db.get_user_state(base_user_id + (i % 5), f"k{i}") for i in range(writes)]
+            )
+            return after["batches"] - before["batches"], values
+
+        db.init_db()
+        batches, values = asyncio.run(burst())
+
+        if any(v != {"i": i} for i, v in enumerate(values)):
+            print_error("Не все записи пачки видны после await")
+            return False
+        print_success(f"{writes} конкурентных записей → {batches} транзакций (commit)")
+        if batches >= writes:
+            print_error("Записи не группируются в пачки")
+            return False
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования group commit: {e}")
+        return False
+
+@on_temp_db
+def test_profile_cache():
+    """Тест 10: Кэш профилей — один рендер не больше одного чтения из БД."""
+    print_header("ТЕСТ 10: Кэш профилей")
+
+    try:
+        import asyncio
+        import user_db_handler as db
+
+        test_user_id = 999999996
+
+        async def scenario():
+            await db.ensure_user(test_user_id)
+            await db.update_user_profile(test_user_id, language="ru")
+            db.configure_profile_cache(max_size=1000)
+            db._PROFILE_CACHE.invalidate(test_user_id)
+
+            reads_before = db.get_pool_stats()["reads"]
+            stats_before = db.get_profile_cache_stats()
+            # show_screen → _ensure_not_banned → render_screen → send_ui
+            for _ in range(5):
+                await db.get_user_profile(test_user_id)
+            reads = db.get_pool_stats()["reads"] - reads_before
+            hits = db.get_profile_cache_stats()["hits"] - stats_before["hits"]
+
+            await db.update_user_profile(test_user_id, language="en")
+            updated = await db.get_user_profile(test_user_id)
+            await db.reset_user_data(test_user_id)
+            after_reset = await db.get_user_profile(test_user_id)
+            return reads, hits, updated, after_reset
+
+        db.init_db()
+        reads, hits, updated, after_reset = asyncio.run(scenario())
+
+        if reads != 1 or hits != 4:
+            print_error(f"5 вызовов get_user_profile: чтений из БД {reads}, попаданий в кэш {hits}")
+            return False
+        print_success("5 вызовов get_user_profile → 1 чтение из БД, 4 попадания в кэш")
+
+        if updated.get("language") != "en" or after_reset.get("language") != "ru":
+            print_error("Кэш не обновился после update_user_profile/reset_user_data")
+            return False
+        print_success("update_user_profile обновляет кэш, reset_user_data инвалидирует")
+
+        # Запись профиля другого пользователя не отменяет заполнение кэша; запись того же — отменяет
+        cache = db._ProfileCache(max_size=10, ttl=60)
+        token = cache.read_token(1)
+        cache.update(2, {"language": "en"})
+        cache.put(1, {"user_id": 1}, token)
+        stale = cache.read_token(3)
+        cache.invalidate(3)
+        cache.put(3, {"user_id": 3}, stale)
+        if cache.get(1) is None or cache.get(3) is not None:
+            print_error("Токен чтения должен зависеть только от записей своего user_id")
+            return False
+        print_success("Счётчик записей — свой у каждого пользователя: чужие записи не мешают заполнению кэша")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования кэша профилей: {e}")
+        return False
+
+@on_temp_db
+def test_user_session():
+    """Тест 11: Сессия апдейта — одна загрузка и один flush на клик."""
+    print_header("ТЕСТ 11: Сессия апдейта (round trips на клик)")
+
+    try:
+        import asyncio
+        from types import SimpleNamespace
+        import main
+        import user_db_handler as db
+        from outbound import OutboundScheduler
+
+        test_user_id = 999999995
+
+        class FakeBot:
+            def __init__(self):
+                self.next_id = 100
+
+            async def send_message(self, **kwargs):
+                self.next_id += 1
+                return SimpleNamespace(message_id=self.next_id)
+
+            async def delete_message(self, **kwargs):
+                return True
+
+        context = SimpleNamespace(bot=FakeBot())
+
+        async def click(data):
+            async with db.user_session(test_user_id) as session:
+                await main._dispatch_callback(context=context, session=session, chat_id=test_user_id, data=data)
+
+        async def scenario():
+            await db.reset_user_data(test_user_id)
+            await click("nav:home")
+            per_click = []
+            for data in ("nav:menu", "nav:settings", "set:lang:en", "nav:back", "nav:home"):
+                reads_before = db.get_pool_stats()["reads"]
+                writer_before = db.get_writer_stats()
+                await click(data)
+                writer_after = db.get_writer_stats()
+                per_click.append(
+                    (
+                        data,
+                        db.get_pool_stats()["reads"] - reads_before,
+                        writer_after["batches"] - writer_before["batches"],
+                        writer_after["ops"] - writer_before["ops"],
+                    )
+                )
+            session = await db.load_user_session(test_user_id)
+            return per_click, session
+
+        db.init_db()
+        original_outbound = main.OUTBOUND
+        # Лимиты Telegram в тесте не нужны
+        main.OUTBOUND = OutboundScheduler(chat_rate=1000, chat_burst=100)
+        try:
+            per_click, session = asyncio.run(scenario())
+        finally:
+            main.OUTBOUND = original_outbound
+
+        for data, reads, batches, ops in per_click:
+            if (reads, batches, ops) != (1, 1, 1):
+                print_error(f"'{data}': {reads} чтений, {batches} пачек писателя, {ops} операций (ожидалось 1/1/1)")
+                return False
+        print_success(f"{len(per_click)} кликов: на каждый 1 чтение (загрузка сессии) и 1 пачка писателя (flush)")
+        if session.lang != "en" or session.get_state("current_screen") != "home":
+            print_error("Изменения сессии не записаны в БД")
+            return False
+        print_success("Изменения сессии записаны одним flush")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования сессии апдейта: {e}")
+        return False
+
+def test_callback_router():
+    """Тест 12: Роутер callback_data (маршруты, типы параметров, приоритет)."""
+    print_header("ТЕСТ 12: Роутер callback_data")
+
+    try:
+        from ui_router import CallbackRouter
+        import main
+
+        router = CallbackRouter()
+
+        @router.route("nav:home")
+        async def nav_home():
+            return None
+
+        @router.route("nav:{screen}")
+        async def nav(screen):
+            return None
+
+        @router.route("user:{user_id:int}")
+        async def user(user_id):
+            return None
+
+        checks = [
+            ("nav:home", nav_home, {}),
+            ("nav:menu", nav, {"screen": "menu"}),
+            ("user:42", user, {"user_id": 42}),
+        ]
+        for data, expected_handler, expected_params in checks:
+            resolved = router.resolve(data)
+            if not resolved or resolved[0] is not expected_handler or resolved[1] != expected_params:
+                print_error(f"'{data}' разобран неверно: {resolved}")
+                return False
+        print_success("Статические/параметризованные/типизированные маршруты разбираются корректно")
+
+        if router.resolve("user:abc") or router.resolve("unknown:x"):
+            print_error("Невалидные callback_data не должны находить маршрут")
+            return False
+        print_success("Невалидные callback_data отбрасываются")
+
+        for data in ("nav:back", "set:lang:en", "plan:check:cp_1", "admin:give:vip", "admin:whatever"):
+            if not main.callbacks.resolve(data):
+                print_error(f"Маршрут для '{data}' не зарегистрирован в main.callbacks")
+                return False
+        print_success(f"main.callbacks: {len(main.callbacks)} маршрутов")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования роутера: {e}")
+        return False
+
+def test_translation_catalog():
+    """Тест 13: Каталог переводов (fallback, форматирование, ленивые языки)."""
+    print_header("ТЕСТ 13: Каталог переводов")
+
+    try:
+        import json
+        import tempfile
+        from i18n import TranslationCatalog
+
+        translations = {
+            "ru": {"hello": "Привет", "plan": "Тариф: {plan}", "only_ru": "Только RU"},
+            "en": {"hello": "Hello", "plan": "Plan: {plan}"},
+        }
+        with tempfile.TemporaryDirectory() as locales_dir:
+            with open(os.path.join(locales_dir, "de.json"), "w", encoding="utf-8") as f:
+                json.dump({"hello": "Hallo", "unknown_key": "x"}, f)
+
+            catalog = TranslationCatalog(translations, default_lang="ru", locales_dir=locales_dir)
+            checks = [
+                (catalog.tr("en", "hello"), "Hello"),
+                (catalog.tr("en", "plan", plan="VIP"), "Plan: VIP"),
+                (catalog.tr("en", "only_ru"), "Только RU"),
+                (catalog.tr("xx", "hello"), "Привет"),
+                (catalog.tr("en", "missing_key"), "missing_key"),
+                (catalog.tr("en", "plan"), "Plan: {plan}"),
+            ]
+            for got, expected in checks:
+                if got != expected:
+                    print_error(f"Ожидалось {expected!r}, получено {got!r}")
+                    return False
+            print_success("Fallback на язык по умолчанию и форматирование как у прежнего tr()")
+
+            if not catalog.has_language("de") or "de" in catalog._templates:
+                print_error("Внешний язык должен быть виден, но не загружен до первого обращения")
+                return False
+            if catalog.tr("de", "hello") != "Hallo" or catalog.tr("de", "plan", plan="VIP") != "Тариф: VIP":
+                print_error("Внешний язык загружен неверно")
+                return False
+        print_success("Внешний язык de.json загружен лениво при первом tr()")
+
+        # Кэш экранов: поля профиля подставляются один раз, экранированные скобки перевода не ломаются
+        from types import SimpleNamespace
+        import main
+
+        with tempfile.TemporaryDirectory() as locales_dir:
+            with open(os.path.join(locales_dir, "de.json"), "w", encoding="utf-8") as f:
+                json.dump({"home_profile": "ID {user_id} {{json}} {plan} {currency} {po_status}"}, f)
+            original_catalog = main.CATALOG
+            main.CATALOG = TranslationCatalog(main.TRANSLATIONS, default_lang="ru", locales_dir=locales_dir)
+            main._RENDER_CACHE.clear()
+            try:
+                session = SimpleNamespace(
+                    user_id=42,
+                    profile={"language": "de", "plan": "{vip}", "currency": "EUR"},
+                    has_credentials=False,
+                    get_state=lambda key, default=None: default,
+                )
+                first, _ = main.render_screen(session=session, screen="home")
+                second, _ = main.render_screen(session=session, screen="home")
+            finally:
+                main.CATALOG = original_catalog
+                main._RENDER_CACHE.clear()
+        if not first.endswith(f"ID 42 {{json}} {{vip}} EUR {main.tr('ru', 'po_not_set')}") or second != first:
+            print_error(f"Экран из кэша отрисован неверно: {first!r}")
+            return False
+        print_success("render_screen: {{ }} из перевода и { } в тарифе не ломают подстановку полей профиля")
+
+        # Переполнение кэша экранов вытесняет давно использованный экран, а не весь кэш
+        original_max = main._RENDER_CACHE_MAX
+        main._RENDER_CACHE_MAX = 2
+        main._RENDER_CACHE.clear()
+        try:
+            session = SimpleNamespace(
+                user_id=42,
+                profile={"language": "ru"},
+                has_credentials=False,
+                get_state=lambda key, default=None: default,
+            )
+            for screen in ("home", "settings", "home", "menu"):
+                main.render_screen(session=session, screen=screen)
+            cached_screens = [key[0] for key in main._RENDER_CACHE]
+        finally:
+            main._RENDER_CACHE_MAX = original_max
+            main._RENDER_CACHE.clear()
+        if cached_screens != ["home", "menu"]:
+            print_error(f"Кэш экранов при переполнении: {cached_screens}")
+            return False
+        print_success("Переполненный кэш экранов вытесняет давно использованный экран (LRU)")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования каталога переводов: {e}")
+        return False
+
+@on_temp_db
+def test_ui_edit_mode():
+    """Тест 14: Режим edit — правка UI-сообщения на месте вместо delete + send."""
+    print_header("ТЕСТ 14: UI_MESSAGE_MODE=edit (вызовы Bot API на клик)")
+
+    try:
+        import asyncio
+        from types import SimpleNamespace
+        from telegram.error import BadRequest
+        import main
+        import user_db_handler as db
+        from outbound import OutboundScheduler
+
+        test_user_id = 999999994
+
+        class FakeBot:
+            def __init__(self):
+                self.next_id = 200
+                self.calls = []
+                self.fail_edits = 0
+
+            async def send_message(self, **kwargs):
+                self.calls.append("send_message")
+                self.next_id += 1
+                return SimpleNamespace(message_id=self.next_id)
+
+            async def delete_message(self, **kwargs):
+                self.calls.append("delete_message")
+                return True
+
+            async def edit_message_text(self, **kwargs):
+                self.calls.append("edit_message_text")
+                if self.fail_edits:
+                    self.fail_edits -= 1
+                    raise BadRequest("Message to edit not found")
+                return True
+
+            async def edit_message_reply_markup(self, **kwargs):
+                self.calls.append("edit_message_reply_markup")
+                return True
+
+            async def answer_callback_query(self, **kwargs):
+                self.calls.append("answer_callback_query")
+                return True
+
+        bot = FakeBot()
+        context = SimpleNamespace(bot=bot)
+
+        async def click(data):
+            message = SimpleNamespace(chat_id=test_user_id, message_id=bot.next_id)
+            query = SimpleNamespace(id=f"cq-{data}", from_user=SimpleNamespace(id=test_user_id), message=message, data=data)
+            await main._track_interaction(main.callback_router)(SimpleNamespace(callback_query=query), context)
+
+        clicks = ("nav:menu", "nav:settings", "nav:back", "nav:home")
+
+        async def run(mode):
+            main.UI_MESSAGE_MODE = mode
+            await db.reset_user_data(test_user_id)
+            await click("nav:home")
+            main._UI_API_STATS.reset()
+            bot.calls.clear()
+            for data in clicks:
+                await click(data)
+            return list(bot.calls), main.get_ui_api_stats()
+
+        async def fallback():
+            bot.fail_edits = 1
+            bot.calls.clear()
+            await click("nav:menu")
+            return list(bot.calls)
+
+        async def scenario():
+            try:
+                replace_calls, replace_stats = await run("replace")
+                edit_calls, edit_stats = await run("edit")
+                fallback_calls = await fallback()
+            finally:
+                main.UI_MESSAGE_MODE = "replace"
+            return replace_calls, replace_stats, edit_calls, edit_stats, fallback_calls
+
+        db.init_db()
+        original_outbound = main.OUTBOUND
+        main.OUTBOUND = OutboundScheduler(chat_rate=1000, chat_burst=100)
+        try:
+            replace_calls, replace_stats, edit_calls, edit_stats, fallback_calls = asyncio.run(scenario())
+        finally:
+            main.OUTBOUND = original_outbound
+
+        print_success(
+            f"replace: {replace_stats['calls_per_interaction']} вызовов/клик, "
+            f"edit: {edit_stats['calls_per_interaction']} вызовов/клик"
+        )
+        if "send_message" in edit_calls or "delete_message" in edit_calls:
+            print_error(f"В режиме edit были delete/send: {edit_calls}")
+            return False
+        if edit_stats["calls_per_interaction"] >= replace_stats["calls_per_interaction"]:
+            print_error("Режим edit не уменьшил число вызовов Bot API")
+            return False
+        if fallback_calls[-2:] != ["delete_message", "send_message"]:
+            print_error(f"Нет fallback на delete + send при ошибке правки: {fallback_calls}")
+            return False
+        print_success("Ошибка правки → delete + send")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования режима edit: {e}")
+        return False
+
+def test_outbound_scheduler():
+    """Тест 15: Планировщик исходящих вызовов — лимиты, приоритеты, RetryAfter, склейка удалений."""
+    print_header("ТЕСТ 15: Очередь исходящих вызовов Bot API")
+
+    try:
+        import asyncio
+        import time
+        from telegram.error import RetryAfter
+        from outbound import PRIORITY_BROADCAST, PRIORITY_UI, OutboundScheduler
+
+        class TimingBot:
+            """Фейковый бот: пишет (метод, chat_id, время вызова)."""
+
+            def __init__(self, retry_after=None):
+                self.calls = []
+                self.retry_after = retry_after
+
+            async def _record(self, method, **kwargs):
+                self.calls.append((method, kwargs["chat_id"], time.monotonic(), kwargs.get("text")))
+                if self.retry_after is not None:
+                    retry_after, self.retry_after = self.retry_after, None
+                    raise RetryAfter(retry_after)
+                await asyncio.sleep(0)
+                return True
+
+            async def send_message(self, **kwargs):
+                return await self._record("send_message", **kwargs)
+
+            async def delete_message(self, **kwargs):
+                return await self._record("delete_message", **kwargs)
+
+        async def global_rate():
+            bot = TimingBot()
+            out = OutboundScheduler(global_rate=100, global_burst=5, chat_rate=1000, chat_burst=10)
+            start = time.monotonic()
+            await asyncio.gather(*[out.call(bot, "send_message", chat_id=i, text="x") for i in range(25)])
+            return time.monotonic() - start
+
+        async def chat_rate():
+            bot = TimingBot()
+            out = OutboundScheduler(global_rate=1000, global_burst=100, chat_rate=20, chat_burst=1)
+            await asyncio.gather(*[out.call(bot, "send_message", chat_id=1, text=str(i)) for i in range(5)])
+            times = [t for _, _, t, _ in bot.calls]
+            order = [text for _, _, _, text in bot.calls]
+            return min(b - a for a, b in zip(times, times[1:])), order
+
+        async def priorities():
+            bot = TimingBot()
+            out = OutboundScheduler(global_rate=50, global_burst=1, chat_rate=1000, chat_burst=10)
+            broadcasts = [
+                asyncio.ensure_future(out.call(bot, "send_message", chat_id=100 + i, text="b", priority=PRIORITY_BROADCAST))
+                for i in range(10)
+            ]
+            await asyncio.sleep(0.05)
+            await out.call(bot, "send_message", chat_id=1, text="ui", priority=PRIORITY_UI)
+            await asyncio.gather(*broadcasts)
+            return [text for _, _, _, text in bot.calls].index("ui")
+
+        async def retry_after():
+            bot = TimingBot(retry_after=0.2)
+            out = OutboundScheduler(global_rate=1000, global_burst=100, chat_rate=1000, chat_burst=10)
+            start = time.monotonic()
+            await out.call(bot, "send_message", chat_id=1, text="x")
+            return time.monotonic() - start, len(bot.calls), out.stats()["retries"]
+
+        async def coalesce():
+            bot = TimingBot()
+            out = OutboundScheduler()
+            submitted = []
+            await asyncio.gather(
+                *[out.delete_message(bot, 1, 55, on_submit=lambda: submitted.append(1)) for _ in range(3)]
+            )
+            await out.delete_message(bot, 1, 55, on_submit=lambda: submitted.append(1))
+            return len(bot.calls), out.stats()["coalesced_deletes"], len(submitted)
+
+        async def backlog():
+            # 5000 рассылок в один чат, упёршийся в лимит: выбор задания другого чата их не перебирает
+            bot = TimingBot()
+            out = OutboundScheduler(global_rate=1e6, global_burst=1e6, chat_rate=0.001, chat_burst=1)
+            for i in range(5000):
+                out._submit(bot, "send_message", 1, {"text": str(i)}, PRIORITY_BROADCAST)
+            first, _ = out._next_job()
+            start = time.perf_counter()
+            picked = []
+            for chat_id in range(2, 2002):
+                out._submit(bot, "send_message", chat_id, {"text": "x"}, PRIORITY_BROADCAST)
+                job, _ = out._next_job()
+                picked.append(job.chat_id if job else None)
+            elapsed = time.perf_counter() - start
+            await out.stop()
+            return first.chat_id, picked == list(range(2, 2002)), elapsed
+
+        elapsed = asyncio.run(global_rate())
+        print_success(f"Глобальный лимит: 25 вызовов при 100/с (burst 5) за {elapsed * 1000:.0f} мс")
+        if elapsed < 0.18:
+            print_error("Глобальный лимит не соблюдён")
+            return False
+
+        min_gap, order = asyncio.run(chat_rate())
+        print_success(f"Лимит чата: минимальный интервал {min_gap * 1000:.0f} мс при 20/с")
+        if min_gap < 0.04 or order != ["0", "1", "2", "3", "4"]:
+            print_error(f"Лимит/порядок чата нарушен: {min_gap:.3f}с, {order}")
+            return False
+
+        ui_position = asyncio.run(priorities())
+        print_success(f"UI-ответ отправлен {ui_position + 1}-м, раньше хвоста рассылки")
+        if ui_position > 5:
+            print_error("Полоса UI не обогнала рассылку")
+            return False
+
+        elapsed, calls, retries = asyncio.run(retry_after())
+        print_success(f"RetryAfter: повтор через {elapsed * 1000:.0f} мс, вызовов {calls}")
+        if calls != 2 or retries != 1 or elapsed < 0.18:
+            print_error("RetryAfter не обработан")
+            return False
+
+        calls, coalesced, submitted = asyncio.run(coalesce())
+        print_success(f"4 удаления одного сообщения → {calls} вызов(а) API")
+        if calls != 1 or coalesced != 3 or submitted != 1:
+            print_error(f"Удаления не склеены: вызовов {calls}, склеено {coalesced}, on_submit {submitted}")
+            return False
+
+        first_chat, in_order, elapsed = asyncio.run(backlog())
+        print_success(f"Хвост 5000 заданий в ожидающем чате: 2000 выборов других чатов за {elapsed * 1000:.0f} мс")
+        if first_chat != 1 or not in_order or elapsed > 0.5:
+            print_error("Выбор следующего задания перебирает весь хвост очереди")
+            return False
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования очереди исходящих вызовов: {e}")
+        return False
+
+def test_signal_client():
+    """Тест 16: SignalClient — вставки вне event loop, лимит параллельности, таймаут, метрики."""
+    print_header("ТЕСТ 16: Асинхронный клиент signal_requests")
+
+    try:
+        import asyncio
+        import threading
+        import time
+        from types import SimpleNamespace
+        from signals import SignalClient
+
+        class FakeSupabase:
+            """Синхронный клиент: execute() блокирует поток на delay секунд."""
+
+            def __init__(self, delay):
+                self.delay = delay
+                self.rows = []
+                self.active = 0
+                self.max_active = 0
+                self.lock = threading.Lock()
+
+            def table(self, name):
+                return self
+
+            def upsert(self, rows, **kwargs):
+                return SimpleNamespace(execute=lambda: self.execute(rows))
+
+            def execute(self, rows):
+                with self.lock:
+                    self.active += 1
+                    self.max_active = max(self.max_active, self.active)
+                time.sleep(self.delay)
+                with self.lock:
+                    self.active -= 1
+                    self.rows.extend(rows)
+                return rows
+
+        async def burst():
+            fake = FakeSupabase(delay=0.05)
+            client = SignalClient(fake, max_concurrency=4, timeout=2)
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.005)
+                    ticks += 1
+
+            tick_task = asyncio.create_task(ticker())
+            start = time.perf_counter()
+            await asyncio.gather(*[client.upsert_requests([{"user_id": i, "request_type": "long"}]) for i in range(12)])
+            elapsed = time.perf_counter() - start
+            tick_task.cancel()
+            client.close()
+            return fake, client.stats(), ticks, elapsed
+
+        async def timeout():
+            fake = FakeSupabase(delay=0.3)
+            client = SignalClient(fake, max_concurrency=1, timeout=0.05)
+            try:
+                outcomes = []
+                for user_id in (1, 2):
+                    try:
+                        await client.upsert_requests([{"user_id": user_id, "request_type": "short"}])
+                        outcomes.append("ok")
+                    except asyncio.TimeoutError:
+                        outcomes.append("timeout")
+                during = client.stats()
+                # Брошенная вставка дорабатывает в потоке и освобождает слот
+                await asyncio.sleep(0.4)
+                return outcomes, during, client.stats(), fake
+            finally:
+                client.close()
+
+        fake, stats, ticks, elapsed = asyncio.run(burst())
+        print_success(
+            f"12 вставок по 50 мс за {elapsed * 1000:.0f} мс, параллельно max {fake.max_active}, "
+            f"event loop тикал {ticks} раз"
+        )
+        if len(fake.rows) != 12 or fake.max_active > 4:
+            print_error("Лимит параллельности нарушен или строки потеряны")
+            return False
+        if ticks < 10:
+            print_error("Event loop блокировался на время вставок")
+            return False
+        print_success(f"Метрики: {stats['latency_ms']}")
+
+        outcomes, during, after, fake = asyncio.run(timeout())
+        if outcomes != ["timeout", "timeout"] or during["timeouts"] != 2:
+            print_error(f"Таймаут вставки не сработал: {outcomes}, {during}")
+            return False
+        print_success("Таймаут вставки сработал и учтён в метриках")
+        if during["abandoned"] != 1 or during["abandoned_running"] != 1 or fake.max_active != 1:
+            print_error(f"Брошенная вставка не держит слот: {during}, параллельно {fake.max_active}")
+            return False
+        if after["abandoned_running"] != 0 or [row["user_id"] for row in fake.rows] != [1]:
+            print_error(f"После завершения потока: {after}, строки {fake.rows}")
+            return False
+        print_success("Брошенная по таймауту вставка держит слот до конца, следующая ждёт слот, а не копится в пуле")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования клиента signal_requests: {e}")
+        return False
+
+@on_temp_db
+def test_signal_outbox():
+    """Тест 17: signal_outbox — локальный commit, пакетный upsert, повтор после сбоя без дублей."""
+    print_header("ТЕСТ 17: Outbox запросов сигналов")
+
+    try:
+        import asyncio
+        import time
+        from types import SimpleNamespace
+        import user_db_handler as db
+        from signals import SignalClient, SignalOutbox
+
+        class FakeSupabase:
+            """signal_requests с UNIQUE(idempotency_key); первые fail_calls вызовов падают."""
+
+            def __init__(self, fail_calls=0):
+                self.rows = {}
+                self.batches = []
+                self.fail_calls = fail_calls
+
+            def table(self, name):
+                return self
+
+            def upsert(self, rows, **kwargs):
+                return SimpleNamespace(execute=lambda: self._upsert(rows, kwargs))
+
+            def _upsert(self, rows, kwargs):
+                self.batches.append(len(rows))
+                if self.fail_calls:
+                    self.fail_calls -= 1
+                    raise RuntimeError("supabase unavailable")
+                assert kwargs.get("on_conflict") == "idempotency_key" and kwargs.get("ignore_duplicates")
+                for row in rows:
+                    self.rows.setdefault(row["idempotency_key"], row)
+
+        async def burst():
+            fake = FakeSupabase()
+            outbox = SignalOutbox(SignalClient(fake), batch_size=100)
+            start = time.perf_counter()
+            await asyncio.gather(*[outbox.submit(900000 + i, "long") for i in range(50)])
+            enqueue_ms = (time.perf_counter() - start) * 1000 / 50
+            sent = await outbox.flush()
+            return fake, sent, enqueue_ms
+
+        async def retry():
+            fake = FakeSupabase(fail_calls=1)
+            outbox = SignalOutbox(SignalClient(fake), backoff_base=0.05, backoff_max=0.05)
+            key = (await outbox.submit(900100, "short")).idempotency_key
+            first = await outbox.flush()
+            await asyncio.sleep(0.08)
+            second = await outbox.flush()
+            # Повторная отправка той же строки (например, сбой после удалённого commit) дублей не создаёт
+            await outbox.client.upsert_requests([{"idempotency_key": key, "user_id": 900100}])
+            return fake, first, second
+
+        db.init_db()
+        fake, sent, enqueue_ms = asyncio.run(burst())
+        print_success(f"50 запросов: {enqueue_ms:.2f} мс на локальный commit, в Supabase ушло пачек: {len(fake.batches)}")
+        if sent != 50 or len(fake.rows) != 50 or len(fake.batches) != 1:
+            print_error(f"Пакетная отправка не сработала: sent={sent}, batches={fake.batches}")
+            return False
+
+        fake, first, second = asyncio.run(retry())
+        print_success(f"Сбой Supabase → повтор после backoff: {first} → {second} отправлено")
+        if first != 0 or second != 1 or len(fake.rows) != 1:
+            print_error("Повтор после сбоя не сработал или создал дубль")
+            return False
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования outbox сигналов: {e}")
+        return False
+
+@on_temp_db
+def test_signal_dedup():
+    """Тест 18: Повторные запросы сигнала в окне cooldown не создают новых строк."""
+    print_header("ТЕСТ 18: Дедупликация запросов сигналов")
+
+    try:
+        import asyncio
+        import signals
+        import user_db_handler as db
+        from signals import SignalClient, SignalDeduplicator, SignalOutbox
+
+        now = [1000.0]
+        user_id = 900200
+
+        async def scenario():
+            dedup = SignalDeduplicator(cooldown=30, clock=lambda: now[0])
+            outbox = SignalOutbox(SignalClient(object()), dedup=dedup)
+            before = db.get_signal_outbox_stats()["pending"]
+            taps = await asyncio.gather(*[outbox.submit(user_id, "latest_signal") for _ in range(5)])
+            other = await outbox.submit(user_id, "long")
+            now[0] += 31
+            after_cooldown = await outbox.submit(user_id, "latest_signal")
+            created = db.get_signal_outbox_stats()["pending"] - before
+            return taps, other, after_cooldown, created, dedup.stats()
+
+        async def cancelled_first():
+            # Первый отправитель отменён, пока дубликат ждёт: дубликат получает обычную ошибку
+            outbox = SignalOutbox(SignalClient(object()), dedup=SignalDeduplicator(cooldown=30, clock=lambda: now[0]))
+            started = asyncio.Event()
+            original = signals.enqueue_signal_request
+
+            async def stuck(*args):
+                started.set()
+                await asyncio.sleep(10)
+
+            signals.enqueue_signal_request = stuck
+            try:
+                first = asyncio.create_task(outbox.submit(user_id, "short"))
+                await started.wait()
+                duplicate = asyncio.create_task(outbox.submit(user_id, "short"))
+                await asyncio.sleep(0)
+                first.cancel()
+                outcome = (await asyncio.gather(duplicate, return_exceptions=True))[0]
+            finally:
+                signals.enqueue_signal_request = original
+            retry = await outbox.submit(user_id, "short")
+            return outcome, retry
+
+        db.init_db()
+        taps, other, after_cooldown, created, stats = asyncio.run(scenario())
+        outcome, retry = asyncio.run(cancelled_first())
+
+        keys = {t.idempotency_key for t in taps}
+        print_success(f"5 нажатий → запросов: {len(keys)}, подавлено дублей: {stats['suppressed']}")
+        if len(keys) != 1 or sum(t.duplicate for t in taps) != 4:
+            print_error("Повторные нажатия создали новые запросы")
+            return False
+        if other.duplicate or after_cooldown.duplicate:
+            print_error("Другой тип запроса или запрос после окна ошибочно склеены")
+            return False
+        if created != 3 or stats["suppressed_by_type"] != {"latest_signal": 4}:
+            print_error(f"Неверный учёт: создано {created}, счётчики {stats}")
+            return False
+        print_success("Другой тип и запрос после cooldown создают новые строки")
+
+        if isinstance(outcome, asyncio.CancelledError) or not isinstance(outcome, Exception) or retry.duplicate:
+            print_error(f"Отмена первого запроса: дубликат получил {outcome!r}, повтор duplicate={retry.duplicate}")
+            return False
+        print_success("Отмена первого запроса: дубликат получил обычную ошибку, повторное нажатие создаёт запрос")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования дедупликации сигналов: {e}")
+        return False
+
+@on_temp_db
+def test_signal_results():
+    """Тест 19: Приём результатов сигналов (POST /signals/results) и пакетная доставка."""
+    print_header("ТЕСТ 19: Доставка результатов сигналов")
+
+    try:
+        import asyncio
+        import uuid
+        from fastapi.testclient import TestClient
+        from telegram.error import Forbidden, TimedOut
+        import main
+        import user_db_handler as db
+        from signals import SignalDeduplicator, SignalResultDispatcher
+
+        run_id = uuid.uuid4().hex[:8]
+        base_user = 900300
+        results = [
+            {"result_id": f"{run_id}-{i}", "user_id": base_user + i, "request_type": "long", "text": f"📈 signal {i}"}
+            for i in range(20)
+        ]
+
+        client = TestClient(main.api_app)
+        old_token = main.RESULTS_TOKEN
+        main.RESULTS_TOKEN = ""
+        try:
+            disabled = client.post("/signals/results", json={"results": results}).status_code
+            main.RESULTS_TOKEN = "secret"
+            unauthorized = client.post("/signals/results", json={"results": results}, headers={"X-Results-Token": "nope"}).status_code
+            first = client.post("/signals/results", json={"results": results}, headers={"X-Results-Token": "secret"})
+            replay = client.post("/signals/results", json={"results": results[:5]}, headers={"X-Results-Token": "secret"})
+        finally:
+            main.RESULTS_TOKEN = old_token
+
+        print_success(f"Без токена: {disabled}, неверный токен: {unauthorized}, пачка: {first.status_code} {first.json()}")
+        if disabled != 503 or unauthorized != 401 or first.status_code != 202 or first.json()["accepted"] != 20:
+            print_error("Неверная авторизация/приём пачки")
+            return False
+        if replay.json()["duplicates"] != 5:
+            print_error(f"Повторная пачка не распознана как дубли: {replay.json()}")
+            return False
+
+        blocked_user, flaky_user = base_user + 3, base_user + 7
+        sent = []
+
+        async def send(user_id, text):
+            if user_id == blocked_user:
+                raise Forbidden("bot was blocked by the user")
+            if user_id == flaky_user:
+                raise TimedOut()
+            sent.append(user_id)
+            return True
+
+        async def scenario():
+            dedup = SignalDeduplicator(cooldown=60)
+            future, _ = dedup.claim(base_user, "long")
+            future.set_result("k")
+            dispatcher = SignalResultDispatcher(dedup=dedup, batch_size=1000, retry_delay=0)
+            before = db.get_signal_delivery_stats()
+            batch = await dispatcher.deliver_once(send)
+            after = db.get_signal_delivery_stats()
+            _, duplicate = dedup.claim(base_user, "long")
+            return batch, before, after, duplicate
+
+        batch, before, after, duplicate = asyncio.run(scenario())
+        delivered = after["delivered"] - before["delivered"]
+        print_success(f"Пачка {batch}: доставлено {delivered}, к повтору {after['pending']}, недоставляемых {after['failed'] - before['failed']}")
+        if delivered != 18 or after["failed"] - before["failed"] != 1 or after["pending"] != 1:
+            print_error("Неверное состояние доставки")
+            return False
+        if duplicate:
+            print_error("После доставки запрос пользователя не снят с учёта дедупликации")
+            return False
+        print_success("Доставленный результат освобождает окно повторного запроса")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования доставки результатов: {e}")
+        return False
+
+@on_temp_db
+def test_health_monitor():
+    """Тест 20: /health читает кэш фонового монитора, /health/deep проверяет по запросу."""
+    print_header("ТЕСТ 20: Фоновый монитор здоровья")
+
+    try:
+        import asyncio
+        import time
+        from fastapi.testclient import TestClient
+        import main
+        from health import HealthMonitor
+
+        calls = {"supabase": 0}
+
+        async def supabase_probe():
+            calls["supabase"] += 1
+            await asyncio.sleep(0.01)
+
+        async def slow_probe():
+            await asyncio.sleep(0.5)
+
+        monitor = HealthMonitor(timeout=0.1)
+        monitor.add_probe("supabase", supabase_probe)
+        monitor.add_probe("sqlite_write", main.check_write_latency)
+        monitor.add_probe("telegram", slow_probe)
+
+        old_health = main.HEALTH
+        main.HEALTH = monitor
+        try:
+            client = TestClient(main.api_app)
+            start = time.perf_counter()
+            for _ in range(200):
+                cached = client.get("/health").json()
+            per_hit_ms = (time.perf_counter() - start) * 1000 / 200
+            probes_from_health = calls["supabase"]
+            deep = client.get("/health/deep").json()
+            after_deep = client.get("/health").json()
+        finally:
+            main.HEALTH = old_health
+
+        print_success(f"/health: {per_hit_ms:.2f} мс на запрос, проверок Supabase: {probes_from_health}")
+        if probes_from_health != 0 or cached["checks"]["supabase"]["status"] != "unknown":
+            print_error("/health выполняет проверки вместо чтения кэша")
+            return False
+        if calls["supabase"] != 1 or deep["supabase"] != "connected" or deep["checks"]["sqlite_write"]["status"] != "ok":
+            print_error(f"/health/deep не выполнил проверки: {deep['checks']}")
+            return False
+        if deep["checks"]["telegram"]["status"] != "error" or deep["status"] != "degraded":
+            print_error("Таймаут проверки не учтён")
+            return False
+        if after_deep["checks"] != deep["checks"] or "outbound" not in deep:
+            print_error("Кэш не обновлён после /health/deep")
+            return False
+        if set(deep["signal_outbox"].get("rows", {})) != {"pending", "sent", "failed"}:
+            print_error(f"/health/deep без размеров outbox: {deep['signal_outbox']}")
+            return False
+        print_success(f"/health/deep: sqlite_write {deep['checks']['sqlite_write']['latency_ms']} мс, telegram — таймаут")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования монитора здоровья: {e}")
+        return False
+
+@on_temp_db
+def test_credentials_batch():
+    """Тест 21: POST /get_po_credentials/batch — один IN-запрос, NDJSON для больших пачек, лимит."""
+    print_header("ТЕСТ 21: Пакетная выдача учетных данных")
+
+    try:
+        import asyncio
+        import json
+        from fastapi.testclient import TestClient
+        import main
+        import user_db_handler as db
+
+        base_user = 910000
+        users = [base_user + i for i in range(700)]
+
+        async def seed():
+            await asyncio.gather(*[db.save_encrypted_credentials(uid, f"l{uid}", f"p{uid}") for uid in users])
+
+        db.init_db()
+        asyncio.run(seed())
+        client = TestClient(main.api_app)
+        small_ids = users[:10] + [1]
+        reads_before = db.get_pool_stats()["reads"]
+        small = client.post("/get_po_credentials/batch", json={"user_ids": small_ids, "request_source": "trading_core"})
+        small_reads = db.get_pool_stats()["reads"] - reads_before
+        big = client.post("/get_po_credentials/batch", json={"user_ids": users + [2], "request_source": "trading_core"})
+        forbidden = client.post("/get_po_credentials/batch", json={"user_ids": [1], "request_source": "unknown"})
+        too_many = client.post(
+            "/get_po_credentials/batch",
+            json={"user_ids": list(range(main.CREDENTIALS_BATCH_MAX + 1)), "request_source": "trading_core"},
+        )
+
+        body = small.json()
+        print_success(f"11 user_id → найдено {len(body['credentials'])}, нет {body['missing']}, чтений БД: {small_reads}")
+        if len(body["credentials"]) != 10 or body["missing"] != [1] or small_reads != 1:
+            print_error("Неверный ответ маленькой пачки")
+            return False
+        if body["credentials"][0]["login_enc"] != f"l{users[0]}":
+            print_error("Ciphertext не совпадает")
+            return False
+
+        lines = [json.loads(line) for line in big.text.splitlines()]
+        print_success(f"701 user_id → {big.headers['content-type']}, строк: {len(lines)}")
+        if not big.headers["content-type"].startswith("application/x-ndjson") or len(lines) != 701:
+            print_error("Большая пачка не отдана потоком NDJSON")
+            return False
+        if lines[-1] != {"status": "done", "found": 700, "missing": [2]}:
+            print_error(f"Неверная итоговая строка: {lines[-1]}")
+            return False
+        if forbidden.status_code != 403 or too_many.status_code != 413:
+            print_error(f"Не сработали проверки источника/лимита: {forbidden.status_code}, {too_many.status_code}")
+            return False
+        print_success("Неизвестный источник → 403, превышение лимита → 413")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования пакетной выдачи: {e}")
+        return False
+
+@on_temp_db
+def test_credentials_changes():
+    """Тест 22: /credentials/changes — курсорная лента изменений кредов с tombstones."""
+    print_header("ТЕСТ 22: Лента изменений учетных данных")
+
+    try:
+        import asyncio
+        import json
+        from fastapi.testclient import TestClient
+        import main
+        import user_db_handler as db
+
+        user_a, user_b, user_c, user_d = 920001, 920002, 920003, 920004
+        past = "1999-01-01T00:00:00Z"
+
+        async def seed():
+            for uid in (user_a, user_b, user_c):
+                await db.save_encrypted_credentials(uid, f"l{uid}", f"p{uid}")
+            await db.reset_user_data(user_c)
+
+            # Сдвигаем изменения в прошлое, за горизонт ленты
+            def _backdate(conn):
+                conn.execute(
+                    "UPDATE user_credentials SET updated_at = ? WHERE user_id IN (?, ?)", (past, user_a, user_b)
+                )
+                conn.execute("UPDATE credential_tombstones SET deleted_at = ? WHERE user_id = ?", (past, user_c))
+
+            await db._write(_backdate)
+            # Свежая запись — моложе горизонта, в ленту пока не попадает
+            await db.save_encrypted_credentials(user_d, "ld", "pd")
+
+        def fetch(**params):
+            response = client.get("/credentials/changes", params={"request_source": "trading_core", **params})
+            lines = [json.loads(line) for line in response.text.splitlines()]
+            return lines[:-1], lines[-1]
+
+        db.init_db()
+        asyncio.run(seed())
+        client = TestClient(main.api_app)
+        page1, tail1 = fetch(since=past, limit=2)
+        page2, tail2 = fetch(cursor=tail1["next_cursor"], limit=1)
+        page3, _ = fetch(cursor=tail2["next_cursor"], limit=10000)
+        bad = client.get("/credentials/changes", params={"request_source": "trading_core", "cursor": "garbage"})
+
+        print_success(f"Страница 1: {[(c['user_id'], c['kind']) for c in page1]}, has_more={tail1['has_more']}")
+        if [(c["user_id"], c["kind"]) for c in page1] != [(user_a, "upsert"), (user_b, "upsert")] or not tail1["has_more"]:
+            print_error("Неверная первая страница")
+            return False
+        if page1[0]["login_enc"] != f"l{user_a}":
+            print_error("В ленте нет ciphertext")
+            return False
+        print_success(f"Страница 2 (по курсору): {[(c['user_id'], c['kind']) for c in page2]}")
+        if [(c["user_id"], c["kind"]) for c in page2] != [(user_c, "delete")]:
+            print_error("Tombstone из reset_user_data не попал в ленту")
+            return False
+        if any(c["user_id"] == user_d for c in page3):
+            print_error("Изменение моложе горизонта попало в ленту")
+            return False
+        if bad.status_code != 400:
+            print_error("Битый курсор не отклонён")
+            return False
+        print_success("Изменения моложе горизонта не отдаются, битый курсор → 400")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования ленты изменений: {e}")
+        return False
+
+def test_cipher_registry():
+    """Тест 23: Реестр шифров — Fernet создаётся один раз, reload_cipher(), encrypt_many/decrypt_many."""
+    print_header("ТЕСТ 23: Реестр шифров crypto_utils")
+
+    try:
+        from cryptography.fernet import Fernet
+        import crypto_utils
+
+        old_key = os.environ.get("ENCRYPTION_KEY")
+        os.environ["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+        try:
+            crypto_utils.reload_cipher()
+            cipher = crypto_utils.get_cipher()
+            if crypto_utils.get_cipher() is not cipher:
+                print_error("Fernet создаётся заново на каждый вызов")
+                return False
+            print_success("Fernet переиспользуется между вызовами")
+
+            values = ["login", "password", "Тест 🔐"]
+            encrypted = crypto_utils.encrypt_many(values)
+            if None in encrypted or crypto_utils.decrypt_many(encrypted) != values:
+                print_error("encrypt_many/decrypt_many: данные не совпадают")
+                return False
+            if crypto_utils.decrypt_many([encrypted[0], "garbage"]) != ["login", None]:
+                print_error("Ошибка одного элемента должна давать None только на его месте")
+                return False
+            print_success("encrypt_many/decrypt_many: пачка и ошибка элемента")
+
+            os.environ["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+            if crypto_utils.decrypt_data(encrypted[0]) != "login":
+                print_error("Смена env без reload_cipher() не должна влиять на шифр")
+                return False
+            crypto_utils.reload_cipher()
+            if crypto_utils.decrypt_data(encrypted[0]) is not None:
+                print_error("reload_cipher() не подхватил новый ключ")
+                return False
+            print_success("Новый ключ применяется только после reload_cipher()")
+
+            # /health без ключа: без ERROR-логов на каждый вызов, результат кэшируется до reload_cipher()
+            import logging
+
+            records = []
+            handler = logging.Handler()
+            handler.emit = records.append
+            crypto_utils.logger.addHandler(handler)
+            saved_keys = {name: os.environ.pop(name, None) for name in ("ENCRYPTION_KEYS", "ENCRYPTION_KEYS_OLD")}
+            try:
+                os.environ.pop("ENCRYPTION_KEY", None)
+                crypto_utils._CIPHER = None
+                crypto_utils._CONFIGURED = None
+                missing = [crypto_utils.is_encryption_configured() for _ in range(100)]
+                os.environ["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+                cached = crypto_utils.is_encryption_configured()
+                crypto_utils.reload_cipher()
+                reloaded = crypto_utils.is_encryption_configured()
+            finally:
+                crypto_utils.logger.removeHandler(handler)
+                for name, value in saved_keys.items():
+                    if value is not None:
+                        os.environ[name] = value
+            if any(missing) or records or cached or not reloaded:
+                print_error(f"is_encryption_configured: {set(missing)}, логов {len(records)}, {cached}, {reloaded}")
+                return False
+            print_success("is_encryption_configured(): без ключа — False без логов, кэш сбрасывает reload_cipher()")
+        finally:
+            if old_key is None:
+                os.environ.pop("ENCRYPTION_KEY", None)
+            else:
+                os.environ["ENCRYPTION_KEY"] = old_key
+            crypto_utils._CIPHER = None
+            crypto_utils._CONFIGURED = None
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования реестра шифров: {e}")
+        return False
+
+@on_temp_db
+def test_key_rotation():
+    """Тест 24: Ротация ключей — MultiFernet и возобновляемое перешифрование user_credentials."""
+    print_header("ТЕСТ 24: Ротация ключей шифрования")
+
+    try:
+        import asyncio
+        import uuid
+        from cryptography.fernet import Fernet
+        import crypto_utils
+        import user_db_handler as db
+
+        saved = {name: os.environ.get(name) for name in ("ENCRYPTION_KEY", "ENCRYPTION_KEYS", "ENCRYPTION_KEYS_OLD")}
+        old_key, new_key = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+        user_ids = [9_024_001 + i for i in range(5)]
+        job = f"reencrypt-test:{uuid.uuid4().hex}"
+        try:
+            os.environ.pop("ENCRYPTION_KEYS", None)
+            os.environ.pop("ENCRYPTION_KEYS_OLD", None)
+            os.environ["ENCRYPTION_KEY"] = old_key
+            crypto_utils.reload_cipher()
+
+            async def _seed():
+                for user_id in user_ids:
+                    login_enc, password_enc = crypto_utils.encrypt_many([f"login{user_id}", "pw"])
+                    await db.save_encrypted_credentials(user_id, login_enc, password_enc)
+                await db.save_encrypted_ssid(user_ids[0], crypto_utils.encrypt_data("ssid"))
+                placeholders = ",".join("?" * len(user_ids))
+                await db._write(
+                    lambda conn: conn.execute(
+                        f"UPDATE user_credentials SET updated_at = '2000-01-01T00:00:00Z' WHERE user_id IN ({placeholders})",
+                        user_ids,
+                    )
+                )
+
+            asyncio.run(_seed())
+
+            os.environ["ENCRYPTION_KEY"] = new_key
+            os.environ["ENCRYPTION_KEYS_OLD"] = old_key
+            crypto_utils.reload_cipher()
+            old_token = asyncio.run(db.get_encrypted_data_from_local_db(user_ids[0]))["login_enc"]
+            if crypto_utils.decrypt_data(old_token) != f"login{user_ids[0]}":
+                print_error("Старый ключ из ENCRYPTION_KEYS_OLD не расшифровывает данные")
+                return False
+            if Fernet(new_key.encode()).decrypt(crypto_utils.encrypt_data("x").encode()) != b"x":
+                print_error("Шифрование должно идти основным ключом")
+                return False
+            print_success("Расшифровка любым ключом, шифрование — основным")
+
+            first = asyncio.run(db.reencrypt_credentials(crypto_utils.rotate_many, job, chunk_size=2, pause=0, max_chunks=1))
+            checkpoint = db.get_job_checkpoint(job)
+            if first["status"] != "running" or not checkpoint or checkpoint["status"] != "running" or checkpoint["stats"]["chunks"] != 1:
+                print_error(f"Чекпоинт после первой порции некорректен: {first}, {checkpoint}")
+                return False
+            print_success(f"Прервано после 1 порции, чекпоинт user_id={checkpoint['cursor']}")
+
+            result = asyncio.run(db.reencrypt_credentials(crypto_utils.rotate_many, job, chunk_size=2, pause=0))
+            if result["status"] != "done" or result["chunks"] <= 1 or result["scanned"] < len(user_ids):
+                print_error(f"Задача не продолжила с чекпоинта: {result}")
+                return False
+
+            primary = Fernet(new_key.encode())
+            with db._pool().reader() as conn:
+                rows = conn.execute(
+                    f"SELECT * FROM user_credentials WHERE user_id IN ({','.join('?' * len(user_ids))})", user_ids
+                ).fetchall()
+            for row in rows:
+                if primary.decrypt(row["login_enc"].encode()) != f"login{row['user_id']}".encode():
+                    print_error(f"Строка {row['user_id']} не перешифрована основным ключом")
+                    return False
+                if row["updated_at"] <= "2000-01-01T00:00:00Z":
+                    print_error("updated_at перешифрованной строки не обновлён (лента изменений её не увидит)")
+                    return False
+            if primary.decrypt(rows[0]["ssid_enc"].encode()) != b"ssid":
+                print_error("ssid_enc не перешифрован")
+                return False
+            print_success(f"Перешифровано строк: {result['rotated']}, порций: {result['chunks']}, updated_at обновлён")
+
+            again = asyncio.run(db.reencrypt_credentials(crypto_utils.rotate_many, job, chunk_size=2, pause=0))
+            if again["status"] != "done" or again["chunks"] != result["chunks"]:
+                print_error("Завершённая задача не должна запускаться повторно")
+                return False
+            print_success("Завершённая задача повторно не проходит таблицу")
+
+            # Конфигурация только через ENCRYPTION_KEYS — /health видит ключи
+            import main
+            os.environ.pop("ENCRYPTION_KEY", None)
+            os.environ.pop("ENCRYPTION_KEYS_OLD", None)
+            os.environ["ENCRYPTION_KEYS"] = f"{new_key},{old_key}"
+            crypto_utils.reload_cipher()
+            if main._health_payload({})["encryption"] != "enabled":
+                print_error("ENCRYPTION_KEYS без ENCRYPTION_KEY: /health сообщает not_configured")
+                return False
+            print_success("/health: шифрование включено при ENCRYPTION_KEYS=\"new,old\"")
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            crypto_utils._CIPHER = None
+            crypto_utils._CONFIGURED = None
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования ротации ключей: {e}")
+        return False
+
+def test_crypto_pool():
+    """Тест 25: async-обёртки crypto_utils — шифрование в пуле потоков, параллельно, с метриками."""
+    print_header("ТЕСТ 25: Шифрование в пуле потоков")
+
+    try:
+        import asyncio
+        import threading
+        from cryptography.fernet import Fernet
+        import crypto_utils
+
+        old_key = os.environ.get("ENCRYPTION_KEY")
+        os.environ["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+        try:
+            crypto_utils.reload_cipher()
+
+            async def scenario():
+                loop_thread = threading.current_thread().name
+                worker = await crypto_utils._run("probe", lambda _: threading.current_thread().name, "x")
+                encrypted = await crypto_utils.encrypt_many_async(["login", "password"])
+                decrypted = await crypto_utils.decrypt_many_async(encrypted + ["garbage"])
+                return loop_thread, worker, encrypted, decrypted
+
+            loop_thread, worker, encrypted, decrypted = asyncio.run(scenario())
+            if worker == loop_thread or not worker.startswith("ui-crypto"):
+                print_error(f"Шифрование выполняется не в пуле: {worker}")
+                return False
+            print_success(f"Fernet выполняется в потоке пула ({worker}), не на event loop")
+
+            if None in encrypted or decrypted != ["login", "password", None]:
+                print_error(f"encrypt_many_async/decrypt_many_async: {encrypted}, {decrypted}")
+                return False
+            print_success("login и password шифруются параллельно, ошибка элемента — None")
+
+            stats = crypto_utils.get_crypto_stats()
+            if stats["encrypt"]["calls"] < 2 or stats["decrypt"]["errors"] < 1 or "work_ms" not in stats["encrypt"]:
+                print_error(f"Метрики не собраны: {stats}")
+                return False
+            print_success(
+                f"Метрики: encrypt p95 work={stats['encrypt']['work_ms']['p95']} мс, "
+                f"wait={stats['encrypt']['wait_ms']['p95']} мс"
+            )
+        finally:
+            if old_key is None:
+                os.environ.pop("ENCRYPTION_KEY", None)
+            else:
+                os.environ["ENCRYPTION_KEY"] = old_key
+            crypto_utils._CIPHER = None
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования пула шифрования: {e}")
+        return False
+
+def test_webhook_mode():
+    """Тест 26: webhook на api_app — проверка secret token и постановка апдейта в очередь Application."""
+    print_header("ТЕСТ 26: Webhook-режим")
+
+    try:
+        import asyncio
+        from types import SimpleNamespace
+        from fastapi.testclient import TestClient
+        import main
+
+        payload = {
+            "update_id": 424242,
+            "message": {
+                "message_id": 7,
+                "date": 1700000000,
+                "chat": {"id": 111, "type": "private"},
+                "from": {"id": 111, "is_bot": False, "first_name": "T"},
+                "text": "/start",
+            },
+        }
+        client = TestClient(main.api_app)
+        old_app, old_secret = main._WEBHOOK_APPLICATION, main.WEBHOOK_SECRET
+        queue: asyncio.Queue = asyncio.Queue()
+        try:
+            main._WEBHOOK_APPLICATION = None
+            if client.post(main.WEBHOOK_PATH, json=payload).status_code != 503:
+                print_error("Без активного webhook-режима эндпоинт должен отвечать 503")
+                return False
+
+            main._WEBHOOK_APPLICATION = SimpleNamespace(update_queue=queue, bot=None)
+            main.WEBHOOK_SECRET = "test-secret_26"
+            missing = client.post(main.WEBHOOK_PATH, json=payload)
+            wrong = client.post(main.WEBHOOK_PATH, json=payload, headers={"X-Telegram-Bot-Api-Secret-Token": "nope"})
+            if missing.status_code != 403 or wrong.status_code != 403 or not queue.empty():
+                print_error(f"Неверный secret token должен давать 403: {missing.status_code}, {wrong.status_code}")
+                return False
+            print_success("Без/с неверным secret token → 403, в очередь ничего не попало")
+
+            headers = {"X-Telegram-Bot-Api-Secret-Token": "test-secret_26"}
+            ok = client.post(main.WEBHOOK_PATH, json=payload, headers=headers)
+            bad = client.post(main.WEBHOOK_PATH, content=b"not json", headers=headers)
+            if ok.status_code != 200 or bad.status_code != 400 or queue.qsize() != 1:
+                print_error(f"Ответы: {ok.status_code}, {bad.status_code}, в очереди {queue.qsize()}")
+                return False
+            update = queue.get_nowait()
+            if update.update_id != 424242 or update.effective_message.text != "/start":
+                print_error("В очередь попал не тот апдейт")
+                return False
+            print_success("Валидный апдейт → 200 и Update в application.update_queue; битый JSON → 400")
+        finally:
+            main._WEBHOOK_APPLICATION, main.WEBHOOK_SECRET = old_app, old_secret
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования webhook-режима: {e}")
+        return False
+
+@on_temp_db
+def test_update_processor():
+    """Тест 27: PerUserUpdateProcessor — разные пользователи параллельно, один пользователь по очереди."""
+    print_header("ТЕСТ 27: Параллельная обработка апдейтов")
+
+    try:
+        import asyncio
+        from telegram import Update
+        from concurrency import PerUserUpdateProcessor
+        import user_db_handler as db
+
+        def make_update(update_id, user_id):
+            return Update.de_json(
+                {
+                    "update_id": update_id,
+                    "callback_query": {
+                        "id": str(update_id),
+                        "chat_instance": "ci",
+                        "data": "nav:menu",
+                        "from": {"id": user_id, "is_bot": False, "first_name": "T"},
+                    },
+                },
+                None,
+            )
+
+        user_a, user_b = 9_027_001, 9_027_002
+        events = []
+
+        async def handler(update, label, delay):
+            events.append(("start", label))
+            # Читаем nav_stack, «медленный» вызов, пишем — классическая гонка lost update
+            async with db.user_session(update.effective_user.id) as session:
+                stack = list(session.get_state("nav_stack", default=[]))
+                await asyncio.sleep(delay)
+                session.set_state("nav_stack", stack + [label])
+            events.append(("end", label))
+
+        async def scenario():
+            processor = PerUserUpdateProcessor(workers=4)
+            await processor.initialize()
+            jobs = [
+                (make_update(1, user_a), "a1", 0.05),
+                (make_update(2, user_a), "a2", 0.0),
+                (make_update(3, user_b), "b1", 0.0),
+                (make_update(4, user_a), "a3", 0.0),
+            ]
+            tasks = [asyncio.create_task(processor.process_update(u, handler(u, label, d))) for u, label, d in jobs]
+            await asyncio.gather(*tasks)
+            await processor.shutdown()
+            stack_a = await db.get_user_state(user_a, "nav_stack", default=[])
+            return processor.stats(), stack_a
+
+        db.init_db()
+        stats, stack_a = asyncio.run(scenario())
+
+        order_a = [label for kind, label in events if label.startswith("a")]
+        if order_a != ["a1", "a1", "a2", "a2", "a3", "a3"] or stack_a != ["a1", "a2", "a3"]:
+            print_error(f"Апдейты одного пользователя перемешались: {events}, nav_stack={stack_a}")
+            return False
+        print_success(f"Пользователь A: по очереди, nav_stack={stack_a}")
+
+        if events.index(("end", "b1")) > events.index(("end", "a1")):
+            print_error(f"Пользователь B ждал медленный апдейт A: {events}")
+            return False
+        print_success("Пользователь B обработан, пока A ждал медленный вызов")
+
+        if stats["processed"] != 4 or stats["pending"] != 0 or stats["keys"] != 0 or stats["max_key_depth"] != 3 or "wait_ms" not in stats:
+            print_error(f"Метрики некорректны: {stats}")
+            return False
+        print_success(f"Метрики: max глубина очереди пользователя {stats['max_key_depth']}, wait p95 {stats['wait_ms']['p95']} мс")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования параллельной обработки: {e}")
+        return False
+
+@on_temp_db
+def test_callback_coalescing():
+    """Тест 28: устаревшие клики отбрасываются без БД, из очереди переходов рендерится последний."""
+    print_header("ТЕСТ 28: Отсев устаревших и схлопывание callback-ов")
+
+    try:
+        import asyncio
+        from types import SimpleNamespace
+        from telegram import Update
+        from concurrency import PerUserUpdateProcessor
+        import main
+        import user_db_handler as db
+        from outbound import OutboundScheduler
+
+        test_user_id = 999999928
+
+        class FakeBot:
+            def __init__(self):
+                self.next_id = 500
+                self.calls = []
+                self.answers = []
+
+            async def send_message(self, **kwargs):
+                self.calls.append("send_message")
+                self.next_id += 1
+                return SimpleNamespace(message_id=self.next_id)
+
+            async def delete_message(self, **kwargs):
+                self.calls.append("delete_message")
+                return True
+
+            async def answer_callback_query(self, **kwargs):
+                self.calls.append("answer_callback_query")
+                self.answers.append(kwargs)
+                return True
+
+        bot = FakeBot()
+        context = SimpleNamespace(bot=bot)
+
+        async def click(data, message_id):
+            message = SimpleNamespace(chat_id=test_user_id, message_id=message_id)
+            query = SimpleNamespace(id=f"cq-{data}", from_user=SimpleNamespace(id=test_user_id), message=message, data=data)
+            await main.callback_router(SimpleNamespace(callback_query=query), context)
+
+        async def stale_scenario():
+            await db.reset_user_data(test_user_id)
+            await click("nav:home", bot.next_id)
+            old_id = bot.next_id
+            await click("nav:menu", old_id)
+            bot.calls.clear()
+            reads_before = db.get_pool_stats()["reads"]
+            stale_before = main._UI_API_STATS.stale_callbacks
+            await click("nav:plans", old_id)
+            in_memory = (list(bot.calls), db.get_pool_stats()["reads"] - reads_before)
+            main._LAST_UI_MESSAGE.clear()
+            bot.calls.clear()
+            await click("nav:plans", old_id)
+            after_restart = list(bot.calls)
+            screen = await db.get_user_state(test_user_id, "current_screen")
+            return in_memory, after_restart, main._UI_API_STATS.stale_callbacks - stale_before, screen
+
+        async def superseded_answer():
+            bot.calls.clear()
+            calls_before = main.OUTBOUND.stats()["calls"]
+            query = SimpleNamespace(
+                id="cq-1",
+                from_user=SimpleNamespace(id=test_user_id),
+                message=SimpleNamespace(chat_id=test_user_id),
+                get_bot=lambda: bot,
+            )
+            await main._answer_superseded(SimpleNamespace(callback_query=query))
+            return list(bot.calls), bot.answers[-1:], main.OUTBOUND.stats()["calls"] - calls_before
+
+        db.init_db()
+        original_outbound = main.OUTBOUND
+        main.OUTBOUND = OutboundScheduler(chat_rate=1000, chat_burst=100)
+        try:
+            (calls, reads), after_restart, stale, screen = asyncio.run(stale_scenario())
+            answer_calls, answers, outbound_calls = asyncio.run(superseded_answer())
+        finally:
+            main.OUTBOUND = original_outbound
+        answered_only = ["answer_callback_query"]
+        if calls != answered_only or reads or after_restart != answered_only or stale != 2 or screen != "menu":
+            print_error(f"Устаревший клик обработан: calls={calls}, reads={reads}, {after_restart}, stale={stale}, screen={screen}")
+            return False
+        print_success("Клик по старому сообщению: только ответ на callback, 0 чтений БД (после рестарта — по профилю)")
+
+        if answer_calls != ["answer_callback_query"] or answers != [{"callback_query_id": "cq-1"}] or outbound_calls != 1:
+            print_error(f"Ответ на перекрытый переход не прошёл через OUTBOUND: {answer_calls}, вызовов {outbound_calls}")
+            return False
+        print_success("Ответ на перекрытый переход идёт через очередь исходящих вызовов")
+
+        def make_update(update_id, data):
+            return Update.de_json(
+                {
+                    "update_id": update_id,
+                    "callback_query": {
+                        "id": str(update_id),
+                        "chat_instance": "ci",
+                        "data": data,
+                        "from": {"id": test_user_id, "is_bot": False, "first_name": "T"},
+                    },
+                },
+                None,
+            )
+
+        rendered, answered = [], []
+
+        async def handler(data, delay):
+            await asyncio.sleep(delay)
+            rendered.append(data)
+
+        async def on_superseded(update):
+            answered.append(update.callback_query.data)
+
+        async def coalesce_scenario():
+            processor = PerUserUpdateProcessor(workers=4, supersede=main._is_nav_callback, on_superseded=on_superseded)
+            clicks = [("nav:settings", 0.05), ("nav:menu", 0), ("set:lang:en", 0), ("nav:plans", 0), ("nav:back", 0), ("nav:help", 0)]
+            tasks = [
+                asyncio.create_task(processor.process_update(make_update(i, data), handler(data, delay)))
+                for i, (data, delay) in enumerate(clicks)
+            ]
+            await asyncio.gather(*tasks)
+            return processor.stats()
+
+        stats = asyncio.run(coalesce_scenario())
+        if rendered != ["nav:settings", "set:lang:en", "nav:back", "nav:help"] or sorted(answered) != ["nav:menu", "nav:plans"]:
+            print_error(f"Схлопывание некорректно: rendered={rendered}, answered={answered}")
+            return False
+        if stats["superseded"] != 2:
+            print_error(f"Счётчик superseded: {stats}")
+            return False
+        print_success(f"6 кликов → {len(rendered)} обработано, перекрытые переходы только отвечены: {answered}")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования схлопывания callback-ов: {e}")
+        return False
+
+@on_temp_db
+def test_packed_session():
+    """Тест 29: навигация — одна упакованная строка user_sessions, холодные ключи — в user_states."""
+    print_header("ТЕСТ 29: Упакованная навигация в user_sessions")
+
+    try:
+        import asyncio
+        import json
+        import user_db_handler as db
+
+        user_id = 9_029_001
+
+        def rows(table):
+            with db._pool().reader() as conn:
+                return conn.execute(f"SELECT * FROM {table} WHERE user_id = ?", (user_id,)).fetchall()
+
+        async def scenario():
+            await db.reset_user_data(user_id)
+            # Старый формат: навигация строками user_states
+            await db._write(lambda conn: db._ensure_user_row(conn, user_id, db._utcnow_iso()))
+            await db._write(
+                lambda conn: conn.executemany(
+                    "INSERT INTO user_states (user_id, key, value_json, updated_at) VALUES (?, ?, ?, '')",
+                    [(user_id, "nav_stack", json.dumps(["home"])), (user_id, "current_screen", json.dumps("menu"))],
+                )
+            )
+            async with db.user_session(user_id) as session:
+                legacy = (session.get_state("nav_stack"), session.get_state("current_screen"))
+                session.set_state("nav_stack", ["home", "menu"])
+                session.set_state("current_screen", "settings")
+                session.set_state("admin_flow", {"action": "ban"})
+            migrated = ([r["key"] for r in rows("user_states")], len(rows("user_sessions")))
+
+            statements = []
+            with db._pool().writer() as conn:
+                conn.set_trace_callback(statements.append)
+            try:
+                async with db.user_session(user_id) as session:
+                    session.set_state("nav_stack", ["home", "menu", "settings"])
+                    session.set_state("current_screen", "plans")
+            finally:
+                with db._pool().writer() as conn:
+                    conn.set_trace_callback(None)
+            dml = [st for st in statements if st.split(None, 1)[0].upper() in ("INSERT", "UPDATE", "DELETE")]
+
+            async with db.user_session(user_id) as session:
+                loaded = (session.get_state("nav_stack"), session.get_state("current_screen"), session.get_state("admin_flow"))
+                # Неупаковываемое значение уходит в user_states, из упакованной строки ключ убирается
+                session.set_state("current_screen", {"weird": True})
+            fallback = await db.get_user_state(user_id, "current_screen")
+            await db.set_user_state(user_id, "current_screen", "help")
+            direct = (await db.get_user_state(user_id, "current_screen"), await db.get_user_state(user_id, "nav_stack"))
+            cold_left = [r["key"] for r in rows("user_states")]
+            await db.reset_user_data(user_id)
+            sessions_after_reset = len(rows("user_sessions"))
+
+            # Строку users удалили, пока сессия известного пользователя открыта — flush её восстанавливает
+            async with db.user_session(user_id) as session:
+                session.set_state("nav_stack", ["home"])
+            async with db.user_session(user_id) as session:
+                await db.reset_user_data(user_id)
+                # Как если бы удаление выполнилось в писателе уже после того, как flush решил known
+                db._remember_user(user_id)
+                session.set_state("nav_stack", ["home", "menu"])
+                session.set_state("admin_flow", {"action": "ban"})
+            reopened = (len(rows("users")), await db.get_user_state(user_id, "nav_stack"))
+
+            # То же для flush только профиля: UPDATE по удалённой строке users не должен молча потеряться
+            async with db.user_session(user_id) as session:
+                await db.reset_user_data(user_id)
+                db._remember_user(user_id)
+                session.update_profile(language="en")
+            profile_only = (len(rows("users")), (await db.get_user_profile(user_id))["language"])
+            return legacy, migrated, dml, loaded, fallback, direct, cold_left, sessions_after_reset, reopened, profile_only
+
+        db.init_db()
+        (
+            legacy, migrated, dml, loaded, fallback, direct, cold_left, sessions_after_reset, reopened, profile_only
+        ) = asyncio.run(scenario())
+
+        if legacy != (["home"], "menu") or migrated != (["admin_flow"], 1):
+            print_error(f"Миграция старого формата: {legacy}, {migrated}")
+            return False
+        print_success("Старые строки nav_stack/current_screen прочитаны и перенесены в user_sessions")
+
+        if len(dml) != 2 or "DO NOTHING" not in dml[0] or "user_sessions" not in dml[1]:
+            print_error(f"Переход известного пользователя: проверка users и 1 upsert user_sessions, а не {dml}")
+            return False
+        print_success("Переход: INSERT users ... DO NOTHING + 1 upsert user_sessions вместо upsert на каждый ключ")
+
+        if loaded != (["home", "menu", "settings"], "plans", {"action": "ban"}):
+            print_error(f"Сессия загрузилась неверно: {loaded}")
+            return False
+        if fallback != {"weird": True} or direct != ("help", ["home", "menu", "settings"]) or cold_left != ["admin_flow"]:
+            print_error(f"Неупаковываемые значения/get/set_user_state: {fallback}, {direct}, {cold_left}")
+            return False
+        if sessions_after_reset:
+            print_error("reset_user_data не удалил user_sessions")
+            return False
+        print_success("Холодные ключи — в user_states; get/set_user_state и reset_user_data учитывают user_sessions")
+
+        if reopened != (1, ["home", "menu"]):
+            print_error(f"flush после удаления строки users: {reopened}")
+            return False
+        print_success("Строка users удалена во время сессии — flush пересоздаёт её вместо ошибки FK")
+
+        if profile_only != (1, "en"):
+            print_error(f"flush только профиля после удаления строки users: {profile_only}")
+            return False
+        print_success("Flush только профиля после удаления строки users пересоздаёт её и пишет изменения")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования упакованной навигации: {e}")
+        return False
+
+@on_temp_db
+def test_state_ttl_sweeper():
+    """Тест 30: TTL ключей user_states, пакетная уборка и архивация неактивных пользователей."""
+    print_header("ТЕСТ 30: TTL состояний и архивация неактивных")
+
+    try:
+        import asyncio
+        import os
+        import sqlite3
+        import user_db_handler as db
+        from maintenance import StateSweeper
+
+        user_id = 9_030_001
+        idle_ids = [9_030_100 + i for i in range(5)]
+        ttl_key = next(iter(db.STATE_TTLS), None)
+        if ttl_key is None:
+            print_error("UI_BOT_STATE_TTLS пуст — нечего проверять")
+            return False
+
+        def count(sql, *args):
+            with db._pool().reader() as conn:
+                return conn.execute(sql, args).fetchone()[0]
+
+        async def scenario():
+            await db.set_user_state(user_id, ttl_key, {"step": 1})
+            await db.set_user_state(user_id, "plain_key", 1)
+            fresh = await db.get_user_state(user_id, ttl_key)
+            # Истекаем вручную: часы не трогаем, сдвигаем expires_at в прошлое
+            await db._write(
+                lambda conn: conn.execute(
+                    "UPDATE user_states SET expires_at = '2000-01-01T00:00:00Z' WHERE user_id = ? AND key = ?",
+                    (user_id, ttl_key),
+                )
+            )
+            hidden = await db.get_user_state(user_id, ttl_key)
+            async with db.user_session(user_id) as session:
+                hidden_in_session = session.get_state(ttl_key)
+
+            # Ещё 5 истёкших строк — уборка пачками по 2 (2 + 2 + 2)
+            await db._write(
+                lambda conn: conn.executemany(
+                    "INSERT INTO user_states (user_id, key, value_json, updated_at, expires_at) VALUES (?, ?, '1', '', '2000-01-01T00:00:00Z')",
+                    [(user_id, f"old_{i}") for i in range(5)],
+                )
+            )
+            batches = []
+            original = db.sweep_expired_states
+
+            async def counting(batch_size):
+                n = await original(batch_size)
+                batches.append(n)
+                return n
+
+            sweeper = StateSweeper(batch_size=2, pause=0, archive_after_days=30)
+            import maintenance
+            maintenance.sweep_expired_states = counting
+            try:
+                # Неактивные пользователи: profile + состояние + навигация, updated_at год назад
+                for uid in idle_ids:
+                    await db.set_user_state(uid, "plain_key", uid)
+                    async with db.user_session(uid) as session:
+                        session.set_state("nav_stack", ["home"])
+                db.flush_touches()
+                await db._write(
+                    lambda conn: conn.executemany(
+                        "UPDATE users SET updated_at = '2000-01-01T00:00:00Z', language = 'en' WHERE user_id = ?",
+                        [(uid,) for uid in idle_ids],
+                    )
+                )
+                report = await sweeper.sweep_once()
+            finally:
+                maintenance.sweep_expired_states = original
+
+            survivor = await db.get_user_state(user_id, "plain_key")
+            returned = idle_ids[0]
+            await db.ensure_user(returned)
+            restored = (await db.get_user_profile(returned))["language"]
+            left_in_archive = count("SELECT COUNT(*) FROM users_archive")
+            return fresh, hidden, hidden_in_session, batches, report, survivor, restored, left_in_archive
+
+        db.init_db()
+        fresh, hidden, hidden_in_session, batches, report, survivor, restored, left_in_archive = asyncio.run(scenario())
+
+        if fresh != {"step": 1} or hidden is not None or hidden_in_session is not None:
+            print_error(f"Истёкший ключ виден: {fresh}, {hidden}, {hidden_in_session}")
+            return False
+        print_success(f"Ключ {ttl_key} с TTL: после expires_at не читается ни get_user_state, ни сессией")
+
+        if batches != [2, 2, 2, 0] or report["expired_states"] != 6 or survivor != 1:
+            print_error(f"Уборка пачками: {batches}, отчёт {report['expired_states']}, plain_key={survivor}")
+            return False
+        print_success("Истёкшие строки удалены пачками по batch_size, ключи без TTL не тронуты")
+
+        reclaimed = report["reclaimed_rows"]
+        if report["archived_users"] != 5 or reclaimed["users"] != 5 or reclaimed["user_states"] != 11 or reclaimed["user_sessions"] != 5:
+            print_error(f"Отчёт архивации неверный: {report}")
+            return False
+        if restored != "en" or left_in_archive != 4:
+            print_error(f"Возврат пользователя из архива: language={restored}, в архиве {left_in_archive}")
+            return False
+        print_success("Неактивные перенесены в users_archive, отчёт по таблицам верный, вернувшийся получил профиль")
+
+        # Миграция: база старого формата без expires_at
+        original_path = db.DB_PATH
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "old.sqlite3")
+            conn = sqlite3.connect(path)
+            conn.execute(
+                "CREATE TABLE user_states (user_id INTEGER NOT NULL, key TEXT NOT NULL, value_json TEXT NOT NULL, "
+                "updated_at TEXT NOT NULL, PRIMARY KEY (user_id, key))"
+            )
+            conn.executemany(
+                "INSERT INTO user_states VALUES (?, ?, '1', ?)",
+                [
+                    (1, "plain_key", ""),
+                    (1, ttl_key, "2000-01-01T00:00:00Z"),  # давно истёк — должен уйти при уборке
+                    (2, ttl_key, ""),  # без updated_at — срок от момента миграции
+                ],
+            )
+            conn.commit()
+            conn.close()
+            try:
+                db.configure_pool(path)
+                db.init_db()
+                with db._pool().reader() as conn:
+                    columns = [r[1] for r in conn.execute("PRAGMA table_info(user_states)")]
+                    without_ttl = conn.execute(
+                        "SELECT COUNT(*) FROM user_states WHERE key = ? AND expires_at IS NULL", (ttl_key,)
+                    ).fetchone()[0]
+                swept = asyncio.run(db.sweep_expired_states(100))
+                with db._pool().reader() as conn:
+                    left = sorted(tuple(r) for r in conn.execute("SELECT user_id, key FROM user_states"))
+            finally:
+                db.configure_pool(original_path)
+        if "expires_at" not in columns or without_ttl != 0:
+            print_error(f"Миграция старой базы: {columns}, строк {ttl_key} без срока {without_ttl}")
+            return False
+        if swept != 1 or left != [(1, "plain_key"), (2, ttl_key)]:
+            print_error(f"Уборка после миграции: удалено {swept}, осталось {left}")
+            return False
+        print_success(f"Старая база: expires_at добавлен и заполнен для {ttl_key}, истёкшая строка убрана sweeper'ом")
+        return True
+
+    except Exception as e:
+        print_error(f"Ошибка тестирования TTL состояний: {e}")
+        return False
+
 def main():
     """Главная функция тестирования."""
     print(f"\n{Colors.BOLD}{'='*60}")
@@ -275,7 +2246,31 @@ def main():
         ("Подключение Supabase", test_supabase),
         ("Шифрование данных", test_encryption),
         ("Локальная база данных", test_database),
-        ("Структура API", test_api_structure)
+        ("Структура API", test_api_structure),
+        ("Пул соединений SQLite", test_db_pool),
+        ("Touch-модель SQLite", test_db_touch),
+        ("Group commit SQLite", test_db_group_commit),
+        ("Кэш профилей", test_profile_cache),
+        ("Сессия апдейта", test_user_session),
+        ("Роутер callback_data", test_callback_router),
+        ("Каталог переводов", test_translation_catalog),
+        ("Режим edit для UI", test_ui_edit_mode),
+        ("Очередь исходящих вызовов", test_outbound_scheduler),
+        ("Клиент signal_requests", test_signal_client),
+        ("Outbox сигналов", test_signal_outbox),
+        ("Дедупликация сигналов", test_signal_dedup),
+        ("Доставка результатов сигналов", test_signal_results),
+        ("Монитор здоровья", test_health_monitor),
+        ("Пакетная выдача учетных данных", test_credentials_batch),
+        ("Лента изменений учетных данных", test_credentials_changes),
+        ("Реестр шифров", test_cipher_registry),
+        ("Ротация ключей шифрования", test_key_rotation),
+        ("Шифрование в пуле потоков", test_crypto_pool),
+        ("Webhook-режим", test_webhook_mode),
+        ("Параллельная обработка апдейтов", test_update_processor),
+        ("Схлопывание callback-ов", test_callback_coalescing),
+        ("Упакованная навигация", test_packed_session),
+        ("TTL состояний и архивация", test_state_ttl_sweeper),
     ]
     
     results = []
@@ -0,0 +1,161 @@
+"""
+ui_router.py
+
+Диспетчер inline callback_data для UI-бота.
+
+Маршруты регистрируются декоратором и компилируются в trie по сегментам ":":
+- статический сегмент:      "nav:home"
+- параметр (str):           "nav:{screen}"
+- типизированный параметр:  "user:{user_id:int}"
+- хвост строки целиком:     "admin:{rest:path}"
+
+Статический сегмент приоритетнее параметра; стоимость поиска — O(число сегментов),
+а не O(число маршрутов), как у цепочки startswith().
+"""
+
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+CallbackHandler = Callable[..., Awaitable[Any]]
+
+_CONVERTERS: Dict[str, Callable[[str], Any]] = {
+    "str": str,
+    "int": int,
+}
+
+
+class _Node:
+    __slots__ = ("static", "params", "handler", "pattern")
+
+    def __init__(self) -> None:
+        self.static: Dict[str, _Node] = {}
+        # (имя, конвертер | None для path, дочерний узел)
+        self.params: List[Tuple[str, Optional[Callable[[str], Any]], _Node]] = []
+        self.handler: Optional[CallbackHandler] = None
+        self.pattern: Optional[str] = None
+
+
+def _split_pattern(pattern: str, separator: str) -> List[str]:
+    # Разделитель внутри {...} (например, {user_id:int}) сегмент не делит
+    segments: List[str] = []
+    current: List[str] = []
+    depth = 0
+    for ch in pattern:
+        if ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+        if ch == separator and depth == 0:
+            segments.append("".join(current))
+            current = []
+        else:
+            current.append(ch)
+    segments.append("".join(current))
+    return segments
+
+
+def _parse_param(segment: str) -> Optional[Tuple[str, str]]:
+    if not (segment.startswith("{") and segment.endswith("}")):
+        return None
+    name, _, kind = segment[1:-1].partition(":")
+    return name, (kind or "str")
+
+
+class CallbackRouter:
+    """Регистрация и диспетчеризация callback_data."""
+
+    def __init__(self, separator: str = ":") -> None:
+        self.separator = separator
+        self._root = _Node()
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def route(self, pattern: str) -> Callable[[CallbackHandler], CallbackHandler]:
+        """Декоратор: @router.route("set:lang:{lang}")."""
+
+        def decorator(handler: CallbackHandler) -> CallbackHandler:
+            self.add_route(pattern, handler)
+            return handler
+
+        return decorator
+
+    def add_route(self, pattern: str, handler: CallbackHandler) -> None:
+        segments = _split_pattern(pattern, self.separator)
+        node = self._root
+        for i, segment in enumerate(segments):
+            param = _parse_param(segment)
+            if param is None:
+                node = node.static.setdefault(segment, _Node())
+                continue
+
+            name, kind = param
+            if kind == "path":
+                if i != len(segments) - 1:
+                    raise ValueError(f"{{{name}:path}} must be the last segment: {pattern}")
+                converter = None
+            elif kind in _CONVERTERS:
+                converter = _CONVERTERS[kind]
+            else:
+                raise ValueError(f"Unknown converter '{kind}' in route {pattern}")
+
+            for p_name, p_conv, p_node in node.params:
+                if p_name == name and p_conv is converter:
+                    node = p_node
+                    break
+            else:
+                child = _Node()
+                node.params.append((name, converter, child))
+                node = child
+
+        if node.handler is not None:
+            raise ValueError(f"Duplicate callback route: {pattern} (already {node.pattern})")
+        node.handler = handler
+        node.pattern = pattern
+        self._count += 1
+
+    def resolve(self, data: str) -> Optional[Tuple[CallbackHandler, Dict[str, Any]]]:
+        """Находит обработчик и параметры для callback_data (None — маршрута нет)."""
+        segments = data.split(self.separator)
+        params: Dict[str, Any] = {}
+        node = self._match(self._root, segments, 0, params)
+        if node is None:
+            return None
+        return node.handler, params  # type: ignore[return-value]
+
+    def _match(self, node: _Node, segments: List[str], i: int, params: Dict[str, Any]) -> Optional[_Node]:
+        if i == len(segments):
+            return node if node.handler is not None else None
+
+        child = node.static.get(segments[i])
+        if child is not None:
+            found = self._match(child, segments, i + 1, params)
+            if found is not None:
+                return found
+
+        for name, converter, p_node in node.params:
+            if converter is None:
+                if p_node.handler is not None:
+                    params[name] = self.separator.join(segments[i:])
+                    return p_node
+                continue
+            try:
+                params[name] = converter(segments[i])
+            except (TypeError, ValueError):
+                continue
+            found = self._match(p_node, segments, i + 1, params)
+            if found is not None:
+                return found
+            params.pop(name, None)
+        return None
+
+    async def dispatch(self, data: str, **kwargs: Any) -> bool:
+        """Вызывает обработчик с kwargs + параметрами маршрута. False — маршрут не найден."""
+        resolved = self.resolve(data)
+        if resolved is None:
+            return False
+        handler, params = resolved
+        await handler(**kwargs, **params)
+        return True
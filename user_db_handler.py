@@ -5,41 +5,495 @@ user_db_handler.py
 
 Хранит:
 - профиль пользователя (язык/валюта/тариф/бан/админ-флаг)
-- состояния/навигацию (key-value, JSON)
+- навигацию (current_screen + nav_stack) — одной упакованной строкой на пользователя (user_sessions)
+- прочие состояния (key-value, JSON; у части ключей — TTL, expires_at)
+- архив профилей давно неактивных пользователей (users_archive)
 - последний UI-message для "умного" удаления
 - зашифрованные учетные данные (login/password/ssid)
+- outbox запросов сигналов (signal_outbox) до пакетной отправки в Supabase
+- результаты сигналов от ядра и состояние их доставки (signal_deliveries)
+- tombstones удалённых кредов (credential_tombstones) для ленты изменений ядру
+- чекпоинты фоновых задач обслуживания (maintenance_jobs), например перешифрования кредов
 """
 
 from __future__ import annotations
 
 import asyncio
+import atexit
+import concurrent.futures
 import datetime as _dt
 import json
 import os
+import queue
 import sqlite3
 import threading
-from typing import Any, Dict, Optional
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
 
 
 DB_PATH = os.getenv("UI_BOT_DB_PATH") or os.path.join(os.path.dirname(__file__), "ui_bot.sqlite3")
+# busy timeout (сек) для писателя/читателей пула
+DB_TIMEOUT = float(os.getenv("UI_BOT_DB_TIMEOUT", "30") or 30)
+# PRAGMA synchronous писателя: FULL — fsync WAL на каждую пачку (future резолвится после записи на диск);
+# NORMAL — без fsync на коммит (быстрее, но последние пачки могут потеряться при сбое питания)
+DB_SYNCHRONOUS = (os.getenv("UI_BOT_DB_SYNCHRONOUS") or "FULL").strip().upper()
 _DB_INIT_LOCK = threading.Lock()
 _DB_INITIALIZED = False
 
+# Group commit: поток-писатель коммитит пачку, когда набралось N операций или прошло M мс.
+# M=0: без ожидания — в пачку идёт всё, что накопилось, пока шёл предыдущий COMMIT.
+WRITE_BATCH_MAX_OPS = int(os.getenv("UI_BOT_WRITE_BATCH_MAX_OPS", "64") or 64)
+WRITE_BATCH_MAX_DELAY = float(os.getenv("UI_BOT_WRITE_BATCH_MAX_DELAY_MS", "0") or 0) / 1000.0
+
+# Touch-модель: last-seen (users.updated_at) копится в памяти и пишется пачкой по таймеру
+TOUCH_FLUSH_INTERVAL = float(os.getenv("UI_BOT_TOUCH_FLUSH_INTERVAL", "30") or 30)
+_TOUCH_LOCK = threading.Lock()
+_PENDING_TOUCHES: Dict[int, str] = {}
+
+# Read-through кэш профилей (LRU + TTL); 0 — кэш выключен
+PROFILE_CACHE_SIZE = int(os.getenv("UI_BOT_PROFILE_CACHE_SIZE", "10000") or 0)
+PROFILE_CACHE_TTL = float(os.getenv("UI_BOT_PROFILE_CACHE_TTL", "300") or 0)
+
+# user_id, для которых строка в users уже точно есть (ensure_user без обращения к БД)
+_KNOWN_USERS_MAX = 100_000
+_KNOWN_USERS: set[int] = set()
+
+
+# TTL состояний по ключу (с): "key=seconds,key2=seconds"; истёкшие строки не читаются и удаляются фоном
+def _parse_ttls(raw: str) -> Dict[str, float]:
+    ttls: Dict[str, float] = {}
+    for item in raw.split(","):
+        key, _, seconds = item.partition("=")
+        try:
+            if key.strip() and float(seconds) > 0:
+                ttls[key.strip()] = float(seconds)
+        except ValueError:
+            continue
+    return ttls
+
+
+STATE_TTLS = _parse_ttls(os.getenv("UI_BOT_STATE_TTLS") or "pending_payment=86400,admin_flow=3600")
+
+# Фоновое перешифрование кредов: размер порции (строк) и пауза между порциями (с)
+REENCRYPT_CHUNK_SIZE = int(os.getenv("UI_BOT_REENCRYPT_CHUNK", "200") or 200)
+REENCRYPT_PAUSE = float(os.getenv("UI_BOT_REENCRYPT_PAUSE_MS", "50") or 0) / 1000.0
+
+
+# Поля users, которые можно менять через update_user_profile/UserSession
+_PROFILE_FIELDS = frozenset(
+    {
+        "language",
+        "currency",
+        "plan",
+        "is_admin",
+        "is_banned",
+        "last_ui_chat_id",
+        "last_ui_message_id",
+    }
+)
+
 
 def _utcnow_iso() -> str:
     return _dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
 
-def _connect() -> sqlite3.Connection:
-    # timeout: helps with short bursts of concurrent writes
-    conn = sqlite3.connect(DB_PATH, timeout=30)
-    conn.row_factory = sqlite3.Row
-    # IMPORTANT: SQLite foreign keys are off by default
-    try:
-        conn.execute("PRAGMA foreign_keys = ON;")
-    except Exception:
-        pass
-    return conn
+class _ConnectionPool:
+    """
+    Долгоживущие соединения SQLite.
+
+    - читатели: по одному соединению на рабочий поток (asyncio.to_thread), только чтение;
+    - писатель: одно соединение на процесс, доступ сериализован локом.
+
+    PRAGMA применяются один раз при открытии соединения, а не на каждый вызов.
+    """
+
+    def __init__(self, db_path: str, timeout: float = 30.0) -> None:
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._readers: Dict[int, Tuple[threading.Thread, sqlite3.Connection]] = {}
+        self._stats = {"opens": 0, "reads": 0, "writes": 0}
+
+    def _open(self, *, readonly: bool) -> sqlite3.Connection:
+        # check_same_thread=False: соединение живёт дольше одного вызова, закрываем из close_all()
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA foreign_keys = ON;")
+            if readonly:
+                conn.execute("PRAGMA query_only = ON;")
+            elif DB_SYNCHRONOUS in {"OFF", "NORMAL", "FULL", "EXTRA"}:
+                conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS};")
+        except Exception:
+            pass
+        with self._lock:
+            self._stats["opens"] += 1
+        return conn
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open(readonly=True)
+            self._local.conn = conn
+            with self._lock:
+                self._prune_dead_readers()
+                self._readers[threading.get_ident()] = (threading.current_thread(), conn)
+        with self._lock:
+            self._stats["reads"] += 1
+        yield conn
+
+    def _prune_dead_readers(self) -> None:
+        # Потоки executor'а умирают вместе с event loop'ом — их соединения закрываем сами
+        for ident, (thread, conn) in list(self._readers.items()):
+            if not thread.is_alive():
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                del self._readers[ident]
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._open(readonly=False)
+            conn = self._writer
+            with self._lock:
+                self._stats["writes"] += 1
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "readers": len(self._readers), "writer": int(self._writer is not None)}
+
+    def close_all(self) -> None:
+        with self._write_lock, self._lock:
+            conns = [conn for _, conn in self._readers.values()]
+            if self._writer is not None:
+                conns.append(self._writer)
+            for conn in conns:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._readers = {}
+            self._writer = None
+            # старые thread-local ссылки больше не валидны
+            self._local = threading.local()
+
+
+_POOL: Optional[_ConnectionPool] = None
+_POOL_LOCK = threading.Lock()
+
+
+def _pool() -> _ConnectionPool:
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = _ConnectionPool(DB_PATH, timeout=DB_TIMEOUT)
+    return _POOL
+
+
+def configure_pool(db_path: Optional[str] = None, timeout: Optional[float] = None) -> None:
+    """Настраивает пул соединений (один раз при старте; повторный вызов пересоздаёт пул)."""
+    global _POOL, DB_PATH, DB_TIMEOUT, _DB_INITIALIZED
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.close_all()
+        if db_path:
+            DB_PATH = db_path
+        if timeout is not None:
+            DB_TIMEOUT = float(timeout)
+        _POOL = _ConnectionPool(DB_PATH, timeout=DB_TIMEOUT)
+        _DB_INITIALIZED = False
+        _KNOWN_USERS.clear()
+        _PROFILE_CACHE.invalidate()
+
+
+def close_pool() -> None:
+    """Закрывает все соединения пула (при остановке процесса)."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.close_all()
+        _POOL = None
+
+
+def get_pool_stats() -> Dict[str, int]:
+    """Счётчики пула: opens/reads/writes и число открытых соединений."""
+    return _pool().stats()
+
+
+WriteOp = Callable[[sqlite3.Connection], Any]
+
+
+class _GroupCommitWriter:
+    """
+    Единственный поток-писатель с group commit.
+
+    Мутации приходят через очередь; поток собирает пачку (до WRITE_BATCH_MAX_OPS операций
+    или WRITE_BATCH_MAX_DELAY после первой) и выполняет её одной транзакцией.
+    Каждая операция — в своём SAVEPOINT: ошибка одной не откатывает остальные.
+    Future операции резолвится только после COMMIT пачки.
+    """
+
+    def __init__(self, max_ops: int, max_delay: float) -> None:
+        self.max_ops = max(1, max_ops)
+        self.max_delay = max(0.0, max_delay)
+        self._queue: "queue.Queue[Optional[Tuple[WriteOp, concurrent.futures.Future]]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="ui-db-writer", daemon=True)
+        self._stats = {"ops": 0, "batches": 0, "errors": 0, "max_batch": 0, "touch_flushes": 0}
+        self._next_touch_flush = time.monotonic() + TOUCH_FLUSH_INTERVAL
+        self._thread.start()
+
+    def submit(self, op: WriteOp) -> concurrent.futures.Future:
+        fut: concurrent.futures.Future = concurrent.futures.Future()
+        self._queue.put((op, fut))
+        return fut
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=timeout)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, "queued": self._queue.qsize()}
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            timeout = max(0.0, self._next_touch_flush - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+                batch: List[Tuple[WriteOp, concurrent.futures.Future]] = []
+            else:
+                if item is None:
+                    stopping = True
+                    batch = []
+                else:
+                    batch = [item]
+                    stopping = self._collect(batch)
+
+            touches = self._take_touches(force=stopping)
+            if batch or touches:
+                self._commit(batch, touches)
+
+    def _collect(self, batch: List[Tuple[WriteOp, concurrent.futures.Future]]) -> bool:
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_ops:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                return False
+            if item is None:
+                return True
+            batch.append(item)
+        return False
+
+    def _take_touches(self, *, force: bool) -> Dict[int, str]:
+        global _PENDING_TOUCHES
+        if not force and time.monotonic() < self._next_touch_flush:
+            return {}
+        self._next_touch_flush = time.monotonic() + TOUCH_FLUSH_INTERVAL
+        with _TOUCH_LOCK:
+            pending, _PENDING_TOUCHES = _PENDING_TOUCHES, {}
+        return pending
+
+    def _commit(self, batch: List[Tuple[WriteOp, concurrent.futures.Future]], touches: Dict[int, str]) -> None:
+        results: List[Tuple[concurrent.futures.Future, bool, Any]] = []
+        try:
+            with _pool().writer() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                for op, fut in batch:
+                    if not fut.set_running_or_notify_cancel():
+                        # Вызывающий отменил ожидание до начала записи — операцию не выполняем
+                        continue
+                    conn.execute("SAVEPOINT op")
+                    try:
+                        result = op(conn)
+                        conn.execute("RELEASE op")
+                        results.append((fut, True, result))
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO op")
+                        conn.execute("RELEASE op")
+                        results.append((fut, False, e))
+                if touches:
+                    _apply_touches(conn, touches)
+        except Exception as e:
+            # Транзакция пачки не прошла — ни одна операция не записана
+            for _, fut in batch:
+                if fut.done():
+                    continue
+                if fut.running() or fut.set_running_or_notify_cancel():
+                    self._stats["errors"] += 1
+                    fut.set_exception(e)
+            return
+
+        self._stats["batches"] += 1
+        self._stats["ops"] += len(batch)
+        self._stats["max_batch"] = max(self._stats["max_batch"], len(batch))
+        if touches:
+            self._stats["touch_flushes"] += 1
+        for fut, ok, value in results:
+            if ok:
+                fut.set_result(value)
+            else:
+                self._stats["errors"] += 1
+                fut.set_exception(value)
+
+
+_WRITER: Optional[_GroupCommitWriter] = None
+_WRITER_LOCK = threading.Lock()
+
+
+def _writer() -> _GroupCommitWriter:
+    global _WRITER
+    if _WRITER is None:
+        with _WRITER_LOCK:
+            if _WRITER is None:
+                _WRITER = _GroupCommitWriter(WRITE_BATCH_MAX_OPS, WRITE_BATCH_MAX_DELAY)
+    return _WRITER
+
+
+async def _write(op: WriteOp) -> Any:
+    """Ставит мутацию в очередь писателя и ждёт COMMIT её пачки."""
+    init_db()
+    return await asyncio.wrap_future(_writer().submit(op))
+
+
+def stop_writer() -> None:
+    """Дописывает очередь и touch'и и останавливает поток-писатель (при остановке процесса)."""
+    global _WRITER
+    with _WRITER_LOCK:
+        writer, _WRITER = _WRITER, None
+    if writer is not None:
+        writer.stop()
+
+
+def get_writer_stats() -> Dict[str, int]:
+    """Счётчики group commit: ops/batches/errors/max_batch/queued."""
+    return _writer().stats()
+
+
+class _ProfileCache:
+    """
+    LRU/TTL-кэш строк users внутри процесса.
+
+    Записи профиля обновляют кэш после COMMIT; reset — инвалидирует.
+    Чтение, начатое до записи профиля того же пользователя, свой результат в кэш не кладёт
+    (см. read_token), поэтому устаревшая строка не может перезаписать свежую. Записи других
+    пользователей чужие чтения не отменяют: счётчик записей — свой у каждого user_id.
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max(0, max_size)
+        self.ttl = ttl
+        self._items: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # epoch меняется при полной инвалидации и при сбросе _write_seqs (ограничение памяти)
+        self._epoch = 0
+        self._write_seqs: Dict[int, int] = {}
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is not None and (self.ttl <= 0 or item[0] > time.monotonic()):
+                self._items.move_to_end(user_id)
+                self._stats["hits"] += 1
+                return dict(item[1])
+            if item is not None:
+                del self._items[user_id]
+            self._stats["misses"] += 1
+            return None
+
+    def read_token(self, user_id: int) -> Tuple[int, int]:
+        with self._lock:
+            return self._epoch, self._write_seqs.get(user_id, 0)
+
+    def put(self, user_id: int, profile: Dict[str, Any], token: Tuple[int, int]) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if token != (self._epoch, self._write_seqs.get(user_id, 0)):
+                return
+            self._store(user_id, dict(profile))
+
+    def update(self, user_id: int, fields: Dict[str, Any]) -> None:
+        with self._lock:
+            self._bump(user_id)
+            item = self._items.get(user_id)
+            if item is not None:
+                self._store(user_id, {**item[1], **fields})
+
+    def invalidate(self, user_id: Optional[int] = None) -> None:
+        with self._lock:
+            if user_id is None:
+                self._epoch += 1
+                self._write_seqs.clear()
+                self._items.clear()
+            else:
+                self._bump(user_id)
+                self._items.pop(user_id, None)
+
+    def _bump(self, user_id: int) -> None:
+        if user_id not in self._write_seqs and len(self._write_seqs) >= _PROFILE_SEQS_MAX:
+            # Редкий сброс: отменяет чтения всех пользователей в полёте, но память ограничена
+            self._write_seqs.clear()
+            self._epoch += 1
+        self._write_seqs[user_id] = self._write_seqs.get(user_id, 0) + 1
+
+    def configure(self, max_size: Optional[int], ttl: Optional[float]) -> None:
+        with self._lock:
+            if max_size is not None:
+                self.max_size = max(0, max_size)
+            if ttl is not None:
+                self.ttl = ttl
+            self._evict()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "size": len(self._items), "max_size": self.max_size}
+
+    def _store(self, user_id: int, profile: Dict[str, Any]) -> None:
+        self._items[user_id] = (time.monotonic() + self.ttl, profile)
+        self._items.move_to_end(user_id)
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self._stats["evictions"] += 1
+
+
+# Сколько user_id держим в счётчиках записей кэша профилей; при переполнении — сброс через epoch
+_PROFILE_SEQS_MAX = 100_000
+_PROFILE_CACHE = _ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+
+def configure_profile_cache(max_size: Optional[int] = None, ttl: Optional[float] = None) -> None:
+    """Меняет лимит (записей) и TTL (сек) кэша профилей; max_size=0 выключает кэш."""
+    _PROFILE_CACHE.configure(max_size, ttl)
+
+
+def get_profile_cache_stats() -> Dict[str, int]:
+    """Счётчики кэша профилей: hits/misses/evictions/size."""
+    return _PROFILE_CACHE.stats()
 
 
 def init_db() -> None:
@@ -50,14 +504,24 @@ def init_db() -> None:
     with _DB_INIT_LOCK:
         if _DB_INITIALIZED:
             return
+        with _pool().writer() as conn:
+            _create_schema(conn.cursor())
+        _DB_INITIALIZED = True
+
 
-    conn = _connect()
-    cur = conn.cursor()
+def _add_column_if_missing(cur: sqlite3.Cursor, table: str, column: str, decl: str) -> bool:
+    # Миграция существующих БД: CREATE TABLE IF NOT EXISTS новые колонки не добавляет
+    columns = {row[1] for row in cur.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column in columns:
+        return False
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
 
+
+def _create_schema(cur: sqlite3.Cursor) -> None:
     # Better concurrency characteristics for a bot workload
     try:
         cur.execute("PRAGMA journal_mode = WAL;")
-        cur.execute("PRAGMA synchronous = NORMAL;")
     except Exception:
         # Not fatal (e.g., some FS may not support WAL)
         pass
@@ -94,7 +558,44 @@ def init_db() -> None:
         """
     )
 
-    # Произвольные состояния (JSON value)
+    # Лента изменений кредов для ядра: курсор (updated_at, user_id)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_credentials_updated ON user_credentials (updated_at, user_id)")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS credential_tombstones (
+            user_id INTEGER PRIMARY KEY,
+            deleted_at TEXT NOT NULL
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_credential_tombstones_deleted ON credential_tombstones (deleted_at, user_id)")
+
+    # Чекпоинты фоновых задач обслуживания (перешифрование кредов и т.п.)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS maintenance_jobs (
+            name TEXT PRIMARY KEY,
+            cursor INTEGER,
+            status TEXT NOT NULL,
+            stats_json TEXT NOT NULL DEFAULT '{}',
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+
+    # Горячие ключи навигации: одна строка на пользователя, упакованная (см. _pack_nav)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id INTEGER PRIMARY KEY,
+            nav BLOB NOT NULL,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
+        )
+        """
+    )
+
+    # Произвольные (холодные) состояния (JSON value)
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS user_states (
@@ -107,52 +608,197 @@ def init_db() -> None:
         )
         """
     )
+    # TTL: NULL — без срока; фоновый sweeper удаляет истёкшие строки пачками по индексу
+    if _add_column_if_missing(cur, "user_states", "expires_at", "TEXT"):
+        # Разовый backfill: старые строки TTL-ключей получают срок от updated_at
+        # (пустой/битый updated_at — от момента миграции), иначе sweeper их не увидит
+        for key, ttl in STATE_TTLS.items():
+            cur.execute(
+                """
+                UPDATE user_states SET expires_at = COALESCE(
+                    strftime('%Y-%m-%dT%H:%M:%SZ', updated_at, ?),
+                    strftime('%Y-%m-%dT%H:%M:%SZ', 'now', ?)
+                )
+                WHERE key = ? AND expires_at IS NULL
+                """,
+                (f"+{ttl} seconds", f"+{ttl} seconds", key),
+            )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_user_states_expires ON user_states (expires_at) WHERE expires_at IS NOT NULL"
+    )
+
+    # Профили неактивных пользователей, убранные из users (восстанавливаются при возвращении)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users_archive (
+            user_id INTEGER PRIMARY KEY,
+            profile_json TEXT NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_updated ON users (updated_at)")
+
+    # Outbox запросов сигналов: локальный commit сейчас, пакетная вставка в Supabase — фоном
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS signal_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            request_type TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            sent_at TEXT
+        )
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_signal_outbox_pending "
+        "ON signal_outbox (next_attempt_at, id) WHERE status = 'pending'"
+    )
+
+    # Результаты сигналов от ядра: result_id — ключ идемпотентности повторной доставки
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS signal_deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            result_id TEXT NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            request_type TEXT,
+            idempotency_key TEXT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            delivered_at TEXT
+        )
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_signal_deliveries_pending "
+        "ON signal_deliveries (next_attempt_at, id) WHERE status = 'pending'"
+    )
+
+
+def touch_user(user_id: int) -> None:
+    """Отмечает активность пользователя; запись в БД — пачкой раз в TOUCH_FLUSH_INTERVAL."""
+    with _TOUCH_LOCK:
+        _PENDING_TOUCHES[user_id] = _utcnow_iso()
+
+
+def _apply_touches(conn: sqlite3.Connection, touches: Dict[int, str]) -> None:
+    conn.executemany(
+        "UPDATE users SET updated_at = ? WHERE user_id = ? AND updated_at < ?",
+        [(ts, uid, ts) for uid, ts in touches.items()],
+    )
+
 
-    conn.commit()
-    conn.close()
-    _DB_INITIALIZED = True
+def flush_touches() -> int:
+    """Пишет накопленные touch'и сразу (не дожидаясь таймера). Возвращает число пользователей."""
+    global _PENDING_TOUCHES
+    with _TOUCH_LOCK:
+        if not _PENDING_TOUCHES:
+            return 0
+        pending, _PENDING_TOUCHES = _PENDING_TOUCHES, {}
+    init_db()
+    _writer().submit(lambda conn: _apply_touches(conn, pending)).result()
+    return len(pending)
+
+
+atexit.register(stop_writer)
+
+
+async def check_write_latency() -> float:
+    """Пустая транзакция через очередь писателя (BEGIN IMMEDIATE + COMMIT). Возвращает секунды."""
+    started = time.perf_counter()
+    await _write(lambda conn: conn.execute("SELECT 1").fetchone())
+    return time.perf_counter() - started
+
+
+def _ensure_user_row(conn: sqlite3.Connection, user_id: int, now: str) -> None:
+    # FK-родитель для user_states/user_credentials — в той же транзакции, что и сама запись
+    created = conn.execute(
+        """
+        INSERT INTO users (user_id, created_at, updated_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO NOTHING
+        """,
+        (user_id, now, now),
+    ).rowcount
+    if created:
+        _restore_archived_user(conn, user_id)
+
+
+def _restore_archived_user(conn: sqlite3.Connection, user_id: int) -> None:
+    # Вернувшийся пользователь получает прежний профиль из users_archive (только при создании строки users)
+    row = conn.execute("SELECT profile_json FROM users_archive WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None:
+        return
+    profile = json.loads(row["profile_json"])
+    fields = {k: profile[k] for k in ("language", "currency", "plan", "is_admin", "is_banned", "created_at") if k in profile}
+    if fields:
+        cols = ", ".join(f"{k} = ?" for k in fields)
+        conn.execute(f"UPDATE users SET {cols} WHERE user_id = ?", [*fields.values(), user_id])
+    conn.execute("DELETE FROM users_archive WHERE user_id = ?", (user_id,))
+
+
+def _remember_user(user_id: int) -> None:
+    if len(_KNOWN_USERS) >= _KNOWN_USERS_MAX:
+        _KNOWN_USERS.clear()
+    _KNOWN_USERS.add(user_id)
+
+
+def _forget_user(user_id: int) -> None:
+    _KNOWN_USERS.discard(user_id)
+    with _TOUCH_LOCK:
+        _PENDING_TOUCHES.pop(user_id, None)
 
 
 async def ensure_user(user_id: int) -> None:
-    """Гарантирует, что запись пользователя существует."""
+    """Гарантирует, что запись пользователя существует, и отмечает активность (touch)."""
     init_db()
+    touch_user(user_id)
+    if user_id in _KNOWN_USERS:
+        return
 
-    def _op() -> None:
-        now = _utcnow_iso()
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        row = cur.fetchone()
-        if not row:
-            cur.execute(
-                """
-                INSERT INTO users (user_id, created_at, updated_at)
-                VALUES (?, ?, ?)
-                """,
-                (user_id, now, now),
-            )
-        else:
-            cur.execute("UPDATE users SET updated_at = ? WHERE user_id = ?", (now, user_id))
-        conn.commit()
-        conn.close()
+    await _write(lambda conn: _ensure_user_row(conn, user_id, _utcnow_iso()))
+    _remember_user(user_id)
+
+
+def _default_profile(user_id: int) -> Dict[str, Any]:
+    return {"user_id": user_id, "language": "ru", "currency": "USD", "plan": "free", "is_admin": 0, "is_banned": 0}
 
-    await asyncio.to_thread(_op)
+
+def _read_profile(conn: sqlite3.Connection, user_id: int, token: Tuple[int, int]) -> Dict[str, Any]:
+    row = conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    if not row:
+        # Чтение ничего не создаёт: для нового пользователя — профиль по умолчанию,
+        # для архивного — прежний (строка users восстановится при первой записи)
+        archived = conn.execute("SELECT profile_json FROM users_archive WHERE user_id = ?", (user_id,)).fetchone()
+        if archived is not None:
+            return {**_default_profile(user_id), **json.loads(archived["profile_json"])}
+        return _default_profile(user_id)
+    profile = dict(row)
+    _PROFILE_CACHE.put(user_id, profile, token)
+    return profile
 
 
 async def get_user_profile(user_id: int) -> Dict[str, Any]:
     init_db()
-    await ensure_user(user_id)
+    cached = _PROFILE_CACHE.get(user_id)
+    if cached is not None:
+        return cached
+    token = _PROFILE_CACHE.read_token(user_id)
 
     def _op() -> Dict[str, Any]:
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        row = cur.fetchone()
-        conn.close()
-        if not row:
-            # ensure_user должен был создать, но оставим безопасный fallback
-            return {"user_id": user_id, "language": "ru", "currency": "USD", "plan": "free", "is_admin": 0, "is_banned": 0}
-        return dict(row)
+        with _pool().reader() as conn:
+            return _read_profile(conn, user_id, token)
 
     return await asyncio.to_thread(_op)
 
@@ -162,68 +808,142 @@ async def update_user_profile(user_id: int, **fields: Any) -> None:
     if not fields:
         return
     init_db()
-    await ensure_user(user_id)
 
-    allowed = {
-        "language",
-        "currency",
-        "plan",
-        "is_admin",
-        "is_banned",
-        "last_ui_chat_id",
-        "last_ui_message_id",
-    }
-    safe_fields = {k: v for k, v in fields.items() if k in allowed}
+    safe_fields = {k: v for k, v in fields.items() if k in _PROFILE_FIELDS}
     if not safe_fields:
         return
 
-    def _op() -> None:
-        now = _utcnow_iso()
+    touch_user(user_id)
+
+    now = _utcnow_iso()
+
+    def _op(conn: sqlite3.Connection) -> None:
         cols = ", ".join([f"{k} = ?" for k in safe_fields.keys()])
         params = list(safe_fields.values()) + [now, user_id]
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute(f"UPDATE users SET {cols}, updated_at = ? WHERE user_id = ?", params)
-        conn.commit()
-        conn.close()
+        _ensure_user_row(conn, user_id, now)
+        conn.execute(f"UPDATE users SET {cols}, updated_at = ? WHERE user_id = ?", params)
+
+    try:
+        await _write(_op)
+    except Exception:
+        _PROFILE_CACHE.invalidate(user_id)
+        raise
+    _PROFILE_CACHE.update(user_id, {**safe_fields, "updated_at": now})
+    _remember_user(user_id)
+
+
+# Ключи состояний, которые хранятся упакованными в user_sessions, а не строками user_states
+_NAV_KEYS = ("current_screen", "nav_stack")
+_NAV_FORMAT = 1
+
+
+def _packable(key: str, value: Any) -> bool:
+    # Упаковываются только имена экранов: непустые строки без NUL; прочее — как обычный state
+    def _name(v: Any) -> bool:
+        return isinstance(v, str) and bool(v) and "\x00" not in v
+
+    if key == "current_screen":
+        return _name(value)
+    if key == "nav_stack":
+        return isinstance(value, list) and all(_name(v) for v in value)
+    return False
+
+
+def _pack_nav(nav: Dict[str, Any]) -> bytes:
+    """[формат][флаги] current_screen \\0 nav_stack[0] \\0 nav_stack[1] ... (UTF-8)."""
+    current, stack = nav.get("current_screen"), nav.get("nav_stack")
+    flags = (1 if current is not None else 0) | (2 if stack is not None else 0)
+    body = (current or "").encode() + b"\x00" + b"\x00".join(v.encode() for v in stack or ())
+    return bytes((_NAV_FORMAT, flags)) + body
+
 
-    await asyncio.to_thread(_op)
+def _unpack_nav(blob: Optional[bytes]) -> Dict[str, Any]:
+    if not blob or len(blob) < 2 or blob[0] != _NAV_FORMAT:
+        return {}
+    flags = blob[1]
+    current, _, rest = bytes(blob[2:]).partition(b"\x00")
+    nav: Dict[str, Any] = {}
+    if flags & 1:
+        nav["current_screen"] = current.decode()
+    if flags & 2:
+        nav["nav_stack"] = [v.decode() for v in rest.split(b"\x00")] if rest else []
+    return nav
+
+
+def _read_nav(conn: sqlite3.Connection, user_id: int) -> Dict[str, Any]:
+    row = conn.execute("SELECT nav FROM user_sessions WHERE user_id = ?", (user_id,)).fetchone()
+    return _unpack_nav(row["nav"]) if row else {}
+
+
+def _save_nav(conn: sqlite3.Connection, user_id: int, nav: Dict[str, Any], now: str) -> None:
+    conn.execute(
+        """
+        INSERT INTO user_sessions (user_id, nav, updated_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            nav = excluded.nav,
+            updated_at = excluded.updated_at
+        """,
+        (user_id, _pack_nav(nav), now),
+    )
+
+
+def _state_expires_at(key: str) -> Optional[str]:
+    ttl = STATE_TTLS.get(key)
+    if ttl is None:
+        return None
+    return (_dt.datetime.utcnow() + _dt.timedelta(seconds=ttl)).replace(microsecond=0).isoformat() + "Z"
 
 
 async def set_user_state(user_id: int, key: str, value: Any) -> None:
     init_db()
-    await ensure_user(user_id)
+    touch_user(user_id)
+    value_json = json.dumps(value, ensure_ascii=False)
+    packed = _packable(key, value)
+    expires_at = _state_expires_at(key)
 
-    def _op() -> None:
+    def _op(conn: sqlite3.Connection) -> None:
         now = _utcnow_iso()
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute(
+        _ensure_user_row(conn, user_id, now)
+        if key in _NAV_KEYS:
+            nav = _read_nav(conn, user_id)
+            if packed:
+                nav[key] = value
+            else:
+                nav.pop(key, None)
+            _save_nav(conn, user_id, nav, now)
+            if packed:
+                conn.execute("DELETE FROM user_states WHERE user_id = ? AND key = ?", (user_id, key))
+                return
+        conn.execute(
             """
-            INSERT INTO user_states (user_id, key, value_json, updated_at)
-            VALUES (?, ?, ?, ?)
+            INSERT INTO user_states (user_id, key, value_json, updated_at, expires_at)
+            VALUES (?, ?, ?, ?, ?)
             ON CONFLICT(user_id, key) DO UPDATE SET
                 value_json = excluded.value_json,
-                updated_at = excluded.updated_at
+                updated_at = excluded.updated_at,
+                expires_at = excluded.expires_at
             """,
-            (user_id, key, json.dumps(value, ensure_ascii=False), now),
+            (user_id, key, value_json, now, expires_at),
         )
-        conn.commit()
-        conn.close()
 
-    await asyncio.to_thread(_op)
+    await _write(_op)
+    _remember_user(user_id)
 
 
 async def get_user_state(user_id: int, key: str, default: Any = None) -> Any:
     init_db()
-    await ensure_user(user_id)
 
     def _op() -> Any:
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute("SELECT value_json FROM user_states WHERE user_id = ? AND key = ?", (user_id, key))
-        row = cur.fetchone()
-        conn.close()
+        with _pool().reader() as conn:
+            if key in _NAV_KEYS:
+                nav = _read_nav(conn, user_id)
+                if key in nav:
+                    return nav[key]
+            row = conn.execute(
+                "SELECT value_json FROM user_states WHERE user_id = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (user_id, key, _utcnow_iso()),
+            ).fetchone()
         if not row:
             return default
         try:
@@ -236,28 +956,26 @@ async def get_user_state(user_id: int, key: str, default: Any = None) -> Any:
 
 async def delete_user_state(user_id: int, key: str) -> None:
     init_db()
-    await ensure_user(user_id)
 
-    def _op() -> None:
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM user_states WHERE user_id = ? AND key = ?", (user_id, key))
-        conn.commit()
-        conn.close()
+    def _op(conn: sqlite3.Connection) -> None:
+        if key in _NAV_KEYS:
+            nav = _read_nav(conn, user_id)
+            if nav.pop(key, None) is not None:
+                _save_nav(conn, user_id, nav, _utcnow_iso())
+        conn.execute("DELETE FROM user_states WHERE user_id = ? AND key = ?", (user_id, key))
 
-    await asyncio.to_thread(_op)
+    await _write(_op)
 
 
 async def save_encrypted_credentials(user_id: int, login_enc: str, password_enc: str) -> None:
     """Совместимость: сохраняет (login/password) в таблицу user_credentials."""
     init_db()
-    await ensure_user(user_id)
+    touch_user(user_id)
 
-    def _op() -> None:
+    def _op(conn: sqlite3.Connection) -> None:
         now = _utcnow_iso()
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute(
+        _ensure_user_row(conn, user_id, now)
+        conn.execute(
             """
             INSERT INTO user_credentials (user_id, login_enc, password_enc, updated_at)
             VALUES (?, ?, ?, ?)
@@ -268,21 +986,19 @@ async def save_encrypted_credentials(user_id: int, login_enc: str, password_enc:
             """,
             (user_id, login_enc, password_enc, now),
         )
-        conn.commit()
-        conn.close()
 
-    await asyncio.to_thread(_op)
+    await _write(_op)
+    _remember_user(user_id)
 
 
 async def save_encrypted_ssid(user_id: int, ssid_enc: str) -> None:
     init_db()
-    await ensure_user(user_id)
+    touch_user(user_id)
 
-    def _op() -> None:
+    def _op(conn: sqlite3.Connection) -> None:
         now = _utcnow_iso()
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute(
+        _ensure_user_row(conn, user_id, now)
+        conn.execute(
             """
             INSERT INTO user_credentials (user_id, ssid_enc, updated_at)
             VALUES (?, ?, ?)
@@ -292,23 +1008,20 @@ async def save_encrypted_ssid(user_id: int, ssid_enc: str) -> None:
             """,
             (user_id, ssid_enc, now),
         )
-        conn.commit()
-        conn.close()
 
-    await asyncio.to_thread(_op)
+    await _write(_op)
+    _remember_user(user_id)
 
 
 async def get_encrypted_data_from_local_db(user_id: int) -> Optional[Dict[str, str]]:
     """Совместимость: получает зашифрованные данные для API-сервера."""
     init_db()
-    await ensure_user(user_id)
 
     def _op() -> Optional[Dict[str, str]]:
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute("SELECT login_enc, password_enc FROM user_credentials WHERE user_id = ?", (user_id,))
-        row = cur.fetchone()
-        conn.close()
+        with _pool().reader() as conn:
+            row = conn.execute(
+                "SELECT login_enc, password_enc FROM user_credentials WHERE user_id = ?", (user_id,)
+            ).fetchone()
         if row and row["login_enc"] and row["password_enc"]:
             return {"login_enc": row["login_enc"], "password_enc": row["password_enc"]}
         return None
@@ -316,16 +1029,105 @@ async def get_encrypted_data_from_local_db(user_id: int) -> Optional[Dict[str, s
     return await asyncio.to_thread(_op)
 
 
+# Лимит параметров SQLite (SQLITE_MAX_VARIABLE_NUMBER в старых сборках — 999)
+_IN_CHUNK = 900
+
+
+def _select_credentials(conn: sqlite3.Connection, user_ids: List[int]) -> List[Dict[str, Any]]:
+    placeholders = ",".join("?" * len(user_ids))
+    rows = conn.execute(
+        f"SELECT user_id, login_enc, password_enc FROM user_credentials WHERE user_id IN ({placeholders})",
+        user_ids,
+    ).fetchall()
+    return [dict(row) for row in rows if row["login_enc"] and row["password_enc"]]
+
+
+async def get_encrypted_data_many(user_ids: List[int]) -> Dict[int, Dict[str, str]]:
+    """Пакетная версия get_encrypted_data_from_local_db: user_id -> {login_enc, password_enc}."""
+    init_db()
+    unique_ids = list(dict.fromkeys(user_ids))
+
+    def _op() -> Dict[int, Dict[str, str]]:
+        found: Dict[int, Dict[str, str]] = {}
+        with _pool().reader() as conn:
+            for i in range(0, len(unique_ids), _IN_CHUNK):
+                for row in _select_credentials(conn, unique_ids[i : i + _IN_CHUNK]):
+                    found[row["user_id"]] = {"login_enc": row["login_enc"], "password_enc": row["password_enc"]}
+        return found
+
+    return await asyncio.to_thread(_op)
+
+
+async def iter_encrypted_data_many(user_ids: List[int], chunk_size: int = _IN_CHUNK) -> AsyncIterator[List[Dict[str, Any]]]:
+    """То же, но порциями по chunk_size user_id (для потоковой отдачи больших пачек)."""
+    init_db()
+    unique_ids = list(dict.fromkeys(user_ids))
+    chunk_size = max(1, min(chunk_size, _IN_CHUNK))
+
+    def _op(chunk: List[int]) -> List[Dict[str, Any]]:
+        with _pool().reader() as conn:
+            return _select_credentials(conn, chunk)
+
+    for i in range(0, len(unique_ids), chunk_size):
+        yield await asyncio.to_thread(_op, unique_ids[i : i + chunk_size])
+
+
+# Курсор ленты: (метка времени, user_id, kind); kind: "delete" < "upsert" при равных ts/user_id
+ChangeCursor = Tuple[str, int, str]
+CHANGES_START: ChangeCursor = ("", -(2**63), "")
+
+
+async def get_credential_changes(after: ChangeCursor, until: str, limit: int) -> List[Dict[str, Any]]:
+    """
+    Изменения user_credentials строго после курсора after и не позже until (по возрастанию курсора):
+    {"ts", "user_id", "kind": "upsert", "login_enc", "password_enc", "ssid_enc"} или
+    {"ts", "user_id", "kind": "delete"} (tombstone из reset_user_data).
+    """
+    init_db()
+
+    def _op() -> List[Dict[str, Any]]:
+        # Каждая ветка берёт не больше limit строк по своему индексу — без сортировки всей таблицы
+        with _pool().reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT * FROM (
+                    SELECT updated_at AS ts, user_id, 'upsert' AS kind, login_enc, password_enc, ssid_enc
+                    FROM user_credentials
+                    WHERE (updated_at, user_id, 'upsert') > (?, ?, ?) AND updated_at <= ?
+                    ORDER BY updated_at, user_id
+                    LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT deleted_at AS ts, user_id, 'delete' AS kind, NULL, NULL, NULL
+                    FROM credential_tombstones
+                    WHERE (deleted_at, user_id, 'delete') > (?, ?, ?) AND deleted_at <= ?
+                    ORDER BY deleted_at, user_id
+                    LIMIT ?
+                )
+                ORDER BY ts, user_id, kind
+                LIMIT ?
+                """,
+                (*after, until, limit, *after, until, limit, limit),
+            ).fetchall()
+        changes = []
+        for row in rows:
+            change = dict(row)
+            if change["kind"] == "delete":
+                for key in ("login_enc", "password_enc", "ssid_enc"):
+                    del change[key]
+            changes.append(change)
+        return changes
+
+    return await asyncio.to_thread(_op)
+
+
 async def get_encrypted_ssid(user_id: int) -> Optional[str]:
     init_db()
-    await ensure_user(user_id)
 
     def _op() -> Optional[str]:
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute("SELECT ssid_enc FROM user_credentials WHERE user_id = ?", (user_id,))
-        row = cur.fetchone()
-        conn.close()
+        with _pool().reader() as conn:
+            row = conn.execute("SELECT ssid_enc FROM user_credentials WHERE user_id = ?", (user_id,)).fetchone()
         if row and row["ssid_enc"]:
             return row["ssid_enc"]
         return None
@@ -337,14 +1139,583 @@ async def reset_user_data(user_id: int) -> None:
     """Удаляет локальные данные пользователя (профиль/креды/состояния)."""
     init_db()
 
-    def _op() -> None:
-        conn = _connect()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
-        cur.execute("DELETE FROM user_credentials WHERE user_id = ?", (user_id,))
-        cur.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-        conn.commit()
-        conn.close()
+    def _op(conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
+        # Tombstone — чтобы зеркало ядра узнало об удалении из /credentials/changes
+        conn.execute(
+            """
+            INSERT INTO credential_tombstones (user_id, deleted_at)
+            SELECT user_id, ? FROM user_credentials WHERE user_id = ?
+            ON CONFLICT(user_id) DO UPDATE SET deleted_at = excluded.deleted_at
+            """,
+            (_utcnow_iso(), user_id),
+        )
+        conn.execute("DELETE FROM user_credentials WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+
+    await _write(_op)
+    _forget_user(user_id)
+    _PROFILE_CACHE.invalidate(user_id)
+
+
+# --- TTL состояний и архивация неактивных ---
+async def sweep_expired_states(batch_size: int) -> int:
+    """Удаляет до batch_size истёкших строк user_states (по индексу expires_at). Возвращает число удалённых."""
+    init_db()
+    now = _utcnow_iso()
+
+    def _op(conn: sqlite3.Connection) -> int:
+        return conn.execute(
+            "DELETE FROM user_states WHERE rowid IN (SELECT rowid FROM user_states WHERE expires_at <= ? LIMIT ?)",
+            (now, batch_size),
+        ).rowcount
+
+    return await _write(_op)
+
+
+async def archive_inactive_users(inactive_before: str, batch_size: int) -> Dict[str, int]:
+    """
+    Переносит до batch_size пользователей без активности с inactive_before в users_archive:
+    профиль сохраняется JSON'ом, строки users/user_states/user_sessions удаляются.
+    Пользователи с кредами и админы не архивируются. Возвращает число удалённых строк по таблицам.
+    """
+    init_db()
+    with _TOUCH_LOCK:
+        touched = set(_PENDING_TOUCHES)
+    now = _utcnow_iso()
+
+    def _op(conn: sqlite3.Connection) -> Tuple[List[int], Dict[str, int]]:
+        rows = conn.execute(
+            """
+            SELECT * FROM users u
+            WHERE u.updated_at < ? AND u.is_admin = 0
+                AND NOT EXISTS (SELECT 1 FROM user_credentials c WHERE c.user_id = u.user_id)
+            ORDER BY u.updated_at
+            LIMIT ?
+            """,
+            (inactive_before, batch_size + len(touched)),
+        ).fetchall()
+        # Активность, ещё не записанная touch'ем, — не повод архивировать
+        rows = [row for row in rows if row["user_id"] not in touched][:batch_size]
+        reclaimed = {"users": 0, "user_states": 0, "user_sessions": 0}
+        if not rows:
+            return [], reclaimed
+        ids = [row["user_id"] for row in rows]
+        conn.executemany(
+            """
+            INSERT INTO users_archive (user_id, profile_json, archived_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                profile_json = excluded.profile_json,
+                archived_at = excluded.archived_at
+            """,
+            [(row["user_id"], json.dumps(dict(row), ensure_ascii=False), now) for row in rows],
+        )
+        placeholders = ",".join("?" * len(ids))
+        for table in ("user_states", "user_sessions", "users"):
+            reclaimed[table] = conn.execute(f"DELETE FROM {table} WHERE user_id IN ({placeholders})", ids).rowcount
+        return ids, reclaimed
+
+    ids, reclaimed = await _write(_op)
+    for user_id in ids:
+        _forget_user(user_id)
+        _PROFILE_CACHE.invalidate(user_id)
+    return reclaimed
 
-    await asyncio.to_thread(_op)
 
+def get_state_table_stats() -> Dict[str, int]:
+    """Размеры таблиц состояний: строки user_states (в т.ч. с TTL), user_sessions, users, users_archive."""
+    init_db()
+    with _pool().reader() as conn:
+        row = conn.execute(
+            """
+            SELECT
+                (SELECT COUNT(*) FROM user_states) AS user_states,
+                (SELECT COUNT(*) FROM user_states WHERE expires_at IS NOT NULL) AS user_states_with_ttl,
+                (SELECT COUNT(*) FROM user_sessions) AS user_sessions,
+                (SELECT COUNT(*) FROM users) AS users,
+                (SELECT COUNT(*) FROM users_archive) AS users_archive
+            """
+        ).fetchone()
+    return dict(row)
+
+
+# --- перешифрование кредов ---
+_CREDENTIAL_FIELDS = ("login_enc", "password_enc", "ssid_enc")
+
+
+def get_job_checkpoint(name: str) -> Optional[Dict[str, Any]]:
+    """Чекпоинт задачи обслуживания: {"cursor", "status", "stats", "updated_at"} или None."""
+    init_db()
+    with _pool().reader() as conn:
+        row = conn.execute(
+            "SELECT cursor, status, stats_json, updated_at FROM maintenance_jobs WHERE name = ?", (name,)
+        ).fetchone()
+    if row is None:
+        return None
+    return {"cursor": row["cursor"], "status": row["status"], "stats": json.loads(row["stats_json"]), "updated_at": row["updated_at"]}
+
+
+def _save_checkpoint(conn: sqlite3.Connection, name: str, cursor: Optional[int], status: str, stats: Dict[str, int]) -> None:
+    conn.execute(
+        """
+        INSERT INTO maintenance_jobs (name, cursor, status, stats_json, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET
+            cursor = excluded.cursor,
+            status = excluded.status,
+            stats_json = excluded.stats_json,
+            updated_at = excluded.updated_at
+        """,
+        (name, cursor, status, json.dumps(stats), _utcnow_iso()),
+    )
+
+
+async def reencrypt_credentials(
+    rotate: Callable[[List[Optional[str]]], List[Optional[str]]],
+    job: str,
+    *,
+    chunk_size: int = REENCRYPT_CHUNK_SIZE,
+    pause: float = REENCRYPT_PAUSE,
+    max_chunks: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Перешифровывает user_credentials порциями по user_id (keyset, без OFFSET).
+
+    rotate(tokens) -> tokens: ciphertext на основном ключе (тот же объект — перешифровывать
+    не нужно, None — не расшифровывается). Порция и чекпоинт job коммитятся вместе,
+    поэтому после рестарта задача продолжает с последнего user_id; завершённая задача
+    повторно не запускается. Строку, изменённую пользователем между чтением и записью,
+    не трогаем — новое значение уже зашифровано основным ключом. updated_at перешифрованных
+    строк обновляется, чтобы ядро получило новые ciphertext'ы через /credentials/changes.
+
+    Между порциями — пауза pause и ожидание, пока у писателя не опустеет очередь UI-записей.
+    """
+    init_db()
+    checkpoint = await asyncio.to_thread(get_job_checkpoint, job)
+    stats: Dict[str, int] = {"scanned": 0, "rotated": 0, "unchanged": 0, "undecryptable": 0, "conflicts": 0, "chunks": 0}
+    if checkpoint is not None:
+        stats.update(checkpoint["stats"])
+        if checkpoint["status"] == "done":
+            return {"status": "done", "cursor": checkpoint["cursor"], **stats}
+    cursor: int = checkpoint["cursor"] if checkpoint and checkpoint["cursor"] is not None else -(2**63)
+    chunk_size = max(1, chunk_size)
+
+    def _read(after: int) -> List[Dict[str, Any]]:
+        with _pool().reader() as conn:
+            rows = conn.execute(
+                "SELECT user_id, login_enc, password_enc, ssid_enc FROM user_credentials "
+                "WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (after, chunk_size),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _rotate(rows: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], List[Optional[str]]]]:
+        tokens = rotate([row[field] for row in rows for field in _CREDENTIAL_FIELDS])
+        width = len(_CREDENTIAL_FIELDS)
+        return [(row, tokens[i * width : (i + 1) * width]) for i, row in enumerate(rows)]
+
+    chunks_done = 0
+    while max_chunks is None or chunks_done < max_chunks:
+        rows = await asyncio.to_thread(_read, cursor)
+        if not rows:
+            await _write(lambda conn: _save_checkpoint(conn, job, cursor, "done", stats))
+            return {"status": "done", "cursor": cursor, **stats}
+
+        rotated = await asyncio.to_thread(_rotate, rows)
+        chunk_stats = dict(stats)
+        updates = []
+        for row, tokens in rotated:
+            chunk_stats["scanned"] += 1
+            old = [row[field] for field in _CREDENTIAL_FIELDS]
+            if any(token is None and value for token, value in zip(tokens, old)):
+                chunk_stats["undecryptable"] += 1
+            elif tokens == old:
+                chunk_stats["unchanged"] += 1
+            else:
+                updates.append((*tokens, row["user_id"], *old))
+        next_cursor = rows[-1]["user_id"]
+
+        def _op(conn: sqlite3.Connection) -> Dict[str, int]:
+            now = _utcnow_iso()
+            changed = 0
+            for params in updates:
+                changed += conn.execute(
+                    """
+                    UPDATE user_credentials
+                    SET login_enc = ?, password_enc = ?, ssid_enc = ?, updated_at = ?
+                    WHERE user_id = ? AND login_enc IS ? AND password_enc IS ? AND ssid_enc IS ?
+                    """,
+                    (*params[:3], now, *params[3:]),
+                ).rowcount
+            committed = dict(chunk_stats)
+            committed["rotated"] += changed
+            committed["conflicts"] += len(updates) - changed
+            committed["chunks"] += 1
+            _save_checkpoint(conn, job, next_cursor, "running", committed)
+            return committed
+
+        stats = await _write(_op)
+        cursor = next_cursor
+        chunks_done += 1
+
+        # Уступаем писателя UI: пауза и ожидание пустой очереди (не дольше 20 пауз)
+        await asyncio.sleep(pause)
+        for _ in range(20):
+            if _writer().stats()["queued"] == 0:
+                break
+            await asyncio.sleep(max(pause, 0.005))
+
+    return {"status": "running", "cursor": cursor, **stats}
+
+
+# --- signal outbox ---
+async def enqueue_signal_request(user_id: int, request_type: str, idempotency_key: Optional[str] = None) -> str:
+    """Кладёт запрос сигнала в signal_outbox (один локальный commit). Возвращает idempotency_key."""
+    init_db()
+    key = idempotency_key or uuid.uuid4().hex
+
+    def _op(conn: sqlite3.Connection) -> None:
+        conn.execute(
+            """
+            INSERT INTO signal_outbox (idempotency_key, user_id, request_type, created_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(idempotency_key) DO NOTHING
+            """,
+            (key, user_id, request_type, _utcnow_iso()),
+        )
+
+    await _write(_op)
+    return key
+
+
+async def fetch_pending_signals(limit: int) -> List[Dict[str, Any]]:
+    """Готовые к отправке строки outbox (pending и next_attempt_at уже наступил), по порядку id."""
+    init_db()
+
+    def _op() -> List[Dict[str, Any]]:
+        with _pool().reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT id, idempotency_key, user_id, request_type, attempts, created_at
+                FROM signal_outbox
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at, id
+                LIMIT ?
+                """,
+                (time.time(), limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    return await asyncio.to_thread(_op)
+
+
+async def mark_signals_sent(ids: List[int]) -> None:
+    if not ids:
+        return
+    now = _utcnow_iso()
+
+    def _op(conn: sqlite3.Connection) -> None:
+        conn.executemany(
+            "UPDATE signal_outbox SET status = 'sent', sent_at = ?, attempts = attempts + 1, last_error = NULL WHERE id = ?",
+            [(now, row_id) for row_id in ids],
+        )
+
+    await _write(_op)
+
+
+async def mark_signals_failed(ids: List[int], error: str, retry_in: float, max_attempts: int) -> None:
+    """Отложить повтор на retry_in секунд; после max_attempts попыток строка получает status='failed'."""
+    if not ids:
+        return
+    next_attempt_at = time.time() + retry_in
+
+    def _op(conn: sqlite3.Connection) -> None:
+        conn.executemany(
+            """
+            UPDATE signal_outbox
+            SET attempts = attempts + 1,
+                next_attempt_at = ?,
+                last_error = ?,
+                status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE status END
+            WHERE id = ?
+            """,
+            [(next_attempt_at, error[:500], max_attempts, row_id) for row_id in ids],
+        )
+
+    await _write(_op)
+
+
+async def prune_signal_outbox(older_than: float) -> int:
+    """Удаляет отправленные строки старше older_than секунд. Возвращает число удалённых."""
+    init_db()
+    cutoff = (_dt.datetime.utcnow() - _dt.timedelta(seconds=older_than)).replace(microsecond=0).isoformat() + "Z"
+
+    def _op(conn: sqlite3.Connection) -> int:
+        return conn.execute("DELETE FROM signal_outbox WHERE status = 'sent' AND sent_at < ?", (cutoff,)).rowcount
+
+    return await _write(_op)
+
+
+def get_signal_outbox_stats() -> Dict[str, int]:
+    """Число строк outbox по статусам (pending/sent/failed)."""
+    init_db()
+    with _pool().reader() as conn:
+        rows = conn.execute("SELECT status, COUNT(*) AS n FROM signal_outbox GROUP BY status").fetchall()
+    stats = {"pending": 0, "sent": 0, "failed": 0}
+    stats.update({row["status"]: row["n"] for row in rows})
+    return stats
+
+
+# --- signal deliveries ---
+async def record_signal_results(results: List[Dict[str, Any]]) -> int:
+    """Сохраняет пачку результатов к доставке (повторный result_id игнорируется). Возвращает число новых."""
+    if not results:
+        return 0
+    init_db()
+    now = _utcnow_iso()
+
+    def _op(conn: sqlite3.Connection) -> int:
+        before = conn.total_changes
+        conn.executemany(
+            """
+            INSERT INTO signal_deliveries (result_id, user_id, request_type, idempotency_key, text, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(result_id) DO NOTHING
+            """,
+            [
+                (r["result_id"], r["user_id"], r.get("request_type"), r.get("idempotency_key"), r["text"], now)
+                for r in results
+            ],
+        )
+        return conn.total_changes - before
+
+    return await _write(_op)
+
+
+async def fetch_pending_deliveries(limit: int) -> List[Dict[str, Any]]:
+    init_db()
+
+    def _op() -> List[Dict[str, Any]]:
+        with _pool().reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT id, result_id, user_id, request_type, idempotency_key, text, attempts
+                FROM signal_deliveries
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at, id
+                LIMIT ?
+                """,
+                (time.time(), limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    return await asyncio.to_thread(_op)
+
+
+async def mark_deliveries(
+    delivered: List[int],
+    retry: List[Tuple[int, str]],
+    failed: List[Tuple[int, str]],
+    retry_in: float,
+    max_attempts: int,
+) -> None:
+    """Итог пачки доставки одной транзакцией: доставлено / повторить позже / окончательная ошибка."""
+    now = _utcnow_iso()
+    next_attempt_at = time.time() + retry_in
+
+    def _op(conn: sqlite3.Connection) -> None:
+        conn.executemany(
+            "UPDATE signal_deliveries SET status = 'delivered', delivered_at = ?, attempts = attempts + 1, "
+            "last_error = NULL WHERE id = ?",
+            [(now, row_id) for row_id in delivered],
+        )
+        conn.executemany(
+            """
+            UPDATE signal_deliveries
+            SET attempts = attempts + 1,
+                next_attempt_at = ?,
+                last_error = ?,
+                status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE status END
+            WHERE id = ?
+            """,
+            [(next_attempt_at, error[:500], max_attempts, row_id) for row_id, error in retry],
+        )
+        conn.executemany(
+            "UPDATE signal_deliveries SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+            [(error[:500], row_id) for row_id, error in failed],
+        )
+
+    await _write(_op)
+
+
+def get_signal_delivery_stats() -> Dict[str, int]:
+    """Число результатов по статусам доставки (pending/delivered/failed)."""
+    init_db()
+    with _pool().reader() as conn:
+        rows = conn.execute("SELECT status, COUNT(*) AS n FROM signal_deliveries GROUP BY status").fetchall()
+    stats = {"pending": 0, "delivered": 0, "failed": 0}
+    stats.update({row["status"]: row["n"] for row in rows})
+    return stats
+
+
+class UserSession:
+    """
+    Состояние пользователя на время одного апдейта.
+
+    Загружается одним обращением к БД (профиль + user_sessions + все user_states + флаг кредов),
+    хэндлеры меняют его в памяти, flush() пишет только изменённое одной транзакцией.
+    Навигация (current_screen, nav_stack) пишется одной упакованной строкой user_sessions.
+    """
+
+    def __init__(
+        self,
+        user_id: int,
+        profile: Dict[str, Any],
+        states: Dict[str, Any],
+        has_credentials: bool,
+        nav_rows: Optional[set[str]] = None,
+    ) -> None:
+        self.user_id = user_id
+        self.profile = profile
+        self.states = states
+        self.has_credentials = has_credentials
+        self._dirty_profile: Dict[str, Any] = {}
+        self._dirty_states: Dict[str, Any] = {}
+        self._deleted_states: set[str] = set()
+        # Ключи навигации, у которых есть строка в user_states (старый формат или неупаковываемое значение)
+        self._nav_rows: set[str] = set(nav_rows or ())
+
+    @property
+    def lang(self) -> str:
+        return self.profile.get("language", "ru")
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._dirty_profile or self._dirty_states or self._deleted_states)
+
+    def get_state(self, key: str, default: Any = None) -> Any:
+        return self.states.get(key, default)
+
+    def set_state(self, key: str, value: Any) -> None:
+        self.states[key] = value
+        self._dirty_states[key] = value
+        self._deleted_states.discard(key)
+
+    def delete_state(self, key: str) -> None:
+        self.states.pop(key, None)
+        self._dirty_states.pop(key, None)
+        self._deleted_states.add(key)
+
+    def update_profile(self, **fields: Any) -> None:
+        safe_fields = {k: v for k, v in fields.items() if k in _PROFILE_FIELDS}
+        self.profile.update(safe_fields)
+        self._dirty_profile.update(safe_fields)
+
+    async def flush(self) -> None:
+        """Пишет изменённые поля профиля и состояния одной транзакцией."""
+        if not self.dirty:
+            return
+        user_id = self.user_id
+        profile_fields = dict(self._dirty_profile)
+        nav: Optional[Dict[str, Any]] = None
+        nav_rows = set(self._nav_rows)
+        if any(k in self._dirty_states or k in self._deleted_states for k in _NAV_KEYS):
+            nav = {k: self.states[k] for k in _NAV_KEYS if k in self.states and _packable(k, self.states[k])}
+        states = {
+            k: json.dumps(v, ensure_ascii=False)
+            for k, v in self._dirty_states.items()
+            if not (nav is not None and k in nav)
+        }
+        # Упакованный ключ больше не должен читаться из user_states
+        deleted = list(self._deleted_states | {k for k in nav or () if k in nav_rows})
+        nav_rows = (nav_rows - set(deleted)) | {k for k in states if k in _NAV_KEYS}
+        now = _utcnow_iso()
+
+        def _op(conn: sqlite3.Connection) -> None:
+            # FK-родитель и цель UPDATE профиля. Даже у известного пользователя строку users могли
+            # удалить, пока сессия была открыта (reset_user_data, archive_inactive_users): UPDATE
+            # тогда молча не затронет ни одной строки, поэтому проверяем её всегда (INSERT ... DO NOTHING)
+            _ensure_user_row(conn, user_id, now)
+            if nav is not None:
+                _save_nav(conn, user_id, nav, now)
+            if profile_fields:
+                cols = ", ".join([f"{k} = ?" for k in profile_fields.keys()])
+                conn.execute(
+                    f"UPDATE users SET {cols}, updated_at = ? WHERE user_id = ?",
+                    list(profile_fields.values()) + [now, user_id],
+                )
+            if states:
+                conn.executemany(
+                    """
+                    INSERT INTO user_states (user_id, key, value_json, updated_at, expires_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id, key) DO UPDATE SET
+                        value_json = excluded.value_json,
+                        updated_at = excluded.updated_at,
+                        expires_at = excluded.expires_at
+                    """,
+                    [(user_id, k, v, now, _state_expires_at(k)) for k, v in states.items()],
+                )
+            if deleted:
+                conn.executemany(
+                    "DELETE FROM user_states WHERE user_id = ? AND key = ?", [(user_id, k) for k in deleted]
+                )
+
+        try:
+            await _write(_op)
+        except Exception:
+            _PROFILE_CACHE.invalidate(user_id)
+            raise
+        if profile_fields:
+            _PROFILE_CACHE.update(user_id, {**profile_fields, "updated_at": now})
+        _remember_user(user_id)
+        self._dirty_profile.clear()
+        self._dirty_states.clear()
+        self._deleted_states.clear()
+        self._nav_rows = nav_rows
+
+
+async def load_user_session(user_id: int) -> UserSession:
+    """Загружает профиль, навигацию, все user_states и флаг наличия кредов одним обращением к БД."""
+    init_db()
+    touch_user(user_id)
+    cached = _PROFILE_CACHE.get(user_id)
+    token = _PROFILE_CACHE.read_token(user_id)
+
+    def _op() -> UserSession:
+        with _pool().reader() as conn:
+            profile = cached if cached is not None else _read_profile(conn, user_id, token)
+            states: Dict[str, Any] = {}
+            for row in conn.execute(
+                "SELECT key, value_json FROM user_states WHERE user_id = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (user_id, _utcnow_iso()),
+            ):
+                try:
+                    states[row["key"]] = json.loads(row["value_json"])
+                except Exception:
+                    continue
+            nav_rows = {k for k in _NAV_KEYS if k in states}
+            states.update(_read_nav(conn, user_id))
+            creds = conn.execute(
+                """
+                SELECT 1 FROM user_credentials
+                WHERE user_id = ? AND login_enc IS NOT NULL AND password_enc IS NOT NULL
+                    AND login_enc != '' AND password_enc != ''
+                """,
+                (user_id,),
+            ).fetchone()
+        return UserSession(user_id, profile, states, has_credentials=creds is not None, nav_rows=nav_rows)
+
+    return await asyncio.to_thread(_op)
+
+
+@asynccontextmanager
+async def user_session(user_id: int) -> AsyncIterator[UserSession]:
+    """async with user_session(uid) as s: ... — загрузка в начале апдейта, flush в конце."""
+    session = await load_user_session(user_id)
+    try:
+        yield session
+    finally:
+        await session.flush()